@@ -0,0 +1,99 @@
+"""
+Benchmarks for the redis store.
+
+These run against a throwaway redis-server listening on a unix socket
+in a temporary directory, started and stopped by the harness, so they
+never touch a server that holds real data. Set REDIS_SERVER to the path
+of the redis-server binary if it is not on the PATH.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+
+class RedisServer(object):
+    """
+    A redis-server on a unix socket, with persistence turned off.
+    """
+
+    def __init__(self, binary=None):
+        self.binary = binary or os.environ.get('REDIS_SERVER',
+                'redis-server')
+        self.directory = None
+        self.process = None
+        self.socket_path = None
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix='redisbench')
+        self.socket_path = os.path.join(self.directory, 'redis.sock')
+        self.process = subprocess.Popen([self.binary,
+            '--port', '0',
+            '--unixsocket', self.socket_path,
+            '--dir', self.directory,
+            '--save', '',
+            '--appendonly', 'no'],
+            stdout=open(os.devnull, 'w'))
+        client = Redis(unix_socket_path=self.socket_path)
+        for _ in range(100):
+            try:
+                client.ping()
+                return self
+            except ConnectionError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError('unable to start %s' % self.binary)
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def store_config(self):
+        """
+        The store configuration for talking to this server.
+        """
+        return {'unix_socket_path': self.socket_path}
+
+
+def timed(func, *args):
+    """
+    Call func with args and return the elapsed time in seconds.
+    """
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def percentile(timings, fraction):
+    """
+    Return the timing at ``fraction`` (0 to 1) of the sorted timings.
+    """
+    ordered = sorted(timings)
+    if not ordered:
+        return 0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(timings):
+    """
+    Return a dict of count, throughput and latency percentiles (in
+    milliseconds) for a list of timings in seconds.
+    """
+    total = sum(timings)
+    return {
+            'count': len(timings),
+            'ops_per_second': total and len(timings) / total or 0,
+            'p50_ms': percentile(timings, 0.5) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000,
+            }
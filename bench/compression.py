@@ -0,0 +1,98 @@
+"""
+Measure the memory saved by compressing revision text, and what it
+costs in put and get latency, at several text sizes.
+
+    python -m bench.compression [revisions] [schema]
+
+For each text size and each codec and level, revisions revisions of
+wiki-like text are stored and read back. Printed as JSON, for each:
+the bytes of redis memory per revision, the share saved against no
+compression and the p50 and p99 latency of puts and gets.
+"""
+
+import json
+import random
+import sys
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.redisstore.compress import lz4
+
+from bench import RedisServer, summarize, timed
+
+SIZES = [256, 1024, 4096, 16384, 65536, 262144]
+
+CODECS = [(None, 0), ('zlib', 1), ('zlib', 6), ('zlib', 9), ('lz4', 0)]
+
+WORDS = ('the tiddler bag recipe text of a and to in wiki page store '
+        'revision redis server policy user tag field link with from '
+        'TiddlyWeb is for on that this by').split()
+
+
+def _text(chooser, size):
+    words = []
+    length = 0
+    while length < size:
+        word = chooser.choice(WORDS)
+        if chooser.random() < 0.1:
+            word = '[[%s %s]]' % (word.title(), chooser.randint(1, 999))
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+
+def bench_codec(server, codec, level, size, revisions, schema):
+    store = Store('tiddlywebplugins.redisstore', dict(server.store_config(),
+        schema=schema, compression=codec, compression_level=level,
+        compression_threshold=0), {'tiddlyweb.config': config})
+    redis = store.storage.redis
+    redis.flushdb()
+    store.put(Bag('texts'))
+    chooser = random.Random(size)
+    tiddlers = []
+    for index in range(revisions):
+        tiddler = Tiddler('tiddler%s' % (index % 10), 'texts')
+        tiddler.text = _text(chooser, size)
+        tiddlers.append(tiddler)
+
+    before = redis.info('memory')['used_memory']
+    puts = summarize([timed(store.put, tiddler) for tiddler in tiddlers])
+    used = redis.info('memory')['used_memory'] - before
+    gets = []
+    for tiddler in tiddlers:
+        stored = Tiddler(tiddler.title, 'texts')
+        stored.revision = tiddler.revision
+        gets.append(timed(store.get, stored))
+    return {'bytes_per_revision': used / float(revisions),
+            'put': puts, 'get': summarize(gets)}
+
+
+def run(revisions=200, schema=2):
+    server = RedisServer().start()
+    try:
+        results = []
+        for size in SIZES:
+            plain = None
+            for codec, level in CODECS:
+                if codec == 'lz4' and lz4 is None:
+                    continue
+                result = bench_codec(server, codec, level, size, revisions,
+                        schema)
+                if codec is None:
+                    plain = result['bytes_per_revision']
+                result.update({'size': size, 'codec': codec,
+                    'level': level, 'saved': 1 - result['bytes_per_revision']
+                        / plain})
+                results.append(result)
+        return {'parameters': {'revisions': revisions, 'schema': schema},
+                'results': results}
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(*[int(arg) for arg in sys.argv[1:]]), indent=4,
+        sort_keys=True))
@@ -0,0 +1,75 @@
+"""
+Measure the memory saved by sharing the text of revisions, and what it
+costs in put and get latency.
+
+    python -m bench.dedup [tiddlers] [revisions] [copies] [size]
+
+tiddlers tiddlers of size bytes of text are each given revisions
+revisions which change only their tags, and copied into copies other
+bags. Printed as JSON, with and without dedup_text: the bytes of redis
+memory per revision and the p50 and p99 latency of puts and gets.
+"""
+
+import json
+import random
+import sys
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from bench import RedisServer, summarize, timed
+from bench.compression import _text
+
+
+def bench_dedup(server, dedup, tiddlers, revisions, copies, size):
+    store = Store('tiddlywebplugins.redisstore', dict(server.store_config(),
+        dedup_text=dedup), {'tiddlyweb.config': config})
+    redis = store.storage.redis
+    redis.flushdb()
+    bags = ['bag%s' % index for index in range(copies + 1)]
+    for name in bags:
+        store.put(Bag(name))
+    chooser = random.Random(size)
+    texts = [_text(chooser, size) for _ in range(tiddlers)]
+
+    before = redis.info('memory')['used_memory']
+    puts = []
+    stored = 0
+    for index, text in enumerate(texts):
+        for revision in range(revisions):
+            tiddler = Tiddler('tiddler%s' % index, bags[0])
+            tiddler.text = text
+            tiddler.tags = ['revision%s' % revision]
+            puts.append(timed(store.put, tiddler))
+            stored += 1
+        for name in bags[1:]:
+            tiddler = Tiddler('tiddler%s' % index, name)
+            tiddler.text = text
+            puts.append(timed(store.put, tiddler))
+            stored += 1
+    used = redis.info('memory')['used_memory'] - before
+    gets = [timed(store.get, Tiddler('tiddler%s' % index, name))
+            for index in range(tiddlers) for name in bags]
+    return {'dedup_text': dedup, 'bytes_per_revision': used / float(stored),
+            'put': summarize(puts), 'get': summarize(gets)}
+
+
+def run(tiddlers=100, revisions=5, copies=2, size=4096):
+    server = RedisServer().start()
+    try:
+        results = [bench_dedup(server, dedup, tiddlers, revisions, copies,
+            size) for dedup in [False, True]]
+        results[1]['saved'] = 1 - (results[1]['bytes_per_revision']
+                / results[0]['bytes_per_revision'])
+        return {'parameters': {'tiddlers': tiddlers,
+            'revisions': revisions, 'copies': copies, 'size': size},
+            'results': results}
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(*[int(arg) for arg in sys.argv[1:]]), indent=4,
+        sort_keys=True))
@@ -0,0 +1,92 @@
+"""
+Measure the memory saved by keeping older revisions as deltas, against
+what it costs to read them, at several keyframe intervals.
+
+    python -m bench.deltas [revisions] [lines] [schema]
+
+For each interval, revisions revisions of one tiddler of lines lines
+are stored, each changing a few lines of the one before, and every
+revision is read back. Printed as JSON, for each: the bytes of redis
+memory per revision, the share saved against full text and the p50 and
+p99 latency of puts, of reading the latest revision and of reading the
+older ones.
+"""
+
+import json
+import random
+import sys
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from bench import RedisServer, summarize, timed
+from bench.compression import WORDS
+
+INTERVALS = [None, 2, 5, 10, 20, 50]
+
+
+def _texts(revisions, lines):
+    chooser = random.Random(lines)
+    text = [' '.join(chooser.choice(WORDS) for _ in range(10))
+            for _ in range(lines)]
+    texts = []
+    for _ in range(revisions):
+        for _ in range(3):
+            text[chooser.randrange(lines)] = ' '.join(
+                    chooser.choice(WORDS) for _ in range(10))
+        texts.append('\n'.join(text))
+    return texts
+
+
+def bench_interval(server, interval, texts, schema):
+    store = Store('tiddlywebplugins.redisstore', dict(server.store_config(),
+        schema=schema, revision_deltas=bool(interval),
+        delta_keyframe_interval=interval or 10),
+        {'tiddlyweb.config': config})
+    redis = store.storage.redis
+    redis.flushdb()
+    store.put(Bag('history'))
+
+    before = redis.info('memory')['used_memory']
+    puts = []
+    revisions = []
+    for text in texts:
+        tiddler = Tiddler('history', 'history')
+        tiddler.text = text
+        puts.append(timed(store.put, tiddler))
+        revisions.append(tiddler.revision)
+    used = redis.info('memory')['used_memory'] - before
+    gets = []
+    for rvid in revisions:
+        tiddler = Tiddler('history', 'history')
+        tiddler.revision = rvid
+        gets.append(timed(store.get, tiddler))
+    return {'bytes_per_revision': used / float(len(texts)),
+            'put': summarize(puts), 'get_latest': summarize(gets[-1:]),
+            'get_older': summarize(gets[:-1])}
+
+
+def run(revisions=200, lines=100, schema=2):
+    server = RedisServer().start()
+    try:
+        texts = _texts(revisions, lines)
+        results = []
+        full = None
+        for interval in INTERVALS:
+            result = bench_interval(server, interval, texts, schema)
+            if interval is None:
+                full = result['bytes_per_revision']
+            result.update({'interval': interval,
+                'saved': 1 - result['bytes_per_revision'] / full})
+            results.append(result)
+        return {'parameters': {'revisions': revisions, 'lines': lines,
+            'schema': schema}, 'results': results}
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(*[int(arg) for arg in sys.argv[1:]]), indent=4,
+        sort_keys=True))
@@ -0,0 +1,104 @@
+"""
+Compare getting many tiddlers at once, as a page of an async front end
+does, one after another with the Store and all at once with the
+ThreadedStore.
+
+    python -m bench.fan_out [max fan out] [requests] [workers]
+            [latency ms]
+
+For fan outs of 1, 2, 4... up to max fan out, requests requests each
+get that many tiddlers. Printed as JSON, for each fan out: the p50 and
+p99 latency of a request with each store and how many times quicker
+the ThreadedStore was at the median.
+
+The server is on a local unix socket, where a round trip costs less
+than the Python around it, so the threads of the ThreadedStore gain
+nothing. To stand in for the network between a front end and redis,
+each round trip waits latency ms more (1 by default, 0 for none).
+"""
+
+import json
+import sys
+import time
+
+from redis.connection import Connection
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.redisstore.threaded import ThreadedStore
+
+from bench import RedisServer, percentile, timed
+
+
+def _request(store, titles):
+    for title in titles:
+        store.get(Tiddler(title, 'fan'))
+
+
+def _threaded_request(store, titles):
+    futures = [store.get(Tiddler(title, 'fan')) for title in titles]
+    for future in futures:
+        future.result()
+
+
+def _delay_responses(latency):
+    """
+    Make each read of a response from redis first wait latency seconds.
+    """
+    read_response = Connection.read_response
+
+    def delayed(connection):
+        time.sleep(latency)
+        return read_response(connection)
+    Connection.read_response = delayed
+    return read_response
+
+
+def _latencies(timings):
+    return {'p50_ms': percentile(timings, 0.5) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000}
+
+
+def run(max_fan_out=256, requests=50, workers=16, latency=1):
+    server = RedisServer().start()
+    read_response = _delay_responses(latency / 1000.0)
+    try:
+        store_config = server.store_config()
+        store_config['store_workers'] = workers
+        environ = {'tiddlyweb.config': config}
+        store = Store('tiddlywebplugins.redisstore', store_config, environ)
+        threaded_store = ThreadedStore(store_config, environ)
+        store.put(Bag('fan'))
+        titles = ['tiddler%s' % index for index in range(max_fan_out)]
+        for title in titles:
+            tiddler = Tiddler(title, 'fan')
+            tiddler.text = 'text of %s\n' % title * 20
+            tiddler.tags = ['alpha', 'beta']
+            store.put(tiddler)
+
+        results = []
+        fan_out = 1
+        while fan_out <= max_fan_out:
+            sync = [timed(_request, store, titles[:fan_out])
+                    for _ in range(requests)]
+            concurrent = [timed(_threaded_request, threaded_store,
+                titles[:fan_out]) for _ in range(requests)]
+            results.append({'fan_out': fan_out,
+                'store': _latencies(sync),
+                'threaded_store': _latencies(concurrent),
+                'speedup': percentile(sync, 0.5)
+                    / percentile(concurrent, 0.5)})
+            fan_out *= 2
+        return {'parameters': {'requests': requests, 'workers': workers,
+            'latency_ms': latency}, 'results': results}
+    finally:
+        Connection.read_response = read_response
+        server.stop()
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(*[int(arg) for arg in sys.argv[1:]]), indent=4,
+        sort_keys=True))
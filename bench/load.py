@@ -0,0 +1,189 @@
+"""
+Drive the store from several threads in several processes at once,
+mixing reads and writes, as a deployment's WSGI workers do.
+
+    python -m bench.load [max threads] [max processes] [operations]
+
+Each combination of 1, 2, 4... up to max threads per process and 1,
+2, 4... up to max processes is run, each thread doing operations
+operations. The threads of a process share its redis connection pool,
+as Store instances share the client kept for their configuration.
+
+Printed as JSON, for each run: throughput, p50 and p99 latency, the
+connections each process opened and the time its threads spent getting
+a connection from the pool, and anomalies: revision ids handed out
+twice, tiddler ids shared by different tiddlers, revisions of a
+tiddler written by every worker that went missing, and errors.
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+
+from collections import Counter
+from multiprocessing import Process, Queue
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from bench import RedisServer, summarize
+
+# tiddlers read by the workers
+SEEDS = 100
+# the share of operations which are reads
+READS = 0.8
+
+
+def _store(store_config):
+    return Store('tiddlywebplugins.redisstore', store_config,
+            {'tiddlyweb.config': config})
+
+
+def _doubling(maximum):
+    value = 1
+    while value <= maximum:
+        yield value
+        value *= 2
+
+
+def worker(store_config, name, operations, results):
+    """
+    Do operations mixed reads and writes, recording their timings,
+    the revision ids of the writes and the titles created.
+    """
+    store = _store(store_config)
+    chooser = random.Random(name)
+    timings = []
+    revisions = []
+    titles = []
+    contended = 0
+    errors = []
+    for index in range(operations):
+        choice = chooser.random()
+        start = time.time()
+        try:
+            if choice < READS:
+                store.get(Tiddler('seed%s' % chooser.randrange(SEEDS),
+                    'load'))
+            else:
+                if choice < READS + (1 - READS) / 2:
+                    tiddler = Tiddler('%s-%s' % (name, index), 'load')
+                    titles.append(tiddler.title)
+                else:
+                    tiddler = Tiddler('contended', 'load')
+                    contended += 1
+                tiddler.text = 'written by %s' % name
+                store.put(tiddler)
+                revisions.append(tiddler.revision)
+        except Exception as exc:
+            errors.append('%s: %s' % (exc.__class__.__name__, exc))
+        timings.append(time.time() - start)
+    results.append({'timings': timings, 'revisions': revisions,
+        'titles': titles, 'contended': contended, 'errors': errors})
+
+
+def run_process(store_config, process_id, threads, operations, queue):
+    """
+    Run threads workers sharing one connection pool and put their
+    results, and the pool's, on the queue.
+    """
+    store = _store(store_config)
+    pool = store.storage.redis.connection_pool
+    waits = []
+    get_connection = pool.get_connection
+
+    def timed_get_connection(*args, **kwargs):
+        start = time.time()
+        try:
+            return get_connection(*args, **kwargs)
+        finally:
+            waits.append(time.time() - start)
+    pool.get_connection = timed_get_connection
+
+    results = []
+    workers = [threading.Thread(target=worker, args=(store_config,
+        'p%s-t%s' % (process_id, index), operations, results))
+        for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    queue.put({'workers': results,
+        'connections': pool._created_connections,
+        'pool_wait': sum(waits)})
+
+
+def run_load(server, threads, processes, operations):
+    store_config = server.store_config()
+    store = _store(store_config)
+    redis = store.storage.redis
+    redis.flushdb()
+    store.put(Bag('load'))
+    for index in range(SEEDS):
+        tiddler = Tiddler('seed%s' % index, 'load')
+        tiddler.text = 'seed %s' % index
+        store.put(tiddler)
+    store.put(Tiddler('contended', 'load'))
+
+    queue = Queue()
+    children = [Process(target=run_process, args=(store_config, index,
+        threads, operations, queue)) for index in range(processes)]
+    start = time.time()
+    for child in children:
+        child.start()
+    process_results = [queue.get() for _ in children]
+    elapsed = time.time() - start
+    for child in children:
+        child.join()
+
+    workers = [result for process in process_results
+            for result in process['workers']]
+    timings = [timing for result in workers for timing in result['timings']]
+    revisions = Counter(revision for result in workers
+            for revision in result['revisions'])
+    titles = [title for result in workers for title in result['titles']]
+    tids = Counter(tid for tid in redis.mget(['tiddler:load:%s:tid' % title
+        for title in titles]) if tid) if titles else Counter()
+    contended = sum(result['contended'] for result in workers)
+    written = len(store.list_tiddler_revisions(Tiddler('contended', 'load')))
+
+    summary = summarize(timings)
+    summary.update({
+        'threads': threads,
+        'processes': processes,
+        'ops_per_second': len(timings) / elapsed,
+        'connections': [process['connections']
+            for process in process_results],
+        'pool_wait_ms': sum(process['pool_wait']
+            for process in process_results) * 1000,
+        'anomalies': {
+            'duplicate_revision_ids': sum(count - 1
+                for count in revisions.values() if count > 1),
+            'shared_tiddler_ids': sum(count - 1
+                for count in tids.values() if count > 1),
+            'missing_tiddlers': len(titles) - sum(tids.values()),
+            'lost_revisions': contended + 1 - written,
+            'errors': sorted(set(error for result in workers
+                for error in result['errors'])),
+            },
+        })
+    return summary
+
+
+def run(max_threads=8, max_processes=4, operations=500):
+    server = RedisServer().start()
+    try:
+        return [run_load(server, threads, processes, operations)
+                for processes in _doubling(max_processes)
+                for threads in _doubling(max_threads)]
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(*[int(arg) for arg in sys.argv[1:]]), indent=4,
+        sort_keys=True))
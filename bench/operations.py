@@ -0,0 +1,148 @@
+"""
+Measure the throughput and latency of putting, getting, listing and
+deleting bags, recipes, users and tiddlers, for tracking regressions
+between releases.
+
+    python -m bench.operations [entity count] [revisions per tiddler]
+            [schema]
+
+The results are printed as JSON: for each entity and operation the
+count, operations per second and p50 and p99 latency in milliseconds,
+along with the parameters of the run.
+"""
+
+import json
+import sys
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.user import User
+from tiddlyweb.store import Store
+
+from bench import RedisServer, summarize, timed
+
+# how many times to list all the entities of a kind
+LISTS = 20
+
+
+def _make_bag(name):
+    bag = Bag(name)
+    bag.desc = 'the %s bag' % name
+    bag.policy.write = ['cdent', 'fnd']
+    return bag
+
+
+def _make_recipe(name):
+    recipe = Recipe(name)
+    recipe.desc = 'the %s recipe' % name
+    recipe.set_recipe([('system', ''), (name, 'select=tag:public')])
+    return recipe
+
+
+def _make_user(name):
+    user = User(name)
+    user.set_password('secret')
+    user.add_role('MEMBER')
+    return user
+
+
+def _list(store, lister, *args):
+    return lambda: list(getattr(store, lister)(*args))
+
+
+def bench_entities(store, kind, make, lister, count):
+    """
+    Put, get, list and delete count entities made by make.
+    """
+    names = ['%s%s' % (kind, index) for index in range(count)]
+    entities = [make(name) for name in names]
+    results = {}
+    results['put'] = summarize([timed(store.put, entity)
+        for entity in entities])
+    results['get'] = summarize([timed(store.get, make(name))
+        for name in names])
+    results['list'] = summarize([timed(_list(store, lister))
+        for _ in range(LISTS)])
+    results['delete'] = summarize([timed(store.delete, make(name))
+        for name in names])
+    return results
+
+
+def bench_tiddlers(store, count, revisions):
+    """
+    Put count tiddlers with revisions revisions each, then get, list
+    and delete them, and delete a bag holding as many.
+    """
+    store.put(Bag('tiddlers'))
+    tiddlers = []
+    for index in range(count):
+        tiddler = Tiddler('tiddler%s' % index, 'tiddlers')
+        tiddler.text = 'text of tiddler %s\n' % index * 10
+        tiddler.tags = ['alpha', 'beta', 'tag%s' % (index % 10)]
+        tiddler.fields['field'] = 'value %s' % index
+        tiddler.modifier = 'cdent'
+        tiddlers.append(tiddler)
+
+    results = {}
+    put_timings = []
+    for _ in range(revisions):
+        put_timings.extend(timed(store.put, tiddler) for tiddler in tiddlers)
+    results['put'] = summarize(put_timings)
+    results['get'] = summarize([timed(store.get,
+        Tiddler(tiddler.title, 'tiddlers')) for tiddler in tiddlers])
+    first_revisions = []
+    for tiddler in tiddlers:
+        first_revision = Tiddler(tiddler.title, 'tiddlers')
+        first_revision.revision = store.list_tiddler_revisions(
+                first_revision)[-1]
+        first_revisions.append(first_revision)
+    results['get_revision'] = summarize([timed(store.get, tiddler)
+        for tiddler in first_revisions])
+    results['list'] = summarize([timed(_list(store, 'list_bag_tiddlers',
+        Bag('tiddlers'))) for _ in range(LISTS)])
+    results['list_revisions'] = summarize([timed(_list(store,
+        'list_tiddler_revisions', Tiddler(tiddler.title, 'tiddlers')))
+        for tiddler in tiddlers])
+    results['delete'] = summarize([timed(store.delete,
+        Tiddler(tiddler.title, 'tiddlers')) for tiddler in tiddlers])
+
+    for tiddler in tiddlers:
+        tiddler.bag = 'doomed'
+    store.put(Bag('doomed'))
+    for _ in range(revisions):
+        for tiddler in tiddlers:
+            store.put(tiddler)
+    results['delete_bag'] = summarize([timed(store.delete, Bag('doomed'))])
+    return results
+
+
+def run(count=1000, revisions=1, schema=1):
+    server = RedisServer().start()
+    try:
+        store_config = server.store_config()
+        store_config['schema'] = schema
+        store = Store('tiddlywebplugins.redisstore', store_config,
+                {'tiddlyweb.config': config})
+        results = {
+                'parameters': {'count': count, 'revisions': revisions,
+                    'schema': store.storage.layout.version,
+                    'redis_version': store.storage.redis.info()[
+                        'redis_version']},
+                'bags': bench_entities(store, 'bag', _make_bag,
+                    'list_bags', count),
+                'recipes': bench_entities(store, 'recipe', _make_recipe,
+                    'list_recipes', count),
+                'users': bench_entities(store, 'user', _make_user,
+                    'list_users', count),
+                'tiddlers': bench_tiddlers(store, count, revisions),
+                }
+        return results
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(*[int(arg) for arg in sys.argv[1:]]), indent=4,
+        sort_keys=True))
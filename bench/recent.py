@@ -0,0 +1,83 @@
+"""
+Compare the latency of a recent changes query, sort=-modified;limit=20
+on a bag, answered from the recent index with the same filter answered
+by loading and sorting every tiddler, at several bag sizes, and of the
+merged recent changes of a recipe of several such bags.
+
+    python -m bench.recent [bag size...]
+"""
+
+import json
+import sys
+
+from tiddlyweb.config import config
+from tiddlyweb.filters import parse_for_filters, recursive_filter
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from tiddlywebplugins import redisstore
+
+from bench import RedisServer, summarize, timed
+
+LIMIT = 20
+RECIPE_BAGS = 4
+REPEAT = 20
+
+
+def run(sizes=(100, 1000, 10000)):
+    server = RedisServer().start()
+    try:
+        redisstore.init(config)
+        environ = {'tiddlyweb.config': dict(config,
+            indexer='tiddlywebplugins.redisstore')}
+        store = Store('tiddlywebplugins.redisstore', server.store_config(),
+                environ)
+        environ['tiddlyweb.store'] = store
+        return dict((size, _run_size(store, environ, size))
+                for size in sizes)
+    finally:
+        server.stop()
+
+
+def _run_size(store, environ, size):
+    bags = [Bag('bench%s_%s' % (size, index))
+            for index in range(RECIPE_BAGS)]
+    for number, bag in enumerate(bags):
+        store.put(bag)
+        for index in range(size // RECIPE_BAGS if number else size):
+            tiddler = Tiddler('tiddler%s' % index, bag.name)
+            tiddler.text = 'text of tiddler %s' % index
+            tiddler.modified = '2015%010d' % (index * RECIPE_BAGS + number)
+            store.put(tiddler)
+    recipe = Recipe('bench%s' % size)
+    recipe.set_recipe([(bag.name, '') for bag in bags])
+    store.put(recipe)
+
+    bag = bags[0]
+    filters, _ = parse_for_filters('sort=-modified;limit=%s' % LIMIT,
+            environ)
+
+    def recent(indexable):
+        return [tiddler.title for tiddler in recursive_filter(filters,
+            store.list_bag_tiddlers(bag), indexable=indexable)]
+
+    def recipe_recent():
+        return [store.get(tiddler) for tiddler in
+                store.storage.recent_recipe_tiddlers(recipe, LIMIT)]
+
+    assert recent(bag) == recent(False)
+    return {
+            'indexed': summarize([timed(recent, bag)
+                for _ in range(REPEAT)]),
+            'sorted': summarize([timed(recent, False)
+                for _ in range(REPEAT)]),
+            'recipe': summarize([timed(recipe_recent)
+                for _ in range(REPEAT)]),
+            }
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or (100, 1000, 10000)
+    print(json.dumps(run(sizes), indent=4, sort_keys=True))
@@ -0,0 +1,65 @@
+"""
+Compare the latency of a select filter on a bag answered from a field
+index with the same filter answered by loading every tiddler, at
+several bag sizes.
+
+    python -m bench.select_index [bag size...]
+"""
+
+import json
+import sys
+
+from tiddlyweb.config import config
+from tiddlyweb.filters import parse_for_filters, recursive_filter
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from bench import RedisServer, summarize, timed
+
+MODIFIERS = 10
+REPEAT = 20
+
+
+def run(sizes=(100, 1000, 10000)):
+    server = RedisServer().start()
+    try:
+        environ = {'tiddlyweb.config': dict(config,
+            indexer='tiddlywebplugins.redisstore')}
+        store_config = server.store_config()
+        store_config['indexed_fields'] = ['modifier']
+        store = Store('tiddlywebplugins.redisstore', store_config, environ)
+        environ['tiddlyweb.store'] = store
+        return dict((size, _run_size(store, environ, size))
+                for size in sizes)
+    finally:
+        server.stop()
+
+
+def _run_size(store, environ, size):
+    bag = Bag('bench%s' % size)
+    store.put(bag)
+    for index in range(size):
+        tiddler = Tiddler('tiddler%s' % index, bag.name)
+        tiddler.text = 'text of tiddler %s' % index
+        tiddler.modifier = 'user%s' % (index % MODIFIERS)
+        store.put(tiddler)
+
+    filters, _ = parse_for_filters('select=modifier:user1', environ)
+
+    def select(indexable):
+        return list(recursive_filter(filters, store.list_bag_tiddlers(bag),
+            indexable=indexable))
+
+    assert len(select(bag)) == len(select(False))
+    return {
+            'indexed': summarize([timed(select, bag)
+                for _ in range(REPEAT)]),
+            'scanned': summarize([timed(select, False)
+                for _ in range(REPEAT)]),
+            }
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or (100, 1000, 10000)
+    print(json.dumps(run(sizes), indent=4, sort_keys=True))
@@ -0,0 +1,72 @@
+"""
+Compare the latency of the pipelined tiddler_get with the one key at
+a time version it replaced.
+
+    python -m bench.tiddler_get [tiddler count] [revisions per tiddler]
+"""
+
+import json
+import sys
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+from tiddlyweb.util import binary_tiddler
+
+from bench import RedisServer, summarize, timed
+
+
+def unpipelined_tiddler_get(storage, tiddler):
+    """
+    tiddler_get as it was before pipelining: one round trip per key.
+    """
+    redis = storage.redis
+    bid, tid = storage._tid_for_tiddler(tiddler)
+    current_rvid = redis.lindex('tid:%s:revisions' % tid, -1)
+    base_rvid = redis.lindex('tid:%s:revisions' % tid, 0)
+    tiddler.creator = redis.uget('rvid:%s:modifier' % base_rvid)
+    tiddler.created = redis.uget('rvid:%s:modified' % base_rvid)
+    tiddler.modifier = redis.uget('rvid:%s:modifier' % current_rvid)
+    tiddler.modified = redis.uget('rvid:%s:modified' % current_rvid)
+    tiddler.type = redis.uget('rvid:%s:type' % current_rvid)
+    tiddler.tags = list(redis.smembers('rvid:%s:tags' % current_rvid))
+    tiddler.fields = redis.hgetall('rvid:%s:fields' % current_rvid)
+    if binary_tiddler(tiddler):
+        tiddler.text = redis.get('rvid:%s:text' % current_rvid)
+    else:
+        tiddler.text = redis.uget('rvid:%s:text' % current_rvid)
+    tiddler.revision = current_rvid
+    return tiddler
+
+
+def run(count=1000, revisions=1):
+    server = RedisServer().start()
+    try:
+        store = Store('tiddlywebplugins.redisstore', server.store_config(),
+                {'tiddlyweb.config': config})
+        store.put(Bag('bench'))
+        for index in range(count):
+            tiddler = Tiddler('tiddler%s' % index, 'bench')
+            tiddler.text = 'text of tiddler %s' % index
+            tiddler.tags = ['alpha', 'beta']
+            tiddler.fields['field'] = 'value'
+            for _ in range(revisions):
+                store.put(tiddler)
+
+        results = {}
+        for name, getter in [
+                ('pipelined', store.storage.tiddler_get),
+                ('unpipelined', lambda tiddler: unpipelined_tiddler_get(
+                    store.storage, tiddler))]:
+            results[name] = summarize([timed(getter,
+                Tiddler('tiddler%s' % index, 'bench'))
+                for index in range(count)])
+        return results
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(*[int(arg) for arg in sys.argv[1:]]), indent=4,
+        sort_keys=True))
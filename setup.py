@@ -19,7 +19,7 @@ setup(
     author_email = AUTHOR_EMAIL,
     url = 'http://pypi.python.org/pypi/%s' % NAME,
     platforms = 'Posix; MacOS X; Windows',
-    packages = find_packages(exclude=['test']),
+    packages = find_packages(exclude=['test', 'bench']),
     install_requires = ['setuptools', 'tiddlyweb', 'redis'],
     zip_safe = False
     )
@@ -0,0 +1,193 @@
+"""
+Test importing a text store and dumps into the store, and exporting it,
+carrying on after an interruption.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.user import User
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.redisstore.bulk import (IMPORTED_KEY,
+        entity_record, export_dump, import_source)
+
+from test.test_delta import _stored, _text
+
+# The png header, as the text of a binary tiddler.
+BINARY = '\x89PNG\r\n\x1a\n\x00\x00'
+
+
+def setup_module(module):
+    module.directory = tempfile.mkdtemp(prefix='redisbulk')
+    module.text_store = Store('text', {'store_root':
+        os.path.join(directory, 'store')}, {'tiddlyweb.config': config})
+    module.store = Store('tiddlywebplugins.redisstore', {}, {})
+    module.other = Store('tiddlywebplugins.redisstore', {'db': 6}, {})
+    for each in [store, other]:
+        each.storage.redis.flushdb()
+    _fill(text_store)
+
+
+def teardown_module(module):
+    shutil.rmtree(directory)
+
+
+def _fill(store):
+    user = User('cdent')
+    user.set_password('secret')
+    user.add_role('ADMIN')
+    store.put(user)
+    recipe = Recipe('everything')
+    recipe.set_recipe([('alpha', ''), ('beta', 'select=tag:one')])
+    store.put(recipe)
+    for name in ['alpha', 'beta']:
+        bag = Bag(name)
+        bag.desc = 'the %s bag' % name
+        bag.policy.write = ['cdent']
+        store.put(bag)
+        for index in range(5):
+            for revision in range(3):
+                tiddler = Tiddler('tiddler%s' % index, name)
+                tiddler.text = 'revision %s' % revision
+                tiddler.tags = ['one', 'tag%s' % revision]
+                tiddler.fields['count'] = '%s' % revision
+                tiddler.modifier = 'editor%s' % revision
+                tiddler.modified = '2011010100000%s' % revision
+                tiddler.type = 'text/x-markdown'
+                store.put(tiddler)
+    tiddler = Tiddler('image', 'alpha')
+    tiddler.type = 'image/png'
+    tiddler.modifier = 'cdent'
+    tiddler.text = BINARY
+    store.put(tiddler)
+
+
+def _contents(store):
+    """
+    Everything in the store, to compare stores with.
+    """
+    contents = []
+    for user in store.list_users():
+        user = store.get(user)
+        contents.append((user.usersign, user._password, user.list_roles()))
+    for recipe in store.list_recipes():
+        contents.append(store.get(recipe).get_recipe())
+    for bag in store.list_bags():
+        bag = store.get(bag)
+        contents.append((bag.name, bag.desc, bag.policy.write))
+        for tiddler in store.list_bag_tiddlers(bag):
+            for revision in reversed(store.list_tiddler_revisions(tiddler)):
+                tiddler.revision = revision
+                tiddler = store.get(tiddler)
+                contents.append((tiddler.bag, tiddler.title, tiddler.text,
+                    sorted(tiddler.tags), tiddler.fields.get('count'),
+                    tiddler.modifier, tiddler.modified, tiddler.creator,
+                    tiddler.type))
+    return sorted(contents)
+
+
+def test_import_text_store():
+    import_source(store.storage, os.path.join(directory, 'store'),
+            batch_size=4)
+    assert _contents(store) == _contents(text_store)
+
+    revisions = store.list_tiddler_revisions(Tiddler('tiddler0', 'alpha'))
+    assert len(revisions) == 3
+    assert revisions == sorted(revisions, reverse=True)
+    tiddler = store.get(Tiddler('tiddler0', 'alpha'))
+    assert tiddler.text == 'revision 2'
+    assert tiddler.creator == 'editor0'
+    assert store.get(Tiddler('image', 'alpha')).text == BINARY
+
+    # the next tiddler stored gets ids after those imported
+    tiddler = Tiddler('new', 'alpha')
+    store.put(tiddler)
+    assert tiddler.revision > max(revisions)
+
+
+def test_export_and_import_dump():
+    path = os.path.join(directory, 'everything.json')
+    export_dump(store.storage, path, batch_size=4)
+    assert not os.path.exists(path + '.checkpoint')
+    with open(path) as dump:
+        lines = dump.readlines()
+    assert [json.loads(line)['kind'] for line in lines[:3]] == ['user',
+            'recipe', 'bag']
+
+    # an import interrupted part way through carries on
+    with open(path, 'w') as dump:
+        dump.writelines(lines[:20])
+    import_source(other.storage, path, batch_size=8)
+    assert int(other.storage.redis.get(IMPORTED_KEY % path)) == 20
+    with open(path, 'w') as dump:
+        dump.writelines(lines)
+    import_source(other.storage, path, batch_size=8)
+    assert _contents(other) == _contents(store)
+
+
+def test_export_carries_on():
+    path = os.path.join(directory, 'again.json')
+    export_dump(store.storage, path)
+    with open(path) as dump:
+        whole = dump.read()
+
+    # the export stopped part way through a batch, after a checkpoint
+    # at tiddler2 in alpha
+    lines = whole.splitlines(True)
+    index = [index for index, line in enumerate(lines)
+            if json.loads(line).get('title') == 'tiddler2'][2]
+    offset = len(''.join(lines[:index + 1]))
+    with open(path + '.checkpoint', 'w') as checkpoint:
+        json.dump({'bag': 'alpha', 'title': 'tiddler2', 'offset': offset},
+                checkpoint)
+    with open(path, 'w') as dump:
+        dump.write(whole[:offset + 30])
+
+    export_dump(store.storage, path)
+    with open(path) as dump:
+        assert dump.read() == whole
+
+
+def test_import_deltas():
+    deltas = Store('tiddlywebplugins.redisstore', {'db': 5,
+        'revision_deltas': True, 'delta_keyframe_interval': 4}, {})
+    deltas.storage.redis.flushdb()
+    path = os.path.join(directory, 'deltas.json')
+    with open(path, 'w') as dump:
+        _write_record(dump, Bag('deltas'))
+        for version in range(10):
+            tiddler = Tiddler('imported', 'deltas')
+            tiddler.text = _text(version)
+            _write_record(dump, tiddler)
+    # a tiddler's revisions spread over batches
+    import_source(deltas.storage, path, batch_size=3)
+    for version in range(10):
+        tiddler = Tiddler('put', 'deltas')
+        tiddler.text = _text(version)
+        deltas.put(tiddler)
+
+    def _deltas(title):
+        revisions = list(reversed(deltas.list_tiddler_revisions(
+            Tiddler(title, 'deltas'))))
+        for version, rvid in enumerate(revisions):
+            tiddler = Tiddler(title, 'deltas')
+            tiddler.revision = rvid
+            assert deltas.get(tiddler).text == _text(version)
+        return [_stored(deltas, rvid)[2] and revisions.index(
+            int(_stored(deltas, rvid)[2])) for rvid in revisions]
+
+    # as if the revisions had been put one at a time
+    assert _deltas('imported') == _deltas('put') == [1, 2, 3, None, 5, 6,
+            7, None, 9, None]
+
+
+def _write_record(dump, entity):
+    dump.write(json.dumps(entity_record(entity)))
+    dump.write('\n')
@@ -0,0 +1,160 @@
+"""
+Test the in-process caches of bags, recipes, users and ids, and their
+invalidation across processes.
+"""
+
+import time
+
+from multiprocessing import Process
+
+import py.test
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.user import User
+from tiddlyweb.store import Store, NoBagError, NoTiddlerError
+
+from tiddlywebplugins.redisstore.cache import LRUCache
+
+from test.test_roundtrips import CommandCounter
+
+
+def setup_module(module):
+    Store('tiddlywebplugins.redisstore', {}, {}).storage.redis.flushdb()
+    module.store = _store()
+    module.cache = module.store.storage.cache
+
+
+def _store():
+    return Store('tiddlywebplugins.redisstore', {'cache_size': 100}, {})
+
+
+def _wait_for(condition):
+    for _ in range(50):
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_lru_cache():
+    lru = LRUCache(size=2, ttl=60)
+    loads = []
+
+    def loader(value):
+        def load():
+            loads.append(value)
+            return value
+        return load
+
+    assert lru.get('a', loader(1)) == 1
+    assert lru.get('a', loader(2)) == 1
+    lru.get('b', loader(2))
+    lru.get('a', loader(1))
+    lru.get('c', loader(3))
+    # b was the least recently used
+    assert lru.get('b', loader(4)) == 4
+    assert loads == [1, 2, 3, 4]
+    assert lru.stats == {'hits': 2, 'misses': 4, 'evictions': 2,
+            'invalidations': 0}
+
+    lru.ttl = 0
+    lru.get('d', loader(5))
+    assert lru.get('d', loader(6)) == 6
+
+
+def test_entities_cached():
+    bag = Bag('cached')
+    bag.desc = 'first'
+    bag.policy.read = ['cdent']
+    store.put(bag)
+    recipe = Recipe('cached')
+    recipe.set_recipe([('cached', 'select=tag:one')])
+    store.put(recipe)
+    user = User('cached')
+    user.add_role('ADMIN')
+    store.put(user)
+
+    hits = cache.entities.stats['hits']
+    for _ in range(2):
+        bag = store.get(Bag('cached'))
+        assert bag.desc == 'first'
+        assert bag.policy.read == ['cdent']
+        recipe = store.get(Recipe('cached'))
+        assert recipe.get_recipe() == [['cached', 'select=tag:one']]
+        assert store.get(User('cached')).list_roles() == ['ADMIN']
+    assert cache.entities.stats['hits'] == hits + 3
+
+    # changing a returned entity does not change the cached one
+    bag.policy.read.append('fnd')
+    assert store.get(Bag('cached')).policy.read == ['cdent']
+
+    bag.desc = 'second'
+    store.put(bag)
+    assert store.get(Bag('cached')).desc == 'second'
+
+    store.delete(Bag('cached'))
+    py.test.raises(NoBagError, 'store.get(Bag("cached"))')
+
+
+def _change_bag(name, desc):
+    bag = Bag(name)
+    bag.desc = desc
+    _store().put(bag)
+
+
+def test_invalidated_across_processes():
+    bag = Bag('shared')
+    bag.desc = 'before'
+    store.put(bag)
+    assert store.get(Bag('shared')).desc == 'before'
+    assert store.get(Bag('shared')).desc == 'before'
+
+    other = Process(target=_change_bag, args=('shared', 'after'))
+    other.start()
+    other.join()
+    assert other.exitcode == 0
+
+    assert _wait_for(lambda: store.get(Bag('shared')).desc == 'after')
+
+
+def test_ids_remembered():
+    store = Store('tiddlywebplugins.redisstore', {'id_cache_size': 100}, {})
+    store.put(Bag('remembered'))
+    tiddler = Tiddler('one', 'remembered')
+    tiddler.text = 'first'
+    store.put(tiddler)
+    store.get(Tiddler('one', 'remembered'))
+
+    counter = CommandCounter()
+    counter.start()
+    try:
+        tiddler = store.get(Tiddler('one', 'remembered'))
+    finally:
+        counter.stop()
+    assert counter.round_trips == 2
+    assert tiddler.text == 'first'
+
+    # the tiddler is deleted and made again, with a new tid, without
+    # telling this process
+    redis = store.storage.redis
+    redis.scripts['tiddler_delete'](keys=['bag:remembered:bid',
+        'tiddler:remembered:one:tid', 'bag:remembered:moved'],
+        args=['elsewhere'])
+    tiddler.text = 'second'
+    store.put(tiddler)
+    assert store.get(Tiddler('one', 'remembered')).text == 'second'
+
+    store.delete(Tiddler('one', 'remembered'))
+    py.test.raises(NoTiddlerError, 'store.get(Tiddler("one", "remembered"))')
+
+    # the bag is deleted and made again without telling this process
+    store.get(Bag('remembered'))
+    other = Store('tiddlywebplugins.redisstore', {}, {})
+    other.storage._delete_bag_record(redis.get('bag:remembered:bid'))
+    redis.delete('bag:remembered:bid')
+    bag = Bag('remembered')
+    bag.desc = 'again'
+    other.put(bag)
+    assert store.get(Bag('remembered')).desc == 'again'
@@ -0,0 +1,96 @@
+"""
+Test compressing the text of revisions, and reading revisions stored
+with and without compression.
+"""
+
+import py.test
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+TEXT = u'a line of text, with some unicode \u2603, ' * 100
+BINARY = '\x89PNG\r\n\x1a\n' + '\x00\x01\x02\x03' * 500
+
+
+def setup_module(module):
+    module.plain = Store('tiddlywebplugins.redisstore', {}, {})
+    plain.storage.redis.flushdb()
+    module.store = _store('zlib')
+    store.put(Bag('compressed'))
+
+
+def _store(codec, **options):
+    options['compression'] = codec
+    return Store('tiddlywebplugins.redisstore', options, {})
+
+
+def _put(store, title, text, tiddler_type=None):
+    tiddler = Tiddler(title, 'compressed')
+    tiddler.text = text
+    tiddler.type = tiddler_type
+    tiddler.modifier = 'cdent'
+    store.put(tiddler)
+    return tiddler.revision
+
+
+def _stored(store, rvid):
+    """
+    The stored text and compression of a revision.
+    """
+    pipe = store.storage.redis.pipeline()
+    reader = store.storage.layout.read_record(pipe, 'rvid', rvid,
+            ['text', 'compression'])
+    return reader(iter(pipe.execute()))
+
+
+def test_large_text_compressed():
+    rvid = _put(store, 'large', TEXT)
+    text, compression = _stored(store, rvid)
+    assert compression == 'zlib'
+    assert len(text) < len(TEXT) / 10
+    assert store.get(Tiddler('large', 'compressed')).text == TEXT
+
+
+def test_small_text_not_compressed():
+    rvid = _put(store, 'small', u'short \u2603')
+    assert _stored(store, rvid) == [u'short \u2603'.encode('utf-8'), None]
+    assert store.get(Tiddler('small', 'compressed')).text == u'short \u2603'
+
+
+def test_binary_compressed():
+    rvid = _put(store, 'image', BINARY, 'image/png')
+    assert _stored(store, rvid)[1] == 'zlib'
+    assert store.get(Tiddler('image', 'compressed')).text == BINARY
+
+
+def test_mixed_revisions():
+    first = _put(plain, 'mixed', TEXT + 'first')
+    second = _put(store, 'mixed', TEXT + 'second')
+    third = _put(plain, 'mixed', TEXT + 'third')
+    assert [_stored(store, rvid)[1] for rvid in [first, second, third]] == [
+            None, 'zlib', None]
+    for rvid, text in [(first, 'first'), (second, 'second'),
+            (third, 'third')]:
+        for reader in [store, plain]:
+            tiddler = Tiddler('mixed', 'compressed')
+            tiddler.revision = rvid
+            assert reader.get(tiddler).text == TEXT + text
+
+
+def test_threshold():
+    store = _store('zlib', compression_threshold=100000)
+    rvid = _put(store, 'threshold', TEXT)
+    assert _stored(store, rvid)[1] is None
+
+
+def test_lz4():
+    py.test.importorskip('lz4.frame')
+    store = _store('lz4')
+    rvid = _put(store, 'lz4', TEXT)
+    assert _stored(store, rvid)[1] == 'lz4'
+    assert store.get(Tiddler('lz4', 'compressed')).text == TEXT
+
+
+def test_unknown_codec():
+    py.test.raises(ValueError, "_store('bzip')")
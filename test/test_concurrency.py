@@ -0,0 +1,55 @@
+"""
+Test that Stores in several threads, sharing the redis client kept for
+their configuration, do not lose or mix up each other's writes.
+"""
+
+import threading
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+THREADS = 8
+PUTS = 50
+
+
+def setup_module(module):
+    module.store = Store('tiddlywebplugins.redisstore', {}, {})
+    store.storage.redis.flushdb()
+    store.put(Bag('shared'))
+
+
+def test_threaded_puts():
+    revisions = []
+    errors = []
+
+    def writer(name):
+        store = Store('tiddlywebplugins.redisstore', {}, {})
+        try:
+            for index in range(PUTS):
+                for title in ['contended', '%s-%s' % (name, index)]:
+                    tiddler = Tiddler(title, 'shared')
+                    tiddler.text = name
+                    store.put(tiddler)
+                    revisions.append(tiddler.revision)
+                    assert store.get(Tiddler(title, 'shared')).text
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=writer, args=('writer%s' % index,))
+            for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(set(revisions)) == THREADS * PUTS * 2
+    assert len(store.list_tiddler_revisions(
+        Tiddler('contended', 'shared'))) == THREADS * PUTS
+    titles = [tiddler.title for tiddler in
+            store.list_bag_tiddlers(Bag('shared'))]
+    assert len(titles) == THREADS * PUTS + 1
+    redis = store.storage.redis
+    tids = redis.mget(['tiddler:shared:%s:tid' % title for title in titles])
+    assert len(set(tids)) == len(titles)
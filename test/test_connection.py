@@ -0,0 +1,80 @@
+"""
+Test the connection configuration and that the connections of a
+process survive a child forked from it using the store.
+"""
+
+import os
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from redis.connection import UnixDomainSocketConnection
+
+from tiddlywebplugins.redisstore.connection import (
+        ForkSafeBlockingConnectionPool, make_pool)
+
+
+def setup_module(module):
+    module.store = Store('tiddlywebplugins.redisstore',
+            {'max_connections': 1}, {})
+    module.redis = store.storage.redis
+    redis.flushdb()
+    store.put(Bag('forked'))
+
+
+def test_pool_configuration():
+    pool = redis.connection_pool
+    assert pool.max_connections == 1
+    assert Store('tiddlywebplugins.redisstore', {'max_connections': 1},
+            {}).storage.redis is redis
+    assert Store('tiddlywebplugins.redisstore', {}, {}).storage.redis \
+            is not redis
+
+    pool = make_pool({'unix_socket_path': '/tmp/redis.sock', 'port': 1,
+        'socket_keepalive': True, 'db': 2})
+    assert pool.connection_class is UnixDomainSocketConnection
+    assert pool.connection_kwargs == {'path': '/tmp/redis.sock', 'db': 2}
+
+    pool = make_pool({'socket_keepalive': True, 'max_connections': 3,
+        'pool_timeout': 1})
+    assert isinstance(pool, ForkSafeBlockingConnectionPool)
+    assert pool.max_connections == 3
+    assert pool.timeout == 1
+    assert pool.connection_kwargs == {'host': 'localhost', 'port': 6379,
+            'db': 0, 'socket_keepalive': True}
+
+
+def _child():
+    """
+    Use the store made before the fork and a new one, returning
+    the exit status for the parent to check.
+    """
+    try:
+        for child_store in [store, Store('tiddlywebplugins.redisstore',
+                {'max_connections': 1}, {})]:
+            tiddler = Tiddler('child', 'forked')
+            tiddler.text = 'from the child'
+            child_store.put(tiddler)
+            assert child_store.get(tiddler).text == 'from the child'
+        return 0
+    except Exception:
+        return 1
+
+
+def test_fork():
+    tiddler = Tiddler('parent', 'forked')
+    tiddler.text = 'from the parent'
+    store.put(tiddler)
+    client_id = redis.execute_command('CLIENT', 'ID')
+
+    pid = os.fork()
+    if not pid:
+        os._exit(_child())
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+
+    # still on the same connection, which the child left alone
+    assert redis.execute_command('CLIENT', 'ID') == client_id
+    assert store.get(Tiddler('parent', 'forked')).text == 'from the parent'
+    assert store.get(Tiddler('child', 'forked')).text == 'from the child'
@@ -0,0 +1,182 @@
+"""
+Test sharing the text of revisions with the same text, and dropping
+the shared texts once nothing refers to them.
+"""
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.redisstore.dedup import text_digest
+from tiddlywebplugins.redisstore.manage import move_bag
+
+from test.test_roundtrips import CommandCounter
+
+TEXT = u'a copied plugin tiddler, with some unicode \u2603\n' * 100
+
+
+def setup_module(module):
+    module.plain = Store('tiddlywebplugins.redisstore', {}, {})
+    module.redis = plain.storage.redis
+    redis.flushdb()
+    module.store = _store()
+    for name in ['first', 'second']:
+        store.put(Bag(name))
+
+
+def _store(**options):
+    options.setdefault('dedup_text', True)
+    return Store('tiddlywebplugins.redisstore', options, {})
+
+
+def _put(store, title, text=TEXT, bag='first', tags=None):
+    tiddler = Tiddler(title, bag)
+    tiddler.text = text
+    tiddler.tags = tags or []
+    tiddler.modifier = 'cdent'
+    store.put(tiddler)
+    return tiddler.revision
+
+
+def _text_key(text=TEXT):
+    return 'text:%s' % text_digest(text, 0)
+
+
+def _refs(text=TEXT):
+    refs = redis.hget(_text_key(text), 'refs')
+    return refs and int(refs)
+
+
+def test_shared():
+    first = _put(store, 'plugin')
+    _put(store, 'plugin', tags=['retagged'])
+    _put(store, 'plugin', bag='second')
+    assert _refs() == 3
+    assert redis.get('rvid:%s:text' % first) is None
+    assert redis.get('rvid:%s:digest' % first) == text_digest(TEXT, 0)
+
+    tiddler = Tiddler('plugin', 'first')
+    tiddler.revision = first
+    for reader in [store, plain]:
+        assert reader.get(tiddler).text == TEXT
+        assert reader.get(Tiddler('plugin', 'first')).tags == ['retagged']
+        assert reader.get(Tiddler('plugin', 'second')).text == TEXT
+
+
+def test_memory_saved():
+    before = redis.info('memory')['used_memory']
+    for index in range(10):
+        _put(plain, 'full%s' % index, TEXT + 'full')
+    full = redis.info('memory')['used_memory'] - before
+    before = redis.info('memory')['used_memory']
+    for index in range(10):
+        _put(store, 'shared%s' % index, TEXT + 'shared')
+    assert redis.info('memory')['used_memory'] - before < full / 4
+
+
+def test_no_more_round_trips():
+    _put(plain, 'counted plain')
+    _put(store, 'counted')
+    round_trips = []
+    for reader, title in [(plain, 'counted plain'), (store, 'counted')]:
+        reader.get(Tiddler(title, 'first'))
+        counter = CommandCounter()
+        counter.start()
+        try:
+            assert reader.get(Tiddler(title, 'first')).text == TEXT
+        finally:
+            counter.stop()
+        round_trips.append(counter.round_trips)
+    assert round_trips[0] == round_trips[1]
+
+
+def test_scripts_flushed():
+    _put(store, 'flushed')
+    redis.script_flush()
+    assert store.get(Tiddler('flushed', 'first')).text == TEXT
+
+
+def test_short_text_kept():
+    rvid = _put(store, 'short', u'short')
+    assert redis.get('rvid:%s:text' % rvid) == 'short'
+    assert redis.get('rvid:%s:digest' % rvid) is None
+
+
+def test_released():
+    text = TEXT + 'released'
+    _put(store, 'released', text)
+    _put(store, 'released', text)
+    _put(store, 'released', text, bag='second')
+    assert _refs(text) == 3
+    store.delete(Tiddler('released', 'first'))
+    assert _refs(text) == 1
+    store.delete(Tiddler('released', 'second'))
+    assert not redis.exists(_text_key(text))
+
+
+def test_bag_delete_released():
+    text = TEXT + 'bag'
+    store.put(Bag('doomed'))
+    for index in range(3):
+        _put(store, 'doomed%s' % index, text, bag='doomed')
+    assert _refs(text) == 3
+    store.delete(Bag('doomed'))
+    assert not redis.exists(_text_key(text))
+
+
+def test_trim_released():
+    trimmed = _store(retain_revisions=1)
+    _put(store, 'trimmed', TEXT + 'old')
+    _put(trimmed, 'trimmed', TEXT + 'new')
+    assert not redis.exists(_text_key(TEXT + 'old'))
+    assert _refs(TEXT + 'new') == 1
+
+
+def test_compressed():
+    compressed = _store(compression='zlib')
+    text = TEXT + 'compressed'
+    _put(compressed, 'compressed', text)
+    _put(store, 'uncompressed', text)
+    assert redis.hget(_text_key(text), 'compression') == 'zlib'
+    assert len(redis.hget(_text_key(text), 'text')) < len(text) / 10
+    assert plain.get(Tiddler('uncompressed', 'first')).text == text
+
+
+def test_deltas():
+    deltas = _store(revision_deltas=True)
+    text = TEXT + 'delta'
+    first = _put(deltas, 'unique', text)
+    _put(deltas, 'unique', text + 'changed')
+    # the only reference is dropped as the revision becomes a delta
+    assert redis.get('rvid:%s:delta' % first)
+    assert not redis.exists(_text_key(text))
+
+    shared = _put(deltas, 'shared', TEXT)
+    _put(deltas, 'shared', TEXT + 'changed')
+    assert redis.get('rvid:%s:delta' % shared) is None
+    for rvid, text in [(first, text), (shared, TEXT)]:
+        tiddler = Tiddler(rvid == first and 'unique' or 'shared', 'first')
+        tiddler.revision = rvid
+        assert plain.get(tiddler).text == text
+
+
+def test_move_bag():
+    config = {'shards': [{'db': 3}, {'db': 4}], 'dedup_text': True}
+    sharded = Store('tiddlywebplugins.redisstore', config, {})
+    shards = sharded.storage.shards
+    for client in shards.clients.values():
+        client.flushdb()
+    sharded.put(Bag('moving'))
+    for index in range(3):
+        _put(sharded, 'moving%s' % index, bag='moving')
+    source = shards.client_for_bag('moving')
+    target_name, target = [(name, client) for name, client
+            in shards.clients.items() if client is not source][0]
+    assert int(source.hget(_text_key(), 'refs')) == 3
+
+    move_bag(sharded.storage, 'moving', target_name, batch_size=2, grace=0)
+    assert not source.exists(_text_key())
+    assert int(target.hget(_text_key(), 'refs')) == 3
+    assert sharded.get(Tiddler('moving1', 'moving')).text == TEXT
+    for client in shards.clients.values():
+        client.flushdb()
@@ -0,0 +1,183 @@
+"""
+Test keeping older revisions as deltas against the next, and reading
+them back.
+"""
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.redisstore.delta import apply_delta, make_delta
+
+LINES = [u'line %s of a long tiddler, with some unicode \u2603\n' % index
+        for index in range(100)]
+BINARY = '\x89PNG\r\n\x1a\n' + '\x00\x01\x02\x03' * 500
+
+
+def setup_module(module):
+    module.plain = Store('tiddlywebplugins.redisstore', {}, {})
+    plain.storage.redis.flushdb()
+    module.store = _store()
+    store.put(Bag('deltas'))
+
+
+def _store(**options):
+    options.setdefault('revision_deltas', True)
+    options.setdefault('delta_keyframe_interval', 4)
+    return Store('tiddlywebplugins.redisstore', options, {})
+
+
+def _text(version):
+    lines = list(LINES)
+    lines[version % len(lines)] = u'changed in version %s\n' % version
+    return u''.join(lines)
+
+
+def _put(store, title, text, tiddler_type=None):
+    tiddler = Tiddler(title, 'deltas')
+    tiddler.text = text
+    tiddler.type = tiddler_type
+    tiddler.modifier = 'cdent'
+    store.put(tiddler)
+    return tiddler.revision
+
+
+def _stored(store, rvid):
+    """
+    The stored text, compression and delta of a revision.
+    """
+    pipe = store.storage.redis.pipeline()
+    reader = store.storage.layout.read_record(pipe, 'rvid', rvid,
+            ['text', 'compression', 'delta'])
+    return reader(iter(pipe.execute()))
+
+
+def _get(store, title, rvid):
+    tiddler = Tiddler(title, 'deltas')
+    tiddler.revision = rvid
+    return store.get(tiddler)
+
+
+def test_make_and_apply():
+    old = _text(1).encode('utf-8')
+    new = _text(2).encode('utf-8')
+    delta = make_delta(old, new)
+    assert len(delta) < len(old) / 10
+    assert apply_delta(delta, new) == old
+    assert apply_delta(make_delta('', new), new) == ''
+    assert apply_delta(make_delta(old, ''), '') == old
+    assert apply_delta(make_delta('no newline', 'no\nnewline'),
+            'no\nnewline') == 'no newline'
+
+
+def test_revisions_readable():
+    revisions = [_put(store, 'history', _text(version))
+            for version in range(10)]
+    for version, rvid in enumerate(revisions):
+        tiddler = _get(store, 'history', rvid)
+        assert tiddler.text == _text(version)
+        assert tiddler.modifier == 'cdent'
+        assert tiddler.creator == 'cdent'
+    assert store.get(Tiddler('history', 'deltas')).text == _text(9)
+
+
+def test_keyframes():
+    revisions = [_put(store, 'keyframes', _text(version))
+            for version in range(10)]
+    deltas = [_stored(store, rvid)[2] for rvid in revisions]
+    # each after three deltas, and the latest, keep their text
+    assert deltas == [str(revisions[1]), str(revisions[2]),
+            str(revisions[3]), None, str(revisions[5]), str(revisions[6]),
+            str(revisions[7]), None, str(revisions[9]), None]
+    assert len(_stored(store, revisions[1])[0]) < len(_text(1)) / 10
+
+
+def test_memory_saved():
+    # the bytes of text stored, as the server's used_memory moves with
+    # much else
+    full = sum(len(_stored(plain, _put(plain, 'full', _text(version)))[0])
+            for version in range(20))
+    revisions = [_put(store, 'delta', _text(version))
+            for version in range(20)]
+    assert sum(len(_stored(store, rvid)[0]) for rvid in revisions) < full / 2
+
+
+def test_compressed_deltas():
+    compressed = _store(compression='zlib', compression_threshold=0)
+    revisions = [_put(compressed, 'compressed', _text(version))
+            for version in range(3)]
+    revisions.append(_put(store, 'compressed', _text(3)))
+    revisions.append(_put(plain, 'compressed', _text(4)))
+    assert [_stored(store, rvid)[1:] for rvid in revisions] == [
+            ['zlib', str(revisions[1])], ['zlib', str(revisions[2])],
+            [None, str(revisions[3])], [None, None], [None, None]]
+    for version, rvid in enumerate(revisions):
+        for reader in [store, compressed, plain]:
+            assert _get(reader, 'compressed', rvid).text == _text(version)
+
+
+def test_binary_not_delta():
+    first = _put(store, 'image', BINARY, 'image/png')
+    _put(store, 'image', BINARY + '\x00', 'image/png')
+    _put(store, 'image', BINARY + '\x01', 'image/png')
+    assert _stored(store, first)[2] is None
+    assert _get(store, 'image', first).text == BINARY
+
+
+def test_binary_and_text_revisions():
+    image = _put(store, 'changing', BINARY, 'image/png')
+    text = _put(store, 'changing', _text(0))
+    assert _stored(store, image)[2] is None
+    assert _get(store, 'changing', image).text == BINARY
+    second_image = _put(store, 'changing', BINARY + '\x00', 'image/png')
+    assert _stored(store, text)[2] is None
+    assert _get(store, 'changing', text).text == _text(0)
+    _put(store, 'changing', _text(1))
+    assert _get(store, 'changing', second_image).text == BINARY + '\x00'
+
+
+def test_other_types_not_delta():
+    first = _put(store, 'typed', _text(0), 'text/x-markdown')
+    _put(store, 'typed', _text(1))
+    assert _stored(store, first)[2] is None
+    assert _get(store, 'typed', first).text == _text(0)
+
+
+def test_different_text_not_delta():
+    first = _put(store, 'different', u'one line')
+    _put(store, 'different', u'another line')
+    _put(store, 'different', u'a third line')
+    assert _stored(store, first)[2] is None
+
+
+def test_plain_revisions_kept():
+    first = _put(plain, 'plain', _text(0))
+    second = _put(plain, 'plain', _text(1))
+    third = _put(store, 'plain', _text(2))
+    assert [_stored(store, rvid)[2] for rvid in [first, second, third]] == [
+            None, str(third), None]
+    assert _get(store, 'plain', first).text == _text(0)
+    assert _get(plain, 'plain', second).text == _text(1)
+
+
+def test_interleaved_puts():
+    interleaved = _store(delta_keyframe_interval=3)
+    scripts = interleaved.storage.redis.scripts
+    revisions = [_put(interleaved, 'interleaved', _text(0))]
+    # each put finds the revision before it, but the rewrites are only
+    # made once all three are stored, as with puts from other processes
+    deferred = []
+    revision_delta = scripts['revision_delta']
+    scripts['revision_delta'] = lambda **kwargs: deferred.append(kwargs)
+    try:
+        for version in range(1, 4):
+            revisions.append(_put(interleaved, 'interleaved', _text(version)))
+    finally:
+        scripts['revision_delta'] = revision_delta
+    assert len(deferred) == 3
+    assert [revision_delta(**kwargs) for kwargs in deferred] == [1, 1, 0]
+    # no run of deltas is longer than the interval allows
+    assert [_stored(interleaved, rvid)[2] for rvid in revisions] == [
+            str(revisions[1]), str(revisions[2]), None, None]
+    for version, rvid in enumerate(revisions):
+        assert _get(interleaved, 'interleaved', rvid).text == _text(version)
@@ -0,0 +1,109 @@
+"""
+Test allocating ids in blocks, keeping the revisions of a tiddler in
+increasing order.
+"""
+
+from multiprocessing import Process, Queue
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.redisstore.ids import IdAllocator
+
+from test.test_roundtrips import CommandCounter
+
+
+def setup_module(module):
+    module.store = _store()
+    module.redis = store.storage.redis
+    redis.flushdb()
+    store.put(Bag('ids'))
+
+
+def _store(**options):
+    options.setdefault('id_block_size', 10)
+    return Store('tiddlywebplugins.redisstore', options, {})
+
+
+def _put(store, title, text='text'):
+    tiddler = Tiddler(title, 'ids')
+    tiddler.text = text
+    store.put(tiddler)
+    return tiddler.revision
+
+
+def test_blocks():
+    for name in ['one', 'two', 'three']:
+        store.put(Bag(name))
+    assert int(redis.get('ids:nextBagID')) == 10
+
+    _put(store, 'first')
+    counter = CommandCounter()
+    counter.start()
+    try:
+        revisions = [_put(store, 'tiddler%s' % index) for index in range(8)]
+    finally:
+        counter.stop()
+    # one round trip for each put, none to allocate ids
+    assert counter.round_trips == 8
+    assert revisions == sorted(set(revisions))
+    assert int(redis.get('ids:nextRevisionID')) == 10
+
+
+def test_updates_take_no_tids():
+    _put(store, 'updated')
+    before = store.storage.allocator.take(['ids:nextTiddlerID'])[0]
+    for index in range(12):
+        _put(store, 'updated', 'text %s' % index)
+    tiddler = Tiddler('created', 'ids')
+    store.put(tiddler)
+    assert int(redis.get('tiddler:ids:created:tid')) == before + 1
+    assert store.get(Tiddler('updated', 'ids')).text == 'text 11'
+
+    # nor with tids allocated on each put
+    single = _store(id_block_size=1)
+    _put(single, 'updated')
+    before = int(redis.get('ids:nextTiddlerID'))
+    _put(single, 'updated')
+    assert int(redis.get('ids:nextTiddlerID')) == before
+
+
+def test_revisions_increase():
+    first = _store()
+    first.storage.allocator = IdAllocator(first.storage.primary, 10)
+    second = _store()
+    second.storage.allocator = IdAllocator(second.storage.primary, 10)
+    # the first process reserves a block, then the second reserves the
+    # next and stores a revision with an id from it
+    _put(first, 'filler')
+    later = _put(second, 'shared', 'second')
+    assert first.storage.allocator.blocks['ids:nextRevisionID'][0] < later
+
+    rvid = _put(first, 'shared', 'first')
+    assert rvid > later
+    assert first.list_tiddler_revisions(Tiddler('shared', 'ids')) == [rvid,
+            later]
+    assert first.get(Tiddler('shared', 'ids')).text == 'first'
+
+
+def test_strict():
+    strict = _store(id_strict=True)
+    before = int(redis.get('ids:nextRevisionID'))
+    revisions = [_put(strict, 'strict%s' % index) for index in range(3)]
+    assert revisions == [before + 1, before + 2, before + 3]
+
+
+def _put_in_child(queue):
+    queue.put(_put(_store(), 'child'))
+
+
+def test_forked_process_reserves_its_own_block():
+    _put(store, 'parent')
+    reserved = store.storage.allocator.blocks['ids:nextRevisionID'][1]
+    queue = Queue()
+    child = Process(target=_put_in_child, args=(queue,))
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+    assert queue.get() > reserved
@@ -0,0 +1,146 @@
+"""
+Test the tag and field indexes and index_query.
+"""
+
+import py.test
+
+from tiddlyweb.config import config
+from tiddlyweb.filters import (FilterIndexRefused, parse_for_filters,
+        recursive_filter)
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.redisstore.manage import reindex
+
+
+def setup_module(module):
+    Store('tiddlywebplugins.redisstore', {}, {}).storage.redis.flushdb()
+    index_config = dict(config)
+    index_config['indexer'] = 'tiddlywebplugins.redisstore'
+    module.environ = {'tiddlyweb.config': index_config}
+    module.store = Store('tiddlywebplugins.redisstore',
+            {'indexed_fields': ['modifier', 'colour']}, environ)
+    environ['tiddlyweb.store'] = module.store
+    module.redis = module.store.storage.redis
+
+    store.put(Bag('fruit'))
+    store.put(Bag('veg'))
+    for bag, title, tags in [
+            ('fruit', 'apple', ['red', 'round']),
+            ('fruit', 'banana', ['yellow']),
+            ('fruit', 'cherry', ['red', 'round', 'small']),
+            ('veg', 'tomato', ['red', 'round']),
+            ('veg', 'pea', ['green', 'round', 'small'])]:
+        tiddler = Tiddler(title, bag)
+        tiddler.tags = tags
+        tiddler.modifier = bag == 'fruit' and 'cdent' or 'fnd'
+        tiddler.fields['colour'] = tags[0]
+        store.put(tiddler)
+
+
+def _recheck():
+    """
+    Have the schema and indexes of the database read again, by making a
+    store which checks them at once: stores using the same database
+    share what they last read.
+    """
+    Store('tiddlywebplugins.redisstore', {'schema_check_interval': 0}, {})
+
+
+def _titles(tiddlers):
+    return sorted(tiddler.title for tiddler in tiddlers)
+
+
+def _select(bag, filter_string):
+    filters, _ = parse_for_filters(filter_string, environ)
+    return recursive_filter(filters, store.list_bag_tiddlers(bag),
+            indexable=bag)
+
+
+def test_index_query():
+    assert _titles(store.storage.index_query(tag='red', bag='fruit')) == [
+            'apple', 'cherry']
+    assert _titles(store.storage.index_query(tag='red')) == [
+            'apple', 'cherry', 'tomato']
+    assert _titles(store.storage.index_query(tag='small', bag='veg')) == [
+            'pea']
+    assert _titles(store.storage.index_query(tag='blue', bag='veg')) == []
+    tiddlers = list(store.storage.index_query(id='veg:pea'))
+    assert [(tiddler.bag, tiddler.title) for tiddler in tiddlers] == [
+            ('veg', 'pea')]
+    assert list(store.storage.index_query(id='veg:apple')) == []
+
+    py.test.raises(FilterIndexRefused,
+            "store.storage.index_query(title='pea', bag='veg')")
+
+
+def test_select_uses_index():
+    tiddlers = list(_select(Bag('fruit'), 'select=tag:round'))
+    assert _titles(tiddlers) == ['apple', 'cherry']
+    # index_query loads the tiddlers
+    assert tiddlers[0].tags
+
+    # no index for this, the filter falls back to looking at each
+    assert _titles(_select(Bag('fruit'), 'select=title:banana')) == [
+            'banana']
+
+
+def test_field_index():
+    assert _titles(store.storage.index_query(modifier='cdent',
+        bag='fruit')) == ['apple', 'banana', 'cherry']
+    assert _titles(store.storage.index_query(colour='red', bag='fruit')) == [
+            'apple', 'cherry']
+    assert _titles(store.storage.index_query(colour='red', tag='small',
+        bag='fruit')) == ['cherry']
+    assert _titles(_select(Bag('veg'), 'select=colour:green')) == ['pea']
+
+    tiddler = store.get(Tiddler('apple', 'fruit'))
+    tiddler.fields['colour'] = 'green'
+    tiddler.modifier = 'fnd'
+    store.put(tiddler)
+    assert _titles(store.storage.index_query(colour='red', bag='fruit')) == [
+            'cherry']
+    assert _titles(store.storage.index_query(modifier='fnd',
+        bag='fruit')) == ['apple']
+
+    # field indexes are per bag
+    py.test.raises(FilterIndexRefused,
+            "store.storage.index_query(colour='red')")
+
+
+def test_index_follows_changes():
+    tiddler = store.get(Tiddler('cherry', 'fruit'))
+    tiddler.tags = ['black', 'round']
+    store.put(tiddler)
+
+    assert _titles(store.storage.index_query(tag='red', bag='fruit')) == [
+            'apple']
+    assert _titles(store.storage.index_query(tag='black')) == ['cherry']
+
+    store.delete(tiddler)
+    assert _titles(store.storage.index_query(tag='black')) == []
+    assert _titles(store.storage.index_query(tag='round', bag='fruit')) == [
+            'apple']
+
+
+def test_index_cleared_on_bag_delete():
+    store.delete(Bag('veg'))
+    assert _titles(store.storage.index_query(tag='round')) == ['apple']
+    assert not redis.keys('tags:green:*')
+    assert not redis.keys('bid:2:*')
+
+
+def test_reindex():
+    redis.delete('indexes:built')
+    redis.delete('tags:yellow:tids')
+    _recheck()
+    py.test.raises(FilterIndexRefused,
+            "store.storage.index_query(tag='yellow')")
+
+    redis.delete(*redis.keys('bid:*:field:colour:*'))
+    reindex(store.storage)
+    _recheck()
+    assert _titles(store.storage.index_query(tag='yellow')) == ['banana']
+    assert _titles(store.storage.index_query(colour='green',
+        bag='fruit')) == ['apple']
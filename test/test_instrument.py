@@ -0,0 +1,133 @@
+"""
+Test the counting of redis commands and round trips per Store method,
+and the middleware reporting them.
+"""
+
+import logging
+import threading
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.redisstore.instrument import (ENVIRON_KEY, LOGGER,
+        RedisStats, Stats)
+
+from test.test_roundtrips import CommandCounter
+
+
+def setup_module(module):
+    Store('tiddlywebplugins.redisstore', {}, {}).storage.redis.flushdb()
+
+
+def _store(environ):
+    return Store('tiddlywebplugins.redisstore', {}, environ)
+
+
+def test_stats_per_method():
+    environ = {'tiddlyweb.config': config}
+    store = _store(environ)
+    store.put(Bag('counted'))
+    for title in ['one', 'two', 'three']:
+        store.put(Tiddler(title, 'counted'))
+    store.get(Tiddler('one', 'counted'))
+    titles = [tiddler.title for tiddler in
+            store.list_bag_tiddlers(Bag('counted'))]
+    assert len(titles) == 3
+
+    operations = environ[ENVIRON_KEY].operations
+    assert operations['tiddler_put']['calls'] == 3
+    assert operations['tiddler_put']['round_trips'] >= 3
+    assert operations['tiddler_get']['calls'] == 1
+    assert operations['tiddler_get']['round_trips'] == 3
+    assert operations['tiddler_get']['commands'] > 3
+    assert operations['list_bag_tiddlers']['round_trips'] == 3
+    assert operations['tiddler_get']['redis_time'] > 0
+    assert (operations['tiddler_get']['time']
+            >= operations['tiddler_get']['redis_time'])
+
+    # the same environ, the same stats
+    _store(environ).get(Tiddler('two', 'counted'))
+    assert operations['tiddler_get']['calls'] == 2
+    assert environ[ENVIRON_KEY].summary()['calls'] == 7
+
+
+def test_watched_commands_counted():
+    for db in [3, 4]:
+        Store('tiddlywebplugins.redisstore', {'db': db},
+                {}).storage.primary.flushdb()
+    environ = {'tiddlyweb.config': config}
+    store = Store('tiddlywebplugins.redisstore',
+            {'shards': [{'db': 3}, {'db': 4}]}, environ)
+    counter = CommandCounter()
+    counter.start()
+    try:
+        # writes to a bag on a shard WATCH its moved key and check it
+        store.put(Bag('sharded'))
+        store.put(Tiddler('one', 'sharded'))
+        store.delete(Tiddler('one', 'sharded'))
+    finally:
+        counter.stop()
+    totals = environ[ENVIRON_KEY].summary()
+    assert totals['calls'] == 3
+    assert totals['round_trips'] == counter.round_trips
+    for db in [3, 4]:
+        Store('tiddlywebplugins.redisstore', {'db': db},
+                {}).storage.primary.flushdb()
+
+
+def test_counts_from_threads():
+    stats = Stats()
+    counts = stats.operation('tiddler_get')
+
+    def add():
+        for _ in range(10000):
+            stats.add(counts, calls=1, round_trips=2)
+
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stats.summary()['calls'] == 80000
+    assert counts['round_trips'] == 160000
+
+
+class Recorder(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_middleware():
+    def application(environ, start_response):
+        store = _store(environ)
+        tiddler = store.get(Tiddler('one', 'counted'))
+        start_response('200 OK', [])
+        return [tiddler.title]
+
+    recorder = Recorder()
+    LOGGER.addHandler(recorder)
+    LOGGER.setLevel(logging.INFO)
+    try:
+        slow_config = dict(config)
+        slow_config['redisstore.slow_threshold'] = 0
+        environ = {'REQUEST_METHOD': 'GET',
+                'PATH_INFO': '/bags/counted/tiddlers/one',
+                'tiddlyweb.config': slow_config}
+        output = list(RedisStats(application)(environ,
+            lambda status, headers: None))
+    finally:
+        LOGGER.removeHandler(recorder)
+
+    assert output == ['one']
+    assert recorder.messages[0].startswith(
+            'GET /bags/counted/tiddlers/one: 1 store calls, ')
+    assert ' commands, 3 round trips, ' in recorder.messages[0]
+    assert recorder.messages[1].startswith(
+            'slow tiddler_get in GET /bags/counted/tiddlers/one: 1 calls')
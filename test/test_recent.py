@@ -0,0 +1,276 @@
+"""
+Test the recent index of each bag, listing the most recently modified
+tiddlers of bags and recipes, and the sort filter which uses it.
+"""
+
+import json
+
+import py.test
+
+from tiddlyweb.config import config
+from tiddlyweb.control import determine_bag_from_recipe, filter_tiddlers
+from tiddlyweb.filters import (FILTER_PARSERS, FilterIndexRefused,
+        parse_for_filters, recursive_filter)
+from tiddlyweb.filters.sort import sort_parse
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import NoBagError, Store
+from tiddlyweb.web.handler.bag import get_tiddlers
+
+from tiddlywebplugins import redisstore
+from tiddlywebplugins.redisstore.manage import reindex
+
+from test.test_roundtrips import CommandCounter
+
+
+def setup_module(module):
+    Store('tiddlywebplugins.redisstore', {}, {}).storage.redis.flushdb()
+    redisstore.init(config)
+    index_config = dict(config)
+    index_config['indexer'] = 'tiddlywebplugins.redisstore'
+    module.environ = {'tiddlyweb.config': index_config}
+    module.store = Store('tiddlywebplugins.redisstore', {'scan_count': 4},
+            environ)
+    environ['tiddlyweb.store'] = module.store
+    module.redis = module.store.storage.redis
+
+    for name in ['system', 'content', 'empty']:
+        store.put(Bag(name))
+    for index in range(20):
+        _put('system', 'system%02d' % index, '201001%02d000000' % (index + 1))
+        _put('content', 'content%02d' % index, '2011%02d01%02d'
+                % (index % 12 + 1, index))
+    # the same title in both, the one in content hiding that in system
+    _put('system', 'shared', '20150101000000')
+    _put('content', 'shared', '20090101000000')
+
+
+def teardown_module(module):
+    FILTER_PARSERS['sort'] = sort_parse
+
+
+def _put(bag, title, modified):
+    tiddler = Tiddler(title, bag)
+    tiddler.text = title
+    tiddler.modified = modified
+    store.put(tiddler)
+
+
+def _pairs(tiddlers):
+    return [(tiddler.bag, tiddler.title) for tiddler in tiddlers]
+
+
+def _sorted(bag):
+    """
+    The tiddlers of the bag as TiddlyWeb sorts them itself.
+    """
+    tiddlers = [store.get(tiddler) for tiddler in
+            store.list_bag_tiddlers(Bag(bag))]
+    return _pairs(sorted(tiddlers, key=lambda tiddler:
+        tiddler.modified.ljust(14, '0'), reverse=True))
+
+
+def _recheck():
+    """
+    Have the indexes of the database read again, by making a store
+    which checks them at once.
+    """
+    Store('tiddlywebplugins.redisstore', {'schema_check_interval': 0}, {})
+
+
+def _round_trips(func):
+    counter = CommandCounter()
+    counter.start()
+    try:
+        func()
+    finally:
+        counter.stop()
+    return counter.round_trips
+
+
+def _filter(bag, filter_string):
+    filters, _ = parse_for_filters(filter_string, environ)
+    return recursive_filter(filters, store.list_bag_tiddlers(Bag(bag)),
+            indexable=Bag(bag))
+
+
+def test_recent_order():
+    assert _pairs(store.storage.recent_tiddlers(['system'])) == _sorted(
+            'system')
+    assert _pairs(store.storage.recent_tiddlers(['content'])) == _sorted(
+            'content')
+    assert list(store.storage.recent_tiddlers(['empty'])) == []
+    py.test.raises(NoBagError,
+            "list(store.storage.recent_tiddlers(['missing']))")
+
+
+def test_start_and_count():
+    everything = _sorted('content')
+    assert _pairs(store.storage.recent_tiddlers(['content'], 5)) == (
+            everything[:5])
+    assert _pairs(store.storage.recent_tiddlers(['content'], 6, 3)) == (
+            everything[3:9])
+    assert _pairs(store.storage.recent_tiddlers(['content'], start=18)) == (
+            everything[18:])
+    assert list(store.storage.recent_tiddlers(['content'], 0)) == []
+
+
+def test_merge_hides_earlier_bags():
+    merged = _pairs(store.storage.recent_tiddlers(['system', 'content']))
+    expected = [pair for pair in _sorted('content') + _sorted('system')
+            if pair != ('system', 'shared')]
+    modified = dict((pair, store.get(Tiddler(pair[1], pair[0])).modified)
+            for pair in expected)
+    assert merged == sorted(expected, key=lambda pair: modified[pair],
+            reverse=True)
+    assert ('content', 'shared') in merged
+    assert _pairs(store.storage.recent_tiddlers(['content', 'system'],
+        1)) == [('system', 'shared')]
+
+
+def test_recipe():
+    recipe = Recipe('site')
+    recipe.set_recipe([('system', ''), ('content', '')])
+    store.put(recipe)
+    assert _pairs(store.storage.recent_recipe_tiddlers(recipe, 3)) == _pairs(
+            store.storage.recent_tiddlers(['system', 'content'], 3))
+
+    recipe.set_recipe([('system', ''), ('content', 'select=tag:public')])
+    store.put(recipe)
+    py.test.raises(FilterIndexRefused,
+            'store.storage.recent_recipe_tiddlers(recipe)')
+
+
+def test_updates_and_deletes():
+    _put('content', 'content00', '20200101000000')
+    assert _pairs(store.storage.recent_tiddlers(['content'], 1)) == [
+            ('content', 'content00')]
+    store.delete(Tiddler('content00', 'content'))
+    assert ('content', 'content00') not in _pairs(
+            store.storage.recent_tiddlers(['content']))
+    assert _pairs(store.storage.recent_tiddlers(['content'])) == _sorted(
+            'content')
+
+
+def test_sort_filter_uses_index():
+    tiddlers = list(_filter('system', 'sort=-modified;limit=3'))
+    assert _pairs(tiddlers) == _sorted('system')[:3]
+    # the tiddlers are loaded
+    assert tiddlers[0].text == tiddlers[0].title
+
+    recent = _round_trips(lambda: list(store.storage.recent_tiddlers(
+        ['system'], 3)))
+    # the bid, the first window and the titles
+    assert recent == 3
+    gets = _round_trips(lambda: [store.get(tiddler) for tiddler in tiddlers])
+    # without listing the bag
+    assert _round_trips(lambda: list(_filter('system',
+        'sort=-modified;limit=3'))) == recent + gets
+
+    # other sorts and those not first are done by TiddlyWeb
+    assert [tiddler.title for tiddler in _filter('system',
+        'sort=title;limit=2')] == ['shared', 'system00']
+    assert _pairs(_filter('system', 'select=title:!shared;sort=-modified;'
+        'limit=1')) == [('system', 'system19')]
+
+
+def test_refused_until_reindexed():
+    store.put(Bag('old'))
+    _put('old', 'first', '20120101000000')
+    _put('old', 'second', '20130101000000')
+    redis.srem('indexes:built', 'recent')
+    redis.delete('bid:%s:recent' % redis.get('bag:old:bid'))
+    _recheck()
+    py.test.raises(FilterIndexRefused,
+            "store.storage.recent_tiddlers(['old'])")
+    # the filter falls back to sorting
+    assert _pairs(_filter('old', 'sort=-modified')) == [('old', 'second'),
+            ('old', 'first')]
+
+    reindex(store.storage)
+    _recheck()
+    assert _pairs(store.storage.recent_tiddlers(['old'])) == [
+            ('old', 'second'), ('old', 'first')]
+
+
+def test_delete_bag():
+    bid = redis.get('bag:old:bid')
+    store.delete(Bag('old'))
+    assert not redis.exists('bid:%s:recent' % bid)
+
+
+def _recorded_sort_parse(sorted_by):
+    """
+    A sort parser, as another plugin might install, which sorts as
+    TiddlyWeb does and records the attributes it sorts by.
+    """
+    def parse(attribute):
+        sorter = sort_parse(attribute)
+
+        def recorded_sorter(entities, indexable=False, environ=None):
+            sorted_by.append(attribute)
+            return sorter(entities, indexable, environ)
+        return recorded_sorter
+    return parse
+
+
+def test_sort_parser_wraps_previous():
+    original = FILTER_PARSERS['sort']
+    sorted_by = []
+    FILTER_PARSERS['sort'] = _recorded_sort_parse(sorted_by)
+    try:
+        redisstore.init(config)
+        wrapped = FILTER_PARSERS['sort']
+        redisstore.init(config)
+        assert FILTER_PARSERS['sort'] is wrapped
+
+        assert [tiddler.title for tiddler in _filter('system',
+            'sort=title;limit=2')] == ['shared', 'system00']
+        assert sorted_by == ['title']
+        assert _pairs(_filter('system', 'sort=-modified;limit=3')) == (
+                _sorted('system')[:3])
+        assert sorted_by == ['title']
+        # without a bag to read the index of, the previous parser sorts
+        tiddlers = filter_tiddlers(store.list_bag_tiddlers(Bag('system')),
+                'sort=-modified;limit=3', environ)
+        assert _pairs(tiddlers) == _sorted('system')[:3]
+        assert sorted_by == ['title', '-modified']
+    finally:
+        FILTER_PARSERS['sort'] = original
+
+
+def test_recipe_lookup_uses_index():
+    recipe = Recipe('lookup')
+    recipe.set_recipe([('system', 'sort=-modified;limit=3'),
+        ('content', 'sort=-modified;limit=1')])
+    recipe.store = store
+    system = [title for _, title in _sorted('system')]
+    content = [title for _, title in _sorted('content')]
+    # only the latest of content, and of system the latest three
+    assert determine_bag_from_recipe(recipe, Tiddler(content[0]),
+            environ).name == 'content'
+    assert determine_bag_from_recipe(recipe, Tiddler(system[2]),
+            environ).name == 'system'
+    py.test.raises(NoBagError, 'determine_bag_from_recipe(recipe, '
+            'Tiddler(content[1]), environ)')
+
+    # each bag is read from the index, loading only what the limit
+    # keeps, where sorting would load every tiddler of both
+    gets = _round_trips(lambda: store.get(Tiddler(system[0], 'system')))
+    assert _round_trips(lambda: determine_bag_from_recipe(recipe,
+        Tiddler(system[2]), environ)) <= 2 * (3 + 4 * gets)
+
+
+def test_web_bag_tiddlers_sorted():
+    web_environ = dict(environ)
+    web_environ.update({'wsgiorg.routing_args': ((), {'bag_name': 'system'}),
+        'tiddlyweb.query': {}, 'tiddlyweb.type': ['application/json'],
+        'tiddlyweb.usersign': {'name': 'GUEST', 'roles': []},
+        'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'HTTP_HOST': 'test'})
+    web_environ['tiddlyweb.filters'], _ = parse_for_filters(
+            'sort=-modified;limit=3', web_environ)
+    output = ''.join(get_tiddlers(web_environ, lambda status, headers: None))
+    # the listed tiddlers are sorted by TiddlyWeb, not from the index
+    assert [('system', tiddler['title']) for tiddler in
+            json.loads(output)] == _sorted('system')[:3]
@@ -0,0 +1,95 @@
+"""
+Test sending reads to replicas. Databases 1 and 2 of the test server
+stand in for replicas of database 0, so that what is read shows where
+it was read from.
+"""
+
+import time
+
+import py.test
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import NoBagError, NoTiddlerError, Store
+
+from tiddlywebplugins.redisstore.replica import ENVIRON_KEY
+
+
+def setup_module(module):
+    for db in [0, 1, 2]:
+        _store({'db': db}).storage.primary.flushdb()
+    _store({'db': 0}).put(Bag('primary'))
+    _store({'db': 1}).put(Bag('replica1'))
+    _store({'db': 2}).put(Bag('replica2'))
+
+
+def _store(store_config, environ=None):
+    if environ is None:
+        environ = {}
+    return Store('tiddlywebplugins.redisstore', store_config, environ)
+
+
+def _bags(store):
+    return [bag.name for bag in store.list_bags()]
+
+
+def test_reads_from_replica():
+    store = _store({'replicas': [{'db': 1}]})
+    assert _bags(store) == ['replica1']
+    store.get(Bag('replica1'))
+    py.test.raises(NoBagError, 'store.get(Bag("primary"))')
+    assert store.storage.redis is store.storage.primary
+
+
+def test_read_your_writes():
+    environ = {}
+    store = _store({'replicas': [{'db': 1}]}, environ)
+    tiddler = Tiddler('written', 'primary')
+    tiddler.text = 'hello'
+    store.put(tiddler)
+    assert environ[ENVIRON_KEY] <= time.time()
+    assert store.get(Tiddler('written', 'primary')).text == 'hello'
+    assert _bags(store) == ['primary']
+
+    # another request reads from the replica
+    py.test.raises(NoTiddlerError, '_store({"replicas": [{"db": 1}]}).get('
+            'Tiddler("written", "primary"))')
+
+    # and so does this one once the window has passed
+    store = _store({'replicas': [{'db': 1}], 'read_your_writes': 0},
+            environ)
+    assert _bags(store) == ['replica1']
+
+
+def test_round_robin():
+    store = _store({'replicas': [{'db': 1}, {'db': 2}]})
+    seen = [_bags(store)[0] for _ in range(4)]
+    assert sorted(seen) == ['replica1', 'replica1', 'replica2', 'replica2']
+    assert seen[0] != seen[1]
+
+
+def test_latency():
+    store = _store({'replicas': [{'db': 1}, {'db': 2}],
+        'replica_selection': 'latency'})
+    replicas = store.storage.replicas
+    _bags(store)
+    replicas.latencies = [0.01, 0.001]
+    assert [_bags(store)[0] for _ in range(3)] == ['replica2'] * 3
+
+
+def test_unhealthy_replicas():
+    store = _store({'replicas': [{'port': 1}, {'db': 2}]})
+    assert [_bags(store)[0] for _ in range(3)] == ['replica2'] * 3
+    assert store.storage.replicas.latencies[0] is None
+
+    store = _store({'replicas': [{'port': 1}]})
+    assert _bags(store) == ['primary']
+
+
+def test_failed_replica():
+    store = _store({'replicas': [{'port': 1}], 'replica_check_interval': 60})
+    replicas = store.storage.replicas
+    replicas.latencies = [0.001]
+    replicas.checked = time.time()
+    store.get(Bag('primary'))
+    assert replicas.latencies == [None]
@@ -0,0 +1,147 @@
+"""
+Test trimming the revisions of tiddlers to those the retention options
+keep, as tiddlers are put and with prune.
+"""
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+from tiddlywebplugins.redisstore.manage import prune
+
+OLD = '20100101000000'
+# a bag whose name is not ASCII
+UNICODE = u'mallonga\u0109'
+
+
+def setup_module(module):
+    module.plain = Store('tiddlywebplugins.redisstore', {}, {})
+    module.redis = plain.storage.redis
+    redis.flushdb()
+    for name in ['kept', 'short', UNICODE]:
+        plain.put(Bag(name))
+
+
+def _store(**options):
+    return Store('tiddlywebplugins.redisstore', options, {})
+
+
+def _put(store, title, count, modified=None, bag='kept'):
+    revisions = []
+    for index in range(count):
+        tiddler = Tiddler(title, bag)
+        tiddler.text = 'version %s' % index
+        tiddler.modifier = 'editor%s' % index
+        tiddler.modified = modified
+        store.put(tiddler)
+        revisions.append(tiddler.revision)
+    return revisions
+
+
+def _revisions(title, bag='kept'):
+    return plain.list_tiddler_revisions(Tiddler(title, bag))
+
+
+def test_keep_latest():
+    store = _store(retain_revisions=3)
+    revisions = _put(store, 'latest', 10)
+    assert _revisions('latest') == revisions[:-4:-1]
+    assert not redis.keys('rvid:%s:*' % revisions[0])
+
+    tiddler = plain.get(Tiddler('latest', 'kept'))
+    assert tiddler.text == 'version 9'
+    assert tiddler.creator == 'editor0'
+    assert tiddler.created
+    assert tiddler.modifier == 'editor9'
+    old = Tiddler('latest', 'kept')
+    old.revision = revisions[7]
+    assert plain.get(old).text == 'version 7'
+
+
+def test_amortized():
+    revisions = _put(plain, 'amortized', 10)
+    store = _store(retain_revisions=2, retention_trim_size=3)
+    latest = _put(store, 'amortized', 1)
+    # only the oldest three, of the nine past the two kept, are trimmed
+    assert _revisions('amortized') == latest + revisions[:2:-1]
+    _put(store, 'amortized', 1)
+    assert len(_revisions('amortized')) == 6
+    _put(store, 'amortized', 3)
+    assert len(_revisions('amortized')) == 2
+    assert plain.get(Tiddler('amortized', 'kept')).creator == 'editor0'
+
+
+def test_keep_recent():
+    revisions = _put(plain, 'recent', 4, OLD)
+    revisions.extend(_put(plain, 'recent', 2))
+    store = _store(retain_seconds=3600)
+    revisions.extend(_put(store, 'recent', 1))
+    assert _revisions('recent') == revisions[:3:-1]
+
+
+def test_keep_either():
+    revisions = _put(plain, 'either', 6, OLD)
+    store = _store(retain_revisions=2, retain_seconds=3600)
+    revisions.extend(_put(store, 'either', 2))
+    # the latest two, and nothing older is recent
+    assert _revisions('either') == revisions[:-3:-1]
+
+    revisions = _put(plain, 'recent either', 6)
+    revisions.extend(_put(store, 'recent either', 2))
+    assert _revisions('recent either') == revisions[::-1]
+
+
+def test_latest_always_kept():
+    store = _store(retain_seconds=3600)
+    revisions = _put(store, 'old', 3, OLD)
+    assert _revisions('old') == revisions[-1:]
+
+
+def test_bag_retention():
+    store = _store(retain_revisions=5,
+            bag_retention={'short': {'revisions': 1}})
+    _put(store, 'bagged', 7)
+    _put(store, 'bagged', 7, bag='short')
+    assert len(_revisions('bagged')) == 5
+    assert len(_revisions('bagged', 'short')) == 1
+
+
+def test_prune():
+    _put(plain, 'pruned', 6)
+    _put(plain, 'pruned', 6, bag='short')
+    _put(plain, 'pruned', 6, bag=UNICODE)
+    store = _store(retain_revisions=4, retention_trim_size=0,
+            bag_retention={'short': {'revisions': 2},
+                UNICODE: {'revisions': 3}})
+    _put(store, 'pruned', 1)
+    assert len(_revisions('pruned')) == 7
+    prune(store.storage, batch_size=1)
+    assert len(_revisions('pruned')) == 4
+    assert len(_revisions('pruned', 'short')) == 2
+    assert len(_revisions('pruned', UNICODE)) == 3
+    assert plain.get(Tiddler('pruned', 'short')).creator == 'editor0'
+
+
+def test_deltas():
+    store = _store(retain_revisions=4, revision_deltas=True,
+            delta_keyframe_interval=3)
+    lines = ['line %s\n' % index for index in range(50)]
+    revisions = []
+    for version in range(12):
+        tiddler = Tiddler('deltas', 'kept')
+        tiddler.text = ''.join(lines) + 'version %s' % version
+        store.put(tiddler)
+        revisions.append(tiddler.revision)
+    for version, rvid in enumerate(revisions[-4:]):
+        tiddler = Tiddler('deltas', 'kept')
+        tiddler.revision = rvid
+        assert store.get(tiddler).text.endswith('version %s' % (version + 8))
+
+
+def test_delete_trimmed():
+    store = _store(retain_revisions=2)
+    _put(store, 'deleted', 4)
+    tid = redis.get('tiddler:kept:deleted:tid')
+    assert redis.get('tid:%s:creator' % tid) == 'editor0'
+    plain.delete(Tiddler('deleted', 'kept'))
+    assert not redis.keys('tid:%s*' % tid)
@@ -0,0 +1,98 @@
+"""
+Test listing the revisions of a tiddler a window at a time, and
+counting them.
+"""
+
+import py.test
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import NoTiddlerError, Store
+
+from test.test_roundtrips import CommandCounter
+
+
+def setup_module(module):
+    module.store = Store('tiddlywebplugins.redisstore', {'scan_count': 10},
+            {})
+    store.storage.redis.flushdb()
+    store.put(Bag('history'))
+    module.rvids = []
+    for index in range(25):
+        tiddler = Tiddler('long', 'history')
+        tiddler.text = 'version %s' % index
+        store.put(tiddler)
+        rvids.insert(0, tiddler.revision)
+
+
+def _counted(func, *args):
+    counter = CommandCounter()
+    counter.start()
+    try:
+        result = func(*args)
+    finally:
+        counter.stop()
+    return result, counter.round_trips
+
+
+def test_newest_first():
+    revisions = store.list_tiddler_revisions(Tiddler('long', 'history'))
+    assert len(revisions) == 25
+    assert revisions == rvids
+    assert list(reversed(revisions)) == rvids[::-1]
+    assert revisions[0] == rvids[0]
+    assert revisions[-1] == rvids[-1]
+    assert revisions[5:15] == rvids[5:15]
+    assert revisions[20:40] == rvids[20:40]
+    assert revisions[::7] == rvids[::7]
+    assert revisions[15:5:-3] == rvids[15:5:-3]
+    assert revisions[30:] == []
+    py.test.raises(IndexError, 'revisions[25]')
+
+
+def test_windows():
+    revisions, round_trips = _counted(store.list_tiddler_revisions,
+            Tiddler('long', 'history'))
+    assert round_trips <= 2
+    assert _counted(lambda: revisions[0]) == (rvids[0], 1)
+    assert _counted(lambda: revisions[10:20]) == (rvids[10:20], 1)
+    # three windows of scan_count
+    assert _counted(list, revisions) == (rvids, 3)
+    assert _counted(lambda: list(reversed(revisions))) == (rvids[::-1], 3)
+
+
+def test_count():
+    assert store.storage.count_tiddler_revisions(
+            Tiddler('long', 'history')) == 25
+    py.test.raises(NoTiddlerError,
+            'store.storage.count_tiddler_revisions('
+            'Tiddler("missing", "history"))')
+
+
+def test_trimmed_while_listed():
+    tiddler = Tiddler('trimmed', 'history')
+    for index in range(15):
+        store.put(tiddler)
+    revisions = store.list_tiddler_revisions(tiddler)
+    trimming = Store('tiddlywebplugins.redisstore', {'retain_revisions': 5,
+        'retention_trim_size': 20}, {})
+    trimming.put(tiddler)
+    assert len(list(revisions)) == 5
+    assert revisions[0] == tiddler.revision
+
+
+def test_on_shard():
+    sharded = Store('tiddlywebplugins.redisstore', {'scan_count': 2,
+        'shards': [{'db': 3}, {'db': 4}]}, {})
+    for client in sharded.storage.shards.clients.values():
+        client.flushdb()
+    sharded.put(Bag('sharded'))
+    tiddler = Tiddler('sharded', 'sharded')
+    put = []
+    for index in range(5):
+        sharded.put(tiddler)
+        put.insert(0, tiddler.revision)
+    # read from the shard after the listing has returned
+    assert sharded.list_tiddler_revisions(tiddler) == put
+    for client in sharded.storage.shards.clients.values():
+        client.flushdb()
@@ -0,0 +1,151 @@
+"""
+Count the commands and round trips the store sends to redis, to keep
+the cost of the common operations from creeping up.
+"""
+
+from redis.connection import Connection
+
+from tiddlywebplugins.utils import get_store
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+
+
+class CommandCounter(object):
+    """
+    Wrap the redis Connection to count commands packed and the
+    number of times they are sent, which is the number of round trips.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        self.pack_command = Connection.pack_command
+        self.send_packed_command = Connection.send_packed_command
+
+    def start(self):
+        counter = self
+
+        def pack_command(connection, *args):
+            counter.commands += 1
+            return counter.pack_command(connection, *args)
+
+        def send_packed_command(connection, command):
+            counter.round_trips += 1
+            return counter.send_packed_command(connection, command)
+
+        Connection.pack_command = pack_command
+        Connection.send_packed_command = send_packed_command
+
+    def stop(self):
+        Connection.pack_command = self.pack_command
+        Connection.send_packed_command = self.send_packed_command
+
+
+def setup_module(module):
+    module.store = get_store(config)
+    store.storage.redis.flushdb()
+    store.put(Bag('counted'))
+
+
+def _make_tiddler(title):
+    tiddler = Tiddler(title, 'counted')
+    tiddler.text = 'some text'
+    tiddler.tags = ['one', 'two', 'three']
+    tiddler.fields['alpha'] = 'one'
+    tiddler.fields['beta'] = 'two'
+    tiddler.modifier = 'cdent'
+    return tiddler
+
+
+def test_tiddler_put_round_trips():
+    # make sure the script is loaded on the server
+    store.put(_make_tiddler('warmup'))
+
+    counter = CommandCounter()
+    counter.start()
+    try:
+        store.put(_make_tiddler('new'))
+        store.put(_make_tiddler('new'))
+    finally:
+        counter.stop()
+
+    assert counter.commands == 2
+    assert counter.round_trips == 2
+
+    revisions = store.list_tiddler_revisions(Tiddler('new', 'counted'))
+    assert len(revisions) == 2
+
+
+def test_tiddler_get_round_trips():
+    store.put(_make_tiddler('got'))
+    store.put(_make_tiddler('got'))
+
+    counter = CommandCounter()
+    counter.start()
+    try:
+        tiddler = store.get(Tiddler('got', 'counted'))
+    finally:
+        counter.stop()
+
+    # one to find the tid, two for the revisions and their attributes
+    assert counter.round_trips == 3
+    assert tiddler.text == 'some text'
+    assert sorted(tiddler.tags) == ['one', 'three', 'two']
+    assert tiddler.fields['beta'] == 'two'
+    assert tiddler.creator == 'cdent'
+
+
+def test_list_bag_tiddlers_streams():
+    store.put(Bag('large'))
+    for index in range(600):
+        store.put(Tiddler('tiddler%s' % index, 'large'))
+
+    counter = CommandCounter()
+    counter.start()
+    try:
+        tiddlers = store.list_bag_tiddlers(Bag('large'))
+        tiddlers.next()
+        # the bid, the first chunk of tids and their titles
+        assert counter.round_trips == 3
+        titles = set(tiddler.title for tiddler in tiddlers)
+    finally:
+        counter.stop()
+
+    assert len(titles) == 599
+    assert counter.round_trips > 3
+
+
+def test_delete_round_trips():
+    store.put(Bag('doomed'))
+    for index in range(250):
+        store.put(_make_tiddler('tiddler%s' % index))
+        tiddler = Tiddler('tiddler%s' % index, 'doomed')
+        tiddler.tags = ['doomed']
+        store.put(tiddler)
+    # make sure the scripts are loaded on the server
+    store.delete(Tiddler('tiddler0', 'doomed'))
+    store.put(Tiddler('tiddler0', 'doomed'))
+    store.put(Bag('empty'))
+    store.delete(Bag('empty'))
+
+    counter = CommandCounter()
+    counter.start()
+    try:
+        store.delete(Tiddler('tiddler0', 'doomed'))
+    finally:
+        counter.stop()
+    assert counter.round_trips == 1
+
+    counter = CommandCounter()
+    counter.start()
+    try:
+        store.delete(Bag('doomed'))
+    finally:
+        counter.stop()
+
+    # the bid, three chunks of tiddlers, the policy id and the bag
+    assert counter.round_trips == 6
+    redis = store.storage.redis
+    assert redis.keys('*doomed*') == []
+    assert len(list(store.list_bag_tiddlers(Bag('counted')))) == 253
@@ -0,0 +1,167 @@
+"""
+Test the schema 2 layout and migrating to it from schema 1.
+"""
+
+import py.test
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.user import User
+from tiddlyweb.store import Store, NoTiddlerError
+
+from tiddlywebplugins.redisstore.manage import migrate
+
+
+def _fresh_store(store_config=None):
+    """
+    Get a store which checks the schema of the database now.
+    """
+    store_config = dict(store_config or {})
+    store_config['schema_check_interval'] = 0
+    return Store('tiddlywebplugins.redisstore', store_config,
+            {'tiddlyweb.config': config})
+
+
+def setup_module(module):
+    store = _fresh_store()
+    store.storage.redis.flushdb()
+    module.redis = store.storage.redis
+
+
+def teardown_module(module):
+    redis.flushdb()
+
+
+def _put_entities(store, name):
+    bag = Bag(name)
+    bag.desc = 'the %s bag' % name
+    bag.policy.read = ['cdent']
+    store.put(bag)
+
+    recipe = Recipe(name)
+    recipe.desc = 'the %s recipe' % name
+    recipe.set_recipe([(name, '')])
+    store.put(recipe)
+
+    user = User(name)
+    user.set_password('secret')
+    user.add_role('ADMIN')
+    store.put(user)
+
+    tiddler = Tiddler('tiddler', name)
+    tiddler.text = 'first'
+    tiddler.modifier = 'cdent'
+    tiddler.tags = ['one', 'two']
+    tiddler.fields['field'] = 'value'
+    store.put(tiddler)
+    tiddler.text = 'second'
+    tiddler.modifier = 'fnd'
+    store.put(tiddler)
+
+
+def _check_entities(store, name):
+    bag = store.get(Bag(name))
+    assert bag.desc == 'the %s bag' % name
+    assert bag.policy.read == ['cdent']
+
+    recipe = store.get(Recipe(name))
+    assert recipe.desc == 'the %s recipe' % name
+    assert recipe.get_recipe() == [[name, '']]
+
+    user = store.get(User(name))
+    assert user.check_password('secret')
+    assert user.list_roles() == ['ADMIN']
+
+    tiddler = store.get(Tiddler('tiddler', name))
+    assert tiddler.text == 'second'
+    assert tiddler.creator == 'cdent'
+    assert tiddler.modifier == 'fnd'
+    assert sorted(tiddler.tags) == ['one', 'two']
+    assert tiddler.fields['field'] == 'value'
+    assert len(store.list_tiddler_revisions(tiddler)) == 2
+    assert [tiddler.title for tiddler in
+            store.list_bag_tiddlers(Bag(name))] == ['tiddler']
+
+
+def test_new_database_uses_configured_schema():
+    redis.flushdb()
+    store = _fresh_store({'schema': 2})
+    assert store.storage.layout.version == 2
+    assert redis.get('schema:version') == '2'
+
+    _put_entities(store, 'hashed')
+    _check_entities(store, 'hashed')
+
+    bid = redis.get('bag:hashed:bid')
+    assert redis.hget('bid:%s' % bid, 'desc') == 'the hashed bag'
+    assert not redis.exists('bid:%s:desc' % bid)
+
+    tiddler = store.get(Tiddler('tiddler', 'hashed'))
+    store.delete(tiddler)
+    py.test.raises(NoTiddlerError, 'store.get(tiddler)')
+    store.delete(Bag('hashed'))
+    store.delete(Recipe('hashed'))
+    store.delete(User('hashed'))
+    assert redis.keys('*id:*') == []
+
+
+def test_existing_database_is_schema_one():
+    redis.flushdb()
+    redis.set('ids:nextBagID', 1)
+    redis.delete('schema:version')
+    store = _fresh_store({'schema': 2})
+    assert store.storage.layout.version == 1
+    assert redis.get('schema:version') == '1'
+
+
+def test_migration():
+    redis.flushdb()
+    store = _fresh_store()
+    _put_entities(store, 'old')
+
+    # a migration has started: writes are in the new layout and
+    # reads find records in either layout
+    redis.set('schema:target', 2)
+    store = _fresh_store()
+    _check_entities(store, 'old')
+    _put_entities(store, 'mixed')
+    _check_entities(store, 'mixed')
+
+    migrate(store.storage, 2)
+    assert redis.get('schema:version') == '2'
+    assert not redis.exists('schema:target')
+    assert redis.keys('rvid:*:*') == []
+
+    store = _fresh_store()
+    assert store.storage.layout.version == 2
+    _check_entities(store, 'old')
+    _check_entities(store, 'mixed')
+    _put_entities(store, 'new')
+    _check_entities(store, 'new')
+
+
+def test_databases_keep_their_own_schema():
+    stores = {}
+    for db, schema in [(7, 2), (8, 1), (9, 2)]:
+        store_config = {'db': db, 'schema': schema}
+        Store('tiddlywebplugins.redisstore', store_config,
+                {}).storage.redis.flushdb()
+        stores[db] = Store('tiddlywebplugins.redisstore', store_config,
+                {'tiddlyweb.config': config})
+    try:
+        for db, store in sorted(stores.items()):
+            _put_entities(store, 'db%s' % db)
+        for db, store in stores.items():
+            assert store.storage.layout.version == (db == 8 and 1 or 2)
+            client = store.storage.primary
+            assert client.get('schema:version') == (db == 8 and '1' or '2')
+            assert 'tags' in client.smembers('indexes:built')
+            _check_entities(store, 'db%s' % db)
+            assert [bag.name for bag in store.list_bags()] == ['db%s' % db]
+        assert stores[8].storage.primary.exists('bid:1:name')
+        assert stores[9].storage.primary.exists('bid:1')
+    finally:
+        for store in stores.values():
+            store.storage.redis.flushdb()
@@ -0,0 +1,201 @@
+"""
+Test spreading bags over shards, and moving them between shards.
+Databases 3 and 4 of the test server are the shards, with database 0
+as the coordinator.
+"""
+
+import threading
+
+import py.test
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.user import User
+from tiddlyweb.store import NoBagError, Store
+
+from tiddlywebplugins.redisstore.manage import move_bag, rebalance
+from tiddlywebplugins.redisstore.shard import (MOVED_KEY, PLACEMENT_KEY,
+        BagMoved)
+
+SHARDS = [{'db': 3}, {'db': 4}]
+NAMES = ['localhost:6379/3', 'localhost:6379/4']
+BAGS = ['bag%s' % index for index in range(10)]
+
+
+def setup_module(module):
+    for db in [0, 3, 4]:
+        Store('tiddlywebplugins.redisstore', {'db': db},
+                {}).storage.primary.flushdb()
+    module.store = _store()
+    module.shards = store.storage.shards
+    for name in BAGS:
+        store.put(Bag(name))
+        for title in ['one', 'two']:
+            tiddler = Tiddler(title, name)
+            tiddler.text = '%s in %s' % (title, name)
+            tiddler.tags = ['shared', name]
+            store.put(tiddler)
+
+
+def _store(**options):
+    store_config = {'shards': SHARDS, 'schema_check_interval': 0.1}
+    store_config.update(options)
+    return Store('tiddlywebplugins.redisstore', store_config, {})
+
+
+def _keys(client):
+    return set(key.decode('utf-8') for key in client.keys('*'))
+
+
+def test_bags_on_their_shards():
+    coordinator = store.storage.primary
+    clients = shards.clients
+    placed = set(shards.ring_name(name) for name in BAGS)
+    assert placed == set(NAMES)
+    for name in BAGS:
+        client = clients[shards.ring_name(name)]
+        bid = client.get('bag:%s:bid' % name)
+        assert bid
+        assert client.sismember('bags', bid)
+        for other in clients.values():
+            if other is not client:
+                assert other.get('bag:%s:bid' % name) is None
+    assert not [key for key in _keys(coordinator) if key.startswith('bag')]
+    assert int(coordinator.get('ids:nextBagID')) == len(BAGS)
+    assert int(coordinator.get('ids:nextRevisionID')) == len(BAGS) * 2
+
+    assert sorted(bag.name for bag in store.list_bags()) == BAGS
+    assert store.get(Tiddler('two', 'bag7')).text == 'two in bag7'
+    assert [tiddler.title for tiddler in
+            store.list_bag_tiddlers(Bag('bag3'))] != []
+    assert len(store.list_tiddler_revisions(Tiddler('one', 'bag4'))) == 1
+
+    tiddlers = list(store.storage.index_query(tag='shared'))
+    assert len(tiddlers) == len(BAGS) * 2
+    tiddlers = list(store.storage.index_query(tag='shared', bag='bag5'))
+    assert sorted(tiddler.title for tiddler in tiddlers) == ['one', 'two']
+    tiddlers = list(store.storage.index_query(id='bag6:one'))
+    assert [(tiddler.bag, tiddler.title) for tiddler in tiddlers] == [
+            ('bag6', 'one')]
+
+
+def test_recipes_and_users_on_coordinator():
+    store.put(Recipe('recipe'))
+    store.put(User('user'))
+    coordinator = store.storage.primary
+    assert coordinator.get('recipe:recipe:rid')
+    assert coordinator.get('user:user:uid')
+    assert [recipe.name for recipe in store.list_recipes()] == ['recipe']
+
+
+def test_move_bag():
+    source = shards.ring_name('bag1')
+    target = [name for name in NAMES if name != source][0]
+    tiddler = Tiddler('three', 'bag1')
+    tiddler.tags = ['bag1']
+    store.put(tiddler)
+    before = _keys(shards.clients[source])
+
+    move_bag(store.storage, 'bag1', target, batch_size=1, grace=0)
+
+    assert store.storage.primary.hget(PLACEMENT_KEY, 'bag1') == target
+    assert shards.clients[source].get(MOVED_KEY % 'bag1') == target
+    # the keys of the bag are all on the target and gone from the source
+    shared = set(['bags', 'tags:shared:tids'])
+    after = _keys(shards.clients[source])
+    moved = (_keys(shards.clients[target]) & before) - shared
+    assert after == (before - moved) | set([MOVED_KEY % 'bag1'])
+    bid = shards.clients[target].get('bag:bag1:bid')
+    tids = shards.clients[target].smembers('bid:%s:tiddlers' % bid)
+    assert set(tids) == set(shards.clients[target].smembers(
+        'tags:bag1:tids'))
+    assert set(['bag:bag1:bid', 'tags:bag1:tids']) < moved
+    assert store.get(Tiddler('one', 'bag1')).text == 'one in bag1'
+    assert sorted(tiddler.title for tiddler in
+            store.list_bag_tiddlers(Bag('bag1'))) == ['one', 'three', 'two']
+    assert sorted(bag.name for bag in store.list_bags()) == BAGS
+    assert len(list(store.storage.index_query(tag='bag1'))) == 3
+    # bag1's one and two are hidden by bag2's
+    recent = store.storage.recent_tiddlers(['bag1', 'bag2'])
+    assert sorted((tiddler.bag, tiddler.title) for tiddler in recent) == [
+            ('bag1', 'three'), ('bag2', 'one'), ('bag2', 'two')]
+    assert len(list(store.storage.index_query(tag='shared'))) == (
+            len(BAGS) * 2)
+
+    # a store which has not noticed the move finds it when writing
+    stale = _store(schema_check_interval=60)
+    stale.storage.shards.placements = {}
+    tiddler = Tiddler('four', 'bag1')
+    tiddler.text = 'four'
+    stale.put(tiddler)
+    assert store.get(Tiddler('four', 'bag1')).text == 'four'
+    assert shards.clients[target].get('tiddler:bag1:four:tid')
+
+    # and moving it back removes the placement and the fence
+    move_bag(store.storage, 'bag1', source, grace=0)
+    assert store.storage.primary.hget(PLACEMENT_KEY, 'bag1') is None
+    assert shards.clients[source].get(MOVED_KEY % 'bag1') is None
+    assert store.get(Tiddler('four', 'bag1')).text == 'four'
+
+
+def test_writes_wait_for_move():
+    client = shards.clients[shards.ring_name('bag2')]
+    client.set(MOVED_KEY % 'bag2', 'elsewhere')
+    try:
+        waiting = _store(shard_move_wait=0.2)
+        py.test.raises(BagMoved, 'waiting.put(Tiddler("one", "bag2"))')
+        py.test.raises(BagMoved, 'waiting.put(Bag("bag2"))')
+        py.test.raises(BagMoved, 'waiting.delete(Bag("bag2"))')
+        # reads carry on
+        assert waiting.get(Tiddler('one', 'bag2')).text == 'one in bag2'
+
+        errors = []
+
+        def writer():
+            try:
+                _store().put(Tiddler('five', 'bag2'))
+            except Exception as exc:
+                errors.append(exc)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        thread.join(0.3)
+        assert thread.is_alive()
+    finally:
+        client.delete(MOVED_KEY % 'bag2')
+    thread.join()
+    assert errors == []
+    assert store.get(Tiddler('five', 'bag2'))
+
+
+def test_delete_bag():
+    store.delete(Bag('bag9'))
+    py.test.raises(NoBagError, 'store.get(Bag("bag9"))')
+    client = shards.clients[shards.ring_name('bag9')]
+    assert not [key for key in _keys(client) if 'bag9' in key]
+    BAGS.remove('bag9')
+
+
+def test_rebalance():
+    # a store with a third shard, db 5, which some bags now hash to
+    Store('tiddlywebplugins.redisstore', {'db': 5},
+            {}).storage.primary.flushdb()
+    bigger = _store(shards=SHARDS + [{'db': 5}])
+    new_shards = bigger.storage.shards
+    moving = [name for name in BAGS
+            if new_shards.ring_name(name) == 'localhost:6379/5']
+    assert moving
+
+    rebalance(bigger.storage, pin=True)
+    placements = bigger.storage.primary.hgetall(PLACEMENT_KEY)
+    assert sorted(placements) == sorted(moving)
+    for name in BAGS:
+        assert bigger.get(Tiddler('one', name)).text == 'one in %s' % name
+
+    rebalance(bigger.storage, grace=0)
+    assert bigger.storage.primary.hgetall(PLACEMENT_KEY) == {}
+    for name in BAGS:
+        assert bigger.get(Tiddler('one', name)).text == 'one in %s' % name
+    assert sorted(bag.name for bag in bigger.list_bags()) == BAGS
+    assert new_shards.clients['localhost:6379/5'].get(
+            'bag:%s:bid' % moving[0])
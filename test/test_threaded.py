@@ -0,0 +1,73 @@
+"""
+Test the threaded store, by running the tests of the synchronous one
+against it, and with many operations in flight at once.
+"""
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import NoTiddlerError
+
+from tiddlywebplugins.redisstore.threaded import ThreadedStore
+
+from test import test_simple
+from test.test_simple import (test_store_bag, test_store_tiddler,
+        test_list_bag_tiddlers, test_list_bags, test_users, test_recipes)
+
+
+class Waiting(object):
+    """
+    A Store which waits for the results of a ThreadedStore.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.storage = store.storage
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+        return lambda *args, **kwargs: method(*args, **kwargs).result()
+
+
+def setup_module(module):
+    environ = {'tiddlyweb.config': config}
+    module.store = ThreadedStore(config['server_store'][1], environ)
+    store.storage.redis.flushdb()
+    module.replaced = (getattr(test_simple, 'store', None),
+            getattr(test_simple, 'environ', None))
+    test_simple.store = Waiting(store)
+    test_simple.environ = environ
+
+
+def teardown_module(module):
+    test_simple.store, test_simple.environ = replaced
+
+
+def test_fan_out():
+    store.put(Bag('fan')).result()
+
+    tiddlers = []
+    for index in range(50):
+        tiddler = Tiddler('tiddler%s' % index, 'fan')
+        tiddler.text = 'text%s' % index
+        tiddlers.append(tiddler)
+    futures = [store.put(tiddler) for tiddler in tiddlers]
+    for future in futures:
+        future.result()
+    assert len(set(tiddler.revision for tiddler in tiddlers)) == 50
+
+    futures = [store.get(Tiddler(tiddler.title, 'fan'))
+            for tiddler in tiddlers]
+    assert [future.result().text for future in futures] == [
+            'text%s' % index for index in range(50)]
+
+    listed = store.list_bag_tiddlers(Bag('fan')).result()
+    assert isinstance(listed, list)
+    assert len(listed) == 50
+
+    store.delete(Bag('fan')).result()
+
+
+def test_errors():
+    future = store.get(Tiddler('missing', 'fan'))
+    assert isinstance(future.exception(), NoTiddlerError)
@@ -0,0 +1,73 @@
+"""
+Test tombstoning bags on delete and reaping their tiddlers later.
+"""
+
+import py.test
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store, NoBagError, NoTiddlerError
+
+from tiddlywebplugins.redisstore.manage import reap
+
+
+def setup_module(module):
+    Store('tiddlywebplugins.redisstore', {}, {}).storage.redis.flushdb()
+    module.store = Store('tiddlywebplugins.redisstore',
+            {'tombstone_bags': True, 'delete_chunk_size': 7}, {})
+    module.redis = module.store.storage.redis
+
+
+def _fill_bag(name, count):
+    store.put(Bag(name))
+    for index in range(count):
+        tiddler = Tiddler('tiddler%s' % index, name)
+        tiddler.text = 'in %s' % name
+        tiddler.tags = ['common']
+        store.put(tiddler)
+        store.put(tiddler)
+
+
+def test_tombstoned_bag_is_gone():
+    _fill_bag('doomed', 20)
+    bid = redis.get('bag:doomed:bid')
+    store.delete(Bag('doomed'))
+
+    assert set(redis.smembers('bags:tombstoned')) == set([bid])
+    assert 'doomed' not in [bag.name for bag in store.list_bags()]
+    py.test.raises(NoBagError, 'store.get(Bag("doomed"))')
+    py.test.raises(NoBagError, 'store.get(Tiddler("tiddler1", "doomed"))')
+    py.test.raises(NoBagError,
+            'store.list_tiddler_revisions(Tiddler("tiddler1", "doomed"))')
+    py.test.raises(NoBagError, 'list(store.list_bag_tiddlers(Bag("doomed")))')
+    py.test.raises(NoBagError, 'store.put(Tiddler("tiddler1", "doomed"))')
+    assert list(store.storage.index_query(tag='common')) == []
+
+    # the tiddlers are still there
+    assert redis.scard('bid:%s:tiddlers' % bid) == 20
+
+
+def test_bag_name_reused():
+    _fill_bag('doomed', 3)
+    tiddler = store.get(Tiddler('tiddler1', 'doomed'))
+    assert len(store.list_tiddler_revisions(tiddler)) == 2
+    py.test.raises(NoTiddlerError, 'store.get(Tiddler("tiddler5", "doomed"))')
+    py.test.raises(NoTiddlerError,
+            'store.delete(Tiddler("tiddler5", "doomed"))')
+    assert sorted(tiddler.title for tiddler in
+            store.list_bag_tiddlers(Bag('doomed'))) == [
+                    'tiddler0', 'tiddler1', 'tiddler2']
+
+
+def test_reap():
+    reap(store.storage, pause=0)
+
+    assert redis.scard('bags:tombstoned') == 0
+    assert redis.keys('bid:1*') == []
+    assert redis.scard('tags:common:tids') == 3
+    # the tiddlers of the new bag with the same name are intact
+    tiddler = store.get(Tiddler('tiddler1', 'doomed'))
+    assert tiddler.text == 'in doomed'
+    assert len(store.list_tiddler_revisions(tiddler)) == 2
+    assert len(redis.keys('tiddler:doomed:*')) == 3
+    assert len(redis.keys('tid:*:revisions')) == 3
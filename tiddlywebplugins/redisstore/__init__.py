@@ -0,0 +1,1580 @@
+"""
+A redis-based store for TiddlyWeb. Uses keys as follows:
+
+recipes:
+    ids:nextRecipeID: the counter of recipe ids
+
+    rid.#rid.name:    name of the recipe
+    rid.#rid.desc:    description of the recipe
+    rid.#rid.policy:  id of the policy
+    rid.#rid.rlist:   list of recipe
+
+    recipe.#name.rid: rid associated with recipe name
+    recipes:          set of all recipe rids
+
+policy:
+    ids:nextPolicyID: the counter of policy ids
+
+    pid.#pid:manage:  set of strings
+    pid.#pid:accept:  set of strings
+    pid.#pid:create:  set of strings
+    pid.#pid:edit:    set of strings
+    pid.#pid:write:   set of strings
+    pid.#pid:owner:   string
+
+    policy.#pid:holder: (recipe|bag):#(rid|bid)
+
+bags:
+    ids:nextBagID:    the counter of bag ids
+
+    bid:#bid:name:    bag name
+    bid:#bid:desc:    bag desc
+    bid:#bid:policy:  id of the policy
+    bid:#bid:tiddlers:set of tiddler ids
+
+    bag:#name:bid:    bid associated with bag name
+    bags:             set of all bag bids
+    bags:tombstoned:  set of bids of deleted bags whose tiddlers
+                      are still to be reaped
+
+users:
+    ids:nextUserID:   the counter of user ids
+
+    uid:#uid:usersign:    user name
+    uid:#uid:password:    user password
+    uid:#uid:roles:   set of roles
+
+    user:#name:uid:   uid associated with user name
+    users:            set of all user ids
+
+tiddlers:
+    ids:nextTiddlerID:the counter of tiddler ids
+
+    tid:#tid:title:   tiddler title
+    tid:#tid:bid:     bag id
+    tid:#tid:creator: modifier of the first revision, once that has
+                      been trimmed
+    tid:#tid:created: modified time of the first revision, likewise
+    tid:#tid:revisions (ordered) list of rvids
+
+    tid:#tid:indexes: set of the index sets the tid is in
+
+    tiddler:#bag_name:#tiddler_name:tid: map bag+tiddler to tid
+
+indexes:
+    bid:#bid:tag:#tag:  set of tids in the bag with the tag
+    bid:#bid:field:#name:#value: set of tids in the bag with the value
+                        for the field, for fields in indexed_fields
+    tags:#tag:tids:     set of tids with the tag
+    bid:#bid:recent:    sorted set of the tids in the bag, scored by
+                        modified time, see
+                        tiddlywebplugins.redisstore.recent
+    indexes:built:      set of the names of complete indexes
+
+tiddler revisions:
+    ids:nextRevisionID:the counter of revision ids
+
+    rvid:#rvid:text:    tiddler text
+    rvid:#rvid:tags:    set of tags
+    rvid:#rvid:modified:
+    rvid:#rvid:modifier:
+    rvid:#rvid:fields:  hash
+    rvid:#rvid:tid:     tid of this
+    rvid:#rvid:compression: the codec the text is compressed with,
+                        if it is
+    rvid:#rvid:delta:   the rvid of the revision the text is a delta
+                        against, if it is
+    rvid:#rvid:digest:  the digest of the shared text, in place of text
+                        and compression, if it is shared
+
+shared texts:
+    text:#digest:       hash of the text, its compression and refs, the
+                        number of revisions referring to it, see
+                        tiddlywebplugins.redisstore.dedup
+
+schema:
+    schema:version:   the layout of the records above, 1 or 2
+    schema:target:    the layout being migrated to, if any
+
+bulk imports:
+    import:#source:done: how many records of the source have been
+                      imported, see tiddlywebplugins.redisstore.bulk
+
+shards, when sharded:
+    shards:placement: hash of the shards of moved bags, by bag name
+    bag:#name:moved:  on a shard, the shard the bag is moving or has
+                      moved to
+
+The keys above are schema 1. In schema 2 the attributes of each bid,
+rid, uid, tid and rvid record are instead kept in one hash named for the
+record, e.g. bid:#bid, see tiddlywebplugins.redisstore.layout. The
+schema configured as 'schema' in the store config is used for new
+databases. An existing database is migrated with the twanager command
+redismigrate, while the store is in use.
+
+Options for the store are in the store config alongside those for the
+redis connection, see STORE_OPTIONS and
+tiddlywebplugins.redisstore.connection. Reads may be sent to replicas,
+see tiddlywebplugins.redisstore.replica, and bags spread over several
+servers, see tiddlywebplugins.redisstore.shard. A store whose
+operations run on worker threads, returning futures, is in
+tiddlywebplugins.redisstore.threaded.
+"""
+
+import copy
+import itertools
+import logging
+import threading
+import time
+
+from redis.client import Redis
+from redis.exceptions import NoScriptError
+
+from tiddlyweb.filters import FILTER_PARSERS, FilterIndexRefused
+from tiddlyweb.control import recipe_template
+from tiddlyweb.manage import make_command
+from tiddlyweb.util import binary_tiddler
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.policy import Policy
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.user import User
+from tiddlyweb.store import (NoBagError, NoTiddlerError, NoUserError,
+        NoRecipeError)
+from tiddlyweb.stores import StorageInterface
+
+from tiddlywebplugins.redisstore.cache import CHANNEL, get_cache
+from tiddlywebplugins.redisstore.compress import (check_codec, compress,
+        decompress)
+from tiddlywebplugins.redisstore.connection import get_client
+from tiddlywebplugins.redisstore.dedup import text_digest
+from tiddlywebplugins.redisstore.delta import apply_delta, make_delta
+from tiddlywebplugins.redisstore.ids import (REVISION_COUNTER,
+        TIDDLER_COUNTER, forget_allocators, get_allocator)
+from tiddlywebplugins.redisstore.instrument import (MeasuredPipeline,
+        count_commands, get_stats, measured)
+from tiddlywebplugins.redisstore.layout import get_layout, read_schema
+from tiddlywebplugins.redisstore.recent import merge_recent, sort_parser
+from tiddlywebplugins.redisstore.replica import get_replicas, reads, writes
+from tiddlywebplugins.redisstore.revisions import RevisionList
+from tiddlywebplugins.redisstore.shard import (MOVED_KEY, BagMoved,
+        get_shards, node_iterator, on_bag_shard, on_node)
+from tiddlywebplugins.redisstore.scripts import SCRIPTS
+
+
+LOGGER = logging.getLogger(__name__)
+
+ENTITY_MAP = {
+        'user': 'uid',
+        'recipe': 'rid',
+        'bag': 'bid',
+        }
+
+BAG_ATTRIBUTES = ['name', 'desc', 'policy']
+RECIPE_ATTRIBUTES = ['name', 'desc', 'policy']
+USER_ATTRIBUTES = ['usersign', 'password', 'note']
+
+# The indexes which are always maintained as tiddlers are stored.
+INDEXES = ['tags', 'recent']
+
+# The tiddler attributes which may be in indexed_fields. Other names
+# there are tiddler fields.
+INDEXED_ATTRIBUTES = ['modifier', 'modified', 'type']
+
+# What tiddler_put returns when given an rvid which is not after that
+# of the tiddler's latest revision.
+STALE_REVISION = -2
+
+# Options which configure the store rather than the redis connection,
+# with their defaults.
+STORE_OPTIONS = {
+        'schema': 1,
+        'schema_check_interval': 10,
+        # how many set members to ask for at a time when listing
+        'scan_count': 500,
+        # tiddler attributes and fields to keep indexes of, for selects
+        'indexed_fields': [],
+        # how many tiddlers to delete at a time when deleting a bag
+        'delete_chunk_size': 100,
+        # when deleting a bag only tombstone it, leaving its tiddlers
+        # to be removed by the redisreap command
+        'tombstone_bags': False,
+        # how many bags, recipes and users to keep in the in-process
+        # cache, 0 for none, and for how many seconds
+        'cache_size': 0,
+        'cache_ttl': 60,
+        # how many ids of named entities to remember, 0 for none
+        'id_cache_size': 0,
+        # connection configurations of replicas to read from, see
+        # tiddlywebplugins.redisstore.replica
+        'replicas': [],
+        'replica_selection': 'round_robin',
+        'replica_check_interval': 5,
+        # how many seconds a request reads from the primary after it
+        # writes
+        'read_your_writes': 5,
+        # connection configurations of servers to spread bags over, see
+        # tiddlywebplugins.redisstore.shard
+        'shards': [],
+        # how many seconds to wait for a moving bag before giving up on
+        # changing it
+        'shard_move_wait': 10,
+        # how many ids of a counter each process reserves at a time, and
+        # whether revision ids are instead allocated in the order
+        # revisions are written, see tiddlywebplugins.redisstore.ids
+        'id_block_size': 1,
+        'id_strict': False,
+        # the codec, zlib or lz4, to compress revision text with, if
+        # any, the size in bytes from which to compress it and the
+        # level, see tiddlywebplugins.redisstore.compress
+        'compression': None,
+        'compression_threshold': 1024,
+        'compression_level': 6,
+        # share the text, of at least dedup_threshold bytes, of
+        # revisions with the same text, see
+        # tiddlywebplugins.redisstore.dedup
+        'dedup_text': False,
+        'dedup_threshold': 128,
+        # keep older revisions as deltas against the next, with one in
+        # every delta_keyframe_interval keeping its full text, see
+        # tiddlywebplugins.redisstore.delta
+        'revision_deltas': False,
+        'delta_keyframe_interval': 10,
+        # how many of the latest revisions of each tiddler to keep, 0 for
+        # all, and for how many seconds to keep revisions, 0 for ever; a
+        # revision is removed when neither keeps it. bag_retention maps
+        # bag names to a dict of 'revisions' and 'seconds' to use for the
+        # bag instead. At most retention_trim_size revisions are removed
+        # when a tiddler is put, 0 for none, leaving them to redisprune.
+        'retain_revisions': 0,
+        'retain_seconds': 0,
+        'bag_retention': {},
+        'retention_trim_size': 10,
+        # how many worker threads run the operations of ThreadedStores,
+        # see tiddlywebplugins.redisstore.threaded
+        'store_workers': 16,
+        }
+
+
+def init(config):
+    """
+    Establish the twanager commands for managing the store, and the
+    sort filter which uses its recent index, over the one in place.
+    """
+    FILTER_PARSERS['sort'] = sort_parser(FILTER_PARSERS['sort'])
+
+    @make_command()
+    def redismigrate(args):
+        """Migrate the redis store to a schema version: <version>"""
+        from tiddlywebplugins.redisstore.manage import migrate
+        try:
+            target = int(args[0])
+        except (IndexError, ValueError):
+            target = 2
+        migrate(_store(config), target)
+
+    @make_command()
+    def redisreindex(args):
+        """Rebuild the tag, field and recent indexes of the redis store."""
+        from tiddlywebplugins.redisstore.manage import reindex
+        reindex(_store(config))
+
+    @make_command()
+    def redisreap(args):
+        """Remove the tiddlers of tombstoned bags: [<batch size> [<pause>]]"""
+        from tiddlywebplugins.redisstore.manage import reap
+        kwargs = {}
+        try:
+            kwargs['batch_size'] = int(args[0])
+            kwargs['pause'] = float(args[1])
+        except (IndexError, ValueError):
+            pass
+        reap(_store(config), **kwargs)
+
+    @make_command()
+    def redisprune(args):
+        """Remove revisions not kept by retention: [<batch size> [<pause>]]"""
+        from tiddlywebplugins.redisstore.manage import prune
+        kwargs = {}
+        try:
+            kwargs['batch_size'] = int(args[0])
+            kwargs['pause'] = float(args[1])
+        except (IndexError, ValueError):
+            pass
+        prune(_store(config), **kwargs)
+
+    @make_command()
+    def redisimport(args):
+        """Import a text store or a dump: <source> [<batch size>]"""
+        from tiddlywebplugins.redisstore.bulk import import_source
+        import_source(_store(config), *_bulk_args(args))
+
+    @make_command()
+    def redisexport(args):
+        """Export the redis store to a dump file: <dump> [<batch size>]"""
+        from tiddlywebplugins.redisstore.bulk import export_dump
+        export_dump(_store(config), *_bulk_args(args))
+
+    @make_command()
+    def redismovebag(args):
+        """Move a bag of a sharded redis store to a shard: <bag> <shard>"""
+        from tiddlywebplugins.redisstore.manage import move_bag
+        bag_name, target = args
+        move_bag(_store(config), bag_name, target)
+
+    @make_command()
+    def redisrebalance(args):
+        """Move bags to the shards they hash to, or only pin them: [pin]"""
+        from tiddlywebplugins.redisstore.manage import rebalance
+        rebalance(_store(config), pin=args == ['pin'])
+
+
+def index_query(environ, **kwargs):
+    """
+    Satisfy a tiddlyweb filter from the indexes of the redis store.
+    Used when 'indexer' is 'tiddlywebplugins.redisstore' in the config.
+    """
+    store = environ['tiddlyweb.store']
+    tiddlers = store.storage.index_query(**kwargs)
+    return (store.get(tiddler) for tiddler in tiddlers)
+
+
+def _bulk_args(args):
+    """
+    The path and, if given, batch size arguments of a bulk command.
+    """
+    path = args[0]
+    if len(args) > 1:
+        return [path, int(args[1])]
+    return [path]
+
+
+def _store(config):
+    """
+    Get the redis Store configured for the server.
+    """
+    from tiddlyweb.store import Store as StoreWrapper
+    return StoreWrapper(config['server_store'][0], config['server_store'][1],
+            {'tiddlyweb.config': config}).storage
+
+
+def _text_type(tiddler_type):
+    """
+    The type of a tiddler, or a revision as stored, with no type as
+    None.
+    """
+    if not tiddler_type or tiddler_type == 'None':
+        return None
+    return tiddler_type
+
+
+def tiddler_created(result):
+    """
+    Whether the tiddler_put script which returned result created the
+    tiddler.
+    """
+    return isinstance(result, list) and result[1] == 1
+
+
+def split_config(store_config):
+    """
+    Separate the store options in store_config from the configuration
+    of the redis connection.
+    """
+    options = dict(STORE_OPTIONS)
+    redis_config = {}
+    for key, value in store_config.items():
+        if key in STORE_OPTIONS:
+            options[key] = value
+        else:
+            redis_config[key] = value
+    return options, redis_config
+
+
+class URedis(Redis):
+    """
+    Add some better unicode handling to the default redis class.
+    This works for us because we only care about unicode strings
+    anyway.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.encoding = 'utf-8'
+        Redis.__init__(self, *args, **kwargs)
+        self.scripts = {}
+        for name, source in SCRIPTS.items():
+            self.scripts[name] = self.register_script(source)
+        self.forget_schema()
+
+    def forget_schema(self):
+        """
+        Forget the schema of the database, so that it is read again.
+        The layout in use and the indexes which are complete are kept
+        for each client, as clients are for each database, and rechecked
+        every schema_check_interval seconds so that running stores
+        notice a migration or reindexing.
+        """
+        self.schema = {'layout': None, 'indexes': set(), 'checked': 0}
+
+    def flushdb(self):
+        """
+        Delete the keys of the database, and forget its schema and the
+        ids reserved from its counters.
+        """
+        self.forget_schema()
+        forget_allocators(self)
+        return Redis.flushdb(self)
+
+    def execute_command(self, *args, **options):
+        """
+        Execute a command, counting it against the running Store method.
+        """
+        started = time.time()
+        try:
+            return Redis.execute_command(self, *args, **options)
+        finally:
+            count_commands(1, started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MeasuredPipeline(self.connection_pool,
+                self.response_callbacks, transaction, shard_hint)
+
+    def decode(self, value):
+        """
+        Decode ``value``, a result from a pipeline, if it is not empty.
+        """
+        if value:
+            return value.decode(self.encoding)
+        return value
+
+    def uget(self, name):
+        """
+        Return the value and key ``name`` or None, and decode it if not None.
+        """
+        return self.decode(Redis.get(self, name))
+
+    def lrange(self, name, start, end):
+        """
+        Return a slice of the list ``name`` between
+        position ``start`` and ``end``
+        
+        ``start`` and ``end`` can be negative numbers just like
+        Python slicing notation
+
+        decode the results
+        """
+        results = Redis.lrange(self, name, start, end)
+        return [result.decode(self.encoding) for result in results]
+
+    def hgetall(self, name):
+        """
+        Return a Python dict of the hash's name/value pairs, both key and
+        value decoded.
+        """
+        output = {}
+        info = Redis.hgetall(self, name)
+        for key, value in info.iteritems():
+            output[key.decode(self.encoding)] = value.decode(self.encoding)
+        return output
+
+    def smembers(self, name):
+        """
+        Return all members of the set ``name``, decoding.
+        """
+        values = Redis.smembers(self, name)
+        return (value.decode(self.encoding) for value in values)
+
+
+class Store(StorageInterface):
+
+    def __init__(self, store_config=None, environ=None):
+        super(Store, self).__init__(store_config, environ)
+        self.options, redis_config = split_config(self.store_config)
+        check_codec(self.options['compression'])
+        self.primary = get_client(URedis, redis_config)
+        self.replicas = get_replicas(URedis, redis_config, self.options)
+        self.shards = get_shards(URedis, redis_config, self.options)
+        self.allocator = get_allocator(self.primary, self.options)
+        # the replica the current thread is reading from, and the shard
+        # it is using, if any
+        self.reading = threading.local()
+        self.layout = self._get_layout()
+        self.cache = get_cache(self._nodes(), self.options['cache_size'],
+                self.options['cache_ttl'], self.options['id_cache_size'])
+        self.stats = get_stats(self.environ)
+
+    @property
+    def redis(self):
+        """
+        The client to send commands to: the bag's shard while a method
+        on a bag of a sharded store runs, a replica while a read only
+        method runs, if it chose one, otherwise the primary.
+        """
+        return (getattr(self.reading, 'shard', None)
+                or getattr(self.reading, 'client', None) or self.primary)
+
+    @measured
+    @writes
+    @on_bag_shard
+    def bag_delete(self, bag):
+        """
+        Delete the bag and its tiddlers or, if tombstone_bags is set,
+        only tombstone the bag, leaving its tiddlers to be reaped later.
+        """
+        bid = self._id_for_entity('bag', bag.name)
+        if not bid:
+            raise NoBagError('unable to get id for %s' % bag.name)
+
+        if self.options['tombstone_bags']:
+            pipe = self._bag_pipeline(bag.name)
+            pipe.delete('bag:%s:bid' % bag.name)
+            pipe.srem('bags', bid)
+            pipe.sadd('bags:tombstoned', bid)
+            self.cache.invalidate(pipe, 'bag:%s' % bag.name)
+            self.cache.invalidate(pipe, 'bag:%s:bid' % bag.name)
+            pipe.execute()
+            return
+
+        self._delete_bag_tiddlers(bag.name, bid)
+        self._delete_bag_record(bid, bag.name)
+
+    @measured
+    @reads
+    @on_bag_shard
+    def bag_get(self, bag):
+        desc, policy = self._get_entity('bag:%s' % bag.name,
+                lambda: self._read_bag(bag.name))
+        bag.desc = desc
+        bag.policy = copy.deepcopy(policy)
+        return bag
+
+    @measured
+    @writes
+    @on_bag_shard
+    def bag_put(self, bag):
+        bid = self._id_for_entity('bag', bag.name)
+
+        pid = None
+        if bid:
+            pid = self._read_record('bid', bid, ['policy'])[0]
+        else:
+            bid = self.allocator.next('ids:nextBagID')
+
+        pipe = self._bag_pipeline(bag.name)
+        pipe.set('bag:%s:bid' % bag.name, bid)
+        pid = self._set_policy(pipe, bag.policy, pid)
+        self.layout.write_record(pipe, 'bid', bid, {'name': bag.name,
+            'desc': bag.desc, 'policy': pid})
+        pipe.sadd('bags', bid)
+        self.cache.invalidate(pipe, 'bag:%s' % bag.name)
+        pipe.execute()
+
+    @measured
+    @writes
+    def recipe_delete(self, recipe):
+        rid = self._id_for_entity('recipe', recipe.name)
+        if not rid:
+            raise NoRecipeError('unable to get id for %s' % recipe.name)
+
+        pid = self._read_record('rid', rid, ['policy'])[0]
+
+        delete_keys = self.layout.record_keys('rid', rid, RECIPE_ATTRIBUTES)
+        delete_keys.append('rid:%s:rlist' % rid)
+        delete_keys.append('recipe:%s:rid' % recipe.name)
+        pipe = self.redis.pipeline()
+        pipe.delete(*delete_keys)
+        self._delete_policy(pipe, pid)
+        pipe.srem('recipes', rid)
+        self.cache.invalidate(pipe, 'recipe:%s' % recipe.name)
+        self.cache.invalidate(pipe, 'recipe:%s:rid' % recipe.name)
+        pipe.execute()
+
+    @measured
+    @reads
+    def recipe_get(self, recipe):
+        desc, policy, recipe_items = self._get_entity(
+                'recipe:%s' % recipe.name,
+                lambda: self._read_recipe(recipe.name))
+        recipe.desc = desc
+        recipe.policy = copy.deepcopy(policy)
+        recipe.set_recipe(list(recipe_items))
+        return recipe
+
+    @measured
+    @writes
+    def recipe_put(self, recipe):
+        rid = self._id_for_entity('recipe', recipe.name)
+
+        pid = None
+        if rid:
+            pid = self._read_record('rid', rid, ['policy'])[0]
+        else:
+            rid = self.allocator.next('ids:nextRecipeID')
+
+        pipe = self.redis.pipeline()
+        pipe.set('recipe:%s:rid' % recipe.name, rid)
+        pid = self._set_policy(pipe, recipe.policy, pid)
+        self.layout.write_record(pipe, 'rid', rid, {'name': recipe.name,
+            'desc': recipe.desc, 'policy': pid})
+
+        pipe.delete('rid:%s:rlist' % rid)
+        for bag, filter_string in recipe.get_recipe():
+            pipe.rpush('rid:%s:rlist' % rid, '%s?%s'
+                    % (bag, filter_string))
+
+        pipe.sadd('recipes', rid)
+        self.cache.invalidate(pipe, 'recipe:%s' % recipe.name)
+        pipe.execute()
+
+    @measured
+    @writes
+    @on_bag_shard
+    def tiddler_delete(self, tiddler):
+        """
+        Delete the tiddler, its revisions and its index entries in one
+        server side script.
+        """
+        tiddler_key = 'tiddler:%s:%s:tid' % (tiddler.bag, tiddler.title)
+        self.cache.ids.evict(tiddler_key)
+        result = self.redis.scripts['tiddler_delete'](
+                keys=['bag:%s:bid' % tiddler.bag, tiddler_key,
+                    MOVED_KEY % tiddler.bag],
+                args=[CHANNEL])
+        if result == -2:
+            raise BagMoved('bag has moved: %s' % tiddler.bag)
+        if result < 0:
+            raise NoBagError('no bag found: %s:%s'
+                    % (tiddler.bag, tiddler.title))
+        if not result:
+            raise NoTiddlerError('no tiddler found: %s:%s'
+                    % (tiddler.bag, tiddler.title))
+
+    @measured
+    @reads
+    @on_bag_shard
+    def tiddler_get(self, tiddler):
+        """
+        Load the tiddler: one round trip to find the base and current
+        revision ids, and one to get the attributes of both.
+        """
+        return self._retry_with_fresh_ids(self._tiddler_get, tiddler)
+
+    def _tiddler_get(self, tiddler, memo):
+        bid, tid = self._tid_for_tiddler(tiddler, memo)
+        if not tid:
+            raise NoTiddlerError('unable to load %s:%s'
+                    % (tiddler.bag, tiddler.title))
+
+        revisions_key = 'tid:%s:revisions' % tid
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lindex(revisions_key, 0)
+        if not tiddler.revision:
+            pipe.lindex(revisions_key, -1)
+        tid_reader = self.layout.read_record(pipe, 'tid', tid,
+                ['bid', 'creator', 'created'])
+        results = iter(pipe.execute())
+        base_rvid = next(results)
+        if tiddler.revision:
+            current_rvid = tiddler.revision
+        else:
+            current_rvid = next(results)
+        tid_bid, creator, created = tid_reader(results)
+        if tid_bid != bid:
+            raise NoTiddlerError('unable to load %s:%s'
+                    % (tiddler.bag, tiddler.title))
+
+        # once the first revision has been trimmed, the tiddler record
+        # has its creator and created
+        base_reader = None
+        if creator is None:
+            base_reader = self.layout.read_record(pipe, 'rvid', base_rvid,
+                    ['modifier', 'modified'])
+        revision_reader = self.layout.read_revision(pipe, current_rvid)
+        if self.options['dedup_text']:
+            # queued without registering the script, which would cost a
+            # round trip to check that the server has it
+            shared_text = self.redis.scripts['revision_shared_text']
+            pipe.evalsha(shared_text.sha, 0, current_rvid)
+        try:
+            results = iter(pipe.execute())
+        except NoScriptError:
+            self.redis.script_load(shared_text.script)
+            return self._tiddler_get(tiddler, memo)
+        if base_reader:
+            creator, created = base_reader(results)
+        creator, created = self._decode_all([creator, created])
+        revision = revision_reader(results)
+        shared = None
+        if self.options['dedup_text']:
+            shared = next(results)
+
+        modifier = self.redis.decode(revision['modifier'])
+        if not modifier:
+            raise NoTiddlerError('unable to load %s:%s@%s'
+                    % (tiddler.bag, tiddler.title, current_rvid))
+        tiddler.creator = creator
+        tiddler.created = created
+        tiddler.modifier = modifier
+        tiddler.modified = self.redis.decode(revision['modified'])
+        tiddler.type = self.redis.decode(revision['type'])
+        tiddler.tags = revision['tags']
+        tiddler.fields = revision['fields']
+        text = self._revision_text(revision, current_rvid, shared)
+        if binary_tiddler(tiddler):
+            tiddler.text = text
+        else:
+            tiddler.text = self.redis.decode(text)
+        tiddler.revision = current_rvid
+        return tiddler
+
+    @measured
+    @writes
+    @on_bag_shard
+    def tiddler_put(self, tiddler):
+        """
+        Store a new revision of the tiddler. Id allocation and all the
+        writes happen in a single server side script, and thus a single
+        round trip, unless ids are allocated in blocks or on the
+        coordinator of a sharded store.
+        """
+        ids = self._new_tiddler_ids()
+        while True:
+            keys, args = self._tiddler_put_arguments(tiddler, ids)
+            result = self.redis.scripts['tiddler_put'](keys=keys, args=args)
+            if result != STALE_REVISION:
+                break
+            # a later revision has been stored, with an rvid from
+            # another process's block, so get a fresh one
+            ids[1] = self.primary.incr(REVISION_COUNTER)
+        if ids[0] != '' and not tiddler_created(result):
+            self.allocator.give_back(TIDDLER_COUNTER, ids[0])
+        self._tiddler_put_done(tiddler, result)
+        if self.options['revision_deltas'] and not binary_tiddler(tiddler):
+            self._delta_previous_revision(tiddler)
+
+    @measured
+    @writes
+    def user_delete(self, user):
+        uid = self._id_for_entity('user', user.usersign)
+        if not uid:
+            raise NoUserError('no user found for %s' % user.usersign)
+
+        delete_keys = self.layout.record_keys('uid', uid, USER_ATTRIBUTES)
+        delete_keys.append('uid:%s:roles' % uid)
+        delete_keys.append('user:%s:uid' % user.usersign)
+
+        pipe = self.redis.pipeline()
+        pipe.delete(*delete_keys)
+        pipe.srem('users', uid)
+        self.cache.invalidate(pipe, 'user:%s' % user.usersign)
+        self.cache.invalidate(pipe, 'user:%s:uid' % user.usersign)
+        pipe.execute()
+
+    @measured
+    @reads
+    def user_get(self, user):
+        password, note, roles = self._get_entity('user:%s' % user.usersign,
+                lambda: self._read_user(user.usersign))
+        user._password = password
+        user.note = note
+        user.roles = list(roles)
+        return user
+
+    @measured
+    @writes
+    def user_put(self, user):
+        uid = self._id_for_entity('user', user.usersign)
+        if not uid:
+            uid = self.allocator.next('ids:nextUserID')
+
+        pipe = self.redis.pipeline()
+        pipe.set('user:%s:uid' % user.usersign, uid)
+        self.layout.write_record(pipe, 'uid', uid, {
+            'usersign': user.usersign, 'password': user._password,
+            'note': user.note})
+
+        pipe.delete('uid:%s:roles' % uid)
+        for role in user.list_roles():
+            pipe.sadd('uid:%s:roles' % uid, role)
+
+        pipe.sadd('users', uid)
+        self.cache.invalidate(pipe, 'user:%s' % user.usersign)
+        pipe.execute()
+
+    @measured
+    @reads
+    def index_query(self, **kwargs):
+        """
+        Yield the tiddlers matching the attributes and values in kwargs,
+        using the index sets. If ``bag`` is given, only tiddlers in that
+        bag. If ``id`` is given, as bag:title, that tiddler if it exists.
+
+        Raise FilterIndexRefused if there is no index for an attribute,
+        so that tiddlyweb falls back to filtering all the tiddlers.
+        """
+        if self.shards is not None and 'id' not in kwargs:
+            return self._index_query_shards(kwargs)
+        return self._index_query(kwargs)
+
+    @measured
+    @reads
+    def list_bags(self):
+        if self.shards is None:
+            names = self._list_attribute('bags', 'bid', 'name')
+        else:
+            names = self._list_sharded_bags()
+        for name in names:
+            yield Bag(name)
+
+    @measured
+    @reads
+    def list_recipes(self):
+        for name in self._list_attribute('recipes', 'rid', 'name'):
+            yield Recipe(name)
+
+    @measured
+    @reads
+    def list_users(self):
+        for name in self._list_attribute('users', 'uid', 'usersign'):
+            yield User(name)
+
+    def _index_query(self, kwargs):
+        if 'id' in kwargs:
+            return self._index_query_id(kwargs.pop('id'))
+
+        bag_name = kwargs.pop('bag', None)
+        bid = None
+        if bag_name:
+            bid = self._id_for_entity('bag', bag_name, memo=True)
+            if not bid:
+                raise NoBagError('No bag while trying to query: %s'
+                        % bag_name)
+
+        built_indexes = self._built_indexes()
+        index_keys = []
+        for attribute, value in kwargs.items():
+            if attribute == 'tag' and 'tags' in built_indexes:
+                if bid:
+                    index_keys.append('bid:%s:tag:%s' % (bid, value))
+                else:
+                    index_keys.append('tags:%s:tids' % value)
+            elif bid and 'field:%s' % attribute in built_indexes:
+                index_keys.append('bid:%s:field:%s:%s'
+                        % (bid, attribute, value))
+            else:
+                raise FilterIndexRefused('no index for %s' % attribute)
+        if not index_keys:
+            raise FilterIndexRefused('nothing to query')
+
+        return self._tiddlers_for_tids(list(self.redis.sinter(index_keys)),
+                bag_name)
+
+    def _index_query_shards(self, kwargs):
+        """
+        Query the indexes of the shard of the bag, if one is given, or
+        otherwise of every shard.
+        """
+        if kwargs.get('bag'):
+            client = self.shards.client_for_bag(kwargs['bag'])
+            return node_iterator(self, client,
+                    on_node(self, client, self._index_query, kwargs))
+        queries = [(client, on_node(self, client, self._index_query,
+            dict(kwargs))) for client in self.shards.clients.values()]
+        return itertools.chain.from_iterable(
+                node_iterator(self, client, tiddlers)
+                for client, tiddlers in queries)
+
+    @measured
+    @reads
+    @on_bag_shard
+    def list_bag_tiddlers(self, bag):
+        bid = self._id_for_entity('bag', bag.name, memo=True)
+        if not bid:
+            raise NoBagError('No bag while trying to list tiddlers: %s'
+                    % bag.name)
+
+        for title in self._list_attribute('bid:%s:tiddlers' % bid, 'tid',
+                'title'):
+            yield Tiddler(title, bag.name)
+
+    @measured
+    @reads
+    @on_bag_shard
+    def list_tiddler_revisions(self, tiddler):
+        """
+        List the rvids of the tiddler's revisions, newest first, as a
+        sequence which reads them as they are used, see
+        tiddlywebplugins.redisstore.revisions.
+        """
+        return self._retry_with_fresh_ids(self._list_tiddler_revisions,
+                tiddler)
+
+    @measured
+    @reads
+    @on_bag_shard
+    def count_tiddler_revisions(self, tiddler):
+        """
+        Count the tiddler's revisions, without reading them.
+        """
+        return len(self._retry_with_fresh_ids(self._list_tiddler_revisions,
+                tiddler))
+
+    @measured
+    @reads
+    def recent_tiddlers(self, bag_names, count=None, start=0):
+        """
+        List the tiddlers of the named bags, most recently modified
+        first, skipping start of them and listing at most count, from
+        the recent index. As in a recipe, a tiddler hides those with the
+        same title in the bags before its own. Raise FilterIndexRefused
+        if the index is not built.
+        """
+        if 'recent' not in self._built_indexes():
+            raise FilterIndexRefused('no index for recent')
+        sources = []
+        for bag_name in bag_names:
+            client = self.redis
+            if self.shards is not None:
+                client = self.shards.client_for_bag(bag_name)
+            bid = on_node(self, client, self._id_for_entity, 'bag',
+                    bag_name, memo=True)
+            if not bid:
+                raise NoBagError('No bag while trying to list recent: %s'
+                        % bag_name)
+            sources.append((client, bag_name, bid))
+        return (Tiddler(title, bag_name) for title, bag_name
+                in merge_recent(self.layout, sources, start, count,
+                    self.options['scan_count']))
+
+    def recent_recipe_tiddlers(self, recipe, count=None, start=0):
+        """
+        List the tiddlers of the recipe's bags as recent_tiddlers does.
+        Raise FilterIndexRefused if the recipe filters its bags.
+        """
+        recipe = self.recipe_get(Recipe(recipe.name))
+        bags = recipe.get_recipe(recipe_template(self.environ))
+        if [bag for bag, filter_string in bags if filter_string]:
+            raise FilterIndexRefused('recipe %s has filters' % recipe.name)
+        return self.recent_tiddlers([bag for bag, _ in bags], count, start)
+
+    def _list_tiddler_revisions(self, tiddler, memo):
+        bid, tid = self._tid_for_tiddler(tiddler, memo)
+        if not tid:
+            raise NoTiddlerError('no such tiddler: %s:%s'
+                    % (tiddler.bag, tiddler.title))
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.llen('tid:%s:revisions' % tid)
+        bid_reader = self.layout.read_record(pipe, 'tid', tid, ['bid'])
+        results = iter(pipe.execute())
+        length = next(results)
+        if bid_reader(results)[0] != bid:
+            raise NoTiddlerError('no such tiddler: %s:%s'
+                    % (tiddler.bag, tiddler.title))
+        # the client is kept, as this may be running on a replica or a
+        # shard only until it returns
+        return RevisionList(self.redis, tid, length,
+                self.options['scan_count'])
+
+    def _decode_all(self, values):
+        return [self.redis.decode(value) for value in values]
+
+    def _delta_previous_revision(self, tiddler):
+        """
+        Rewrite the revision before the one just stored as a delta
+        against it, unless it is a keyframe, is of another type, so
+        perhaps binary, is not UTF-8 or the delta is no smaller.
+        """
+        previous = self.redis.scripts['revision_previous'](
+                keys=['tiddler:%s:%s:tid' % (tiddler.bag, tiddler.title)],
+                args=[tiddler.revision,
+                    self.options['delta_keyframe_interval']])
+        if not previous:
+            return
+        rvid, text, compression, previous_type, _ = previous
+        delta = self._revision_delta(decompress(text, compression),
+                previous_type, tiddler)
+        if delta:
+            self.redis.scripts['revision_delta'](args=[rvid] + delta
+                    + [tiddler.revision,
+                        self.options['delta_keyframe_interval']])
+
+    def _delta_revision_groups(self, groups):
+        """
+        Rewrite revisions as deltas as _delta_previous_revision would
+        have, had the revisions in groups been stored one at a time.
+        Each group is of revisions of one tiddler stored one after the
+        other, oldest first, the last its latest. The revision before
+        each group is read from redis, with the deltas before it, and
+        those in the group are delta'd from their texts here, in two
+        round trips for all the groups, and one to check the scripts.
+        Revisions whose text may be shared, or that are binary, are
+        left as they are.
+        """
+        interval = self.options['delta_keyframe_interval']
+        pipe = self.redis.pipeline(transaction=False)
+        for group in groups:
+            self.redis.scripts['revision_previous'](keys=['tiddler:%s:%s:tid'
+                % (group[0].bag, group[0].title)], args=[group[0].revision,
+                    interval, len(group)], client=pipe)
+        delta_pipe = self.redis.pipeline(transaction=False)
+        for group, previous in zip(groups, pipe.execute()):
+            older = None
+            if previous:
+                rvid, text, compression, previous_type, deltas = previous
+                older = (rvid, decompress(text, compression), previous_type,
+                        deltas)
+            for tiddler in group:
+                deltas = 0
+                delta = older and self._revision_delta(older[1], older[2],
+                        tiddler)
+                if delta:
+                    self.redis.scripts['revision_delta'](args=[older[0]]
+                            + delta + [tiddler.revision, interval],
+                            client=delta_pipe)
+                    deltas = older[3] + 1
+                older = None
+                text = tiddler.text or ''
+                if isinstance(text, unicode):
+                    text = text.encode('utf-8')
+                if (deltas < interval - 1 and not binary_tiddler(tiddler)
+                        and not (self.options['dedup_text']
+                        and text_digest(text,
+                            self.options['dedup_threshold']))):
+                    older = (tiddler.revision, text, tiddler.type, deltas)
+        if delta_pipe.command_stack:
+            delta_pipe.execute()
+
+    def _revision_delta(self, text, text_type, tiddler):
+        """
+        The delta, and its compression, to store in place of text, of
+        a revision of type text_type, against the tiddler stored after
+        it, or None if it is not to be delta'd.
+        """
+        if (binary_tiddler(tiddler)
+                or _text_type(text_type) != _text_type(tiddler.type)):
+            return None
+        new_text = tiddler.text or ''
+        if isinstance(new_text, unicode):
+            new_text = new_text.encode('utf-8')
+        try:
+            delta = make_delta(text, new_text)
+        except UnicodeDecodeError:
+            return None
+        if len(delta) >= len(text):
+            return None
+        return list(compress(delta, self.options['compression'],
+                self.options['compression_threshold'],
+                self.options['compression_level']))
+
+    def _revision_text(self, revision, rvid, shared=None):
+        """
+        The text of the revision, from shared, the shared text and its
+        compression, if the text is shared, or rebuilt from the
+        revisions after it if it is kept as a delta.
+        """
+        if revision['digest']:
+            if shared is None:
+                shared = self.redis.scripts['revision_shared_text'](
+                        args=[rvid])
+            if not shared:
+                raise NoTiddlerError('unable to load the text of %s' % rvid)
+            text = decompress(*shared)
+        else:
+            text = decompress(revision['text'], revision['compression'])
+        if not revision['delta']:
+            return text
+        chain = self.redis.scripts['revision_chain'](
+                args=[revision['delta'],
+                    self.options['delta_keyframe_interval']])
+        if not chain:
+            raise NoTiddlerError('unable to rebuild revision %s' % rvid)
+        texts = [decompress(value, compression) for value, compression
+                in zip(chain[::2], chain[1::2])]
+        # the last has its full text, the others are deltas against the
+        # one after them
+        full = texts.pop()
+        for delta in reversed([text] + texts):
+            full = apply_delta(delta, full)
+        return full
+
+    def _delete_bag_tiddlers(self, name, bid, chunk_size=None,
+            command='DEL', pause=0, fenced=True):
+        """
+        Delete the tiddlers in the bag, chunk_size (by default
+        delete_chunk_size) at a time, each chunk atomically in a server
+        side script, using command, DEL or UNLINK, and sleeping for
+        pause seconds between chunks. Unless the bag is tombstoned, and
+        so not fenced, raise BagMoved if it moves to another shard.
+        """
+        chunk_size = chunk_size or self.options['delete_chunk_size']
+        keys = []
+        if fenced:
+            keys.append(MOVED_KEY % name)
+        while True:
+            remaining = self.redis.scripts['bag_delete_tiddlers'](
+                    keys=keys, args=[bid, name, chunk_size, command])
+            if remaining < 0:
+                raise BagMoved('bag has moved: %s' % name)
+            LOGGER.debug('%s tiddlers left to delete from bag %s',
+                    remaining, name)
+            if not remaining:
+                break
+            time.sleep(pause)
+
+    def _delete_bag_record(self, bid, name=None):
+        """
+        Delete the record of a bag whose tiddlers are gone, and its
+        policy. If the bag has not been tombstoned, its name is given
+        to delete the key mapping the name to the bid.
+        """
+        pid = self._read_record('bid', bid, ['policy'])[0]
+
+        delete_keys = self.layout.record_keys('bid', bid, BAG_ATTRIBUTES)
+        delete_keys.extend(['bid:%s:tiddlers' % bid, 'bid:%s:recent' % bid])
+        if name is None:
+            pipe = self.redis.pipeline()
+        else:
+            pipe = self._bag_pipeline(name)
+            delete_keys.append('bag:%s:bid' % name)
+            self.cache.invalidate(pipe, 'bag:%s' % name)
+            self.cache.invalidate(pipe, 'bag:%s:bid' % name)
+        pipe.delete(*delete_keys)
+        self._delete_policy(pipe, pid)
+        pipe.srem('bags', bid)
+        pipe.srem('bags:tombstoned', bid)
+        pipe.execute()
+
+    def _built_indexes(self):
+        """
+        The names of the indexes which are complete and may be queried.
+        """
+        self._get_layout()
+        return self.primary.schema['indexes']
+
+    def _delete_policy(self, pipe, pid):
+        pipe.delete(*['pid:%s:%s' % (pid, item)
+            for item in Policy.attributes])
+
+    def _bag_pipeline(self, bag_name):
+        """
+        A transaction pipeline for changing the bag. On a sharded store
+        it watches the bag's moved key, so that it fails if the bag
+        starts moving before it is executed, and BagMoved is raised if
+        the bag is already moving.
+        """
+        pipe = self.redis.pipeline()
+        if self.shards is not None:
+            key = MOVED_KEY % bag_name
+            pipe.watch(key)
+            if pipe.exists(key):
+                pipe.reset()
+                raise BagMoved('bag has moved: %s' % bag_name)
+            pipe.multi()
+        return pipe
+
+    def _get_entity(self, key, loader):
+        """
+        Get a bag, recipe or user from the cache, calling loader on a
+        miss. Cached entities are loaded from the primary, as a replica
+        may not yet have the change which evicted the entity.
+        """
+        def load_from_primary():
+            client = getattr(self.reading, 'client', None)
+            self.reading.client = None
+            try:
+                return loader()
+            finally:
+                self.reading.client = client
+
+        if self.cache.entities.size:
+            return self.cache.entities.get(key, load_from_primary)
+        return self.cache.entities.get(key, loader)
+
+    def _get_layout(self):
+        """
+        Get the layout for the schema of the database, checking the
+        schema on the primary if it has not been checked recently.
+        """
+        schema = self.primary.schema
+        now = time.time()
+        if (schema['layout'] is None or now - schema['checked']
+                > self.options['schema_check_interval']):
+            version, target, indexes = read_schema(self.primary,
+                    self.options['schema'], self._index_names())
+            schema['layout'] = get_layout(version, target,
+                    self.primary.encoding)
+            schema['indexes'] = indexes
+            schema['checked'] = now
+        return schema['layout']
+
+    def _get_policy(self, pid):
+        policy = Policy()
+        if not pid:
+            return policy
+        pipe = self.redis.pipeline(transaction=False)
+        for constraint in Policy.attributes:
+            key = 'pid:%s:%s' % (pid, constraint)
+            if constraint == 'owner':
+                pipe.get(key)
+            else:
+                pipe.smembers(key)
+        for constraint, value in zip(Policy.attributes, pipe.execute()):
+            if constraint == 'owner':
+                policy.owner = self.redis.decode(value)
+                if policy.owner == '':
+                    policy.owner = None
+            else:
+                setattr(policy, constraint, self._decode_all(value))
+        return policy
+
+    def _entity_key(self, entity, name):
+        return '%s:%s:%s' % (entity, name, ENTITY_MAP[entity])
+
+    def _id_for_entity(self, entity, name, memo=False):
+        """
+        Return the id of the named entity, or None. If memo, use the
+        remembered id, if any. Ids are only remembered for reads, and
+        a read which finds the entity's record missing calls
+        _forget_id and tries again without the memo.
+        """
+        key = self._entity_key(entity, name)
+        if memo:
+            return self.cache.ids.get(key, lambda: self.redis.uget(key))
+        return self.redis.uget(key)
+
+    def _forget_id(self, entity, name, memo=True):
+        """
+        Forget the remembered id of the named entity, returning True
+        if there was one, which may have been stale.
+        """
+        return memo and self.cache.ids.forget(
+                [self._entity_key(entity, name)])
+
+    def _index_names(self):
+        """
+        The names of the indexes maintained by the store.
+        """
+        return list(INDEXES) + ['field:%s' % name
+                for name in self.options['indexed_fields']]
+
+    def _indexed_values(self, tiddler):
+        """
+        The names and values of the indexed fields the tiddler has.
+        """
+        indexed = []
+        for name in self.options['indexed_fields']:
+            if name in INDEXED_ATTRIBUTES:
+                value = getattr(tiddler, name)
+            else:
+                value = tiddler.fields.get(name)
+            if value is not None:
+                indexed.append((name, value))
+        return indexed
+
+    def _index_query_id(self, tiddler_id):
+        """
+        Yield the tiddler named by ``tiddler_id``, bag:title, if it
+        exists. Bag names and titles may contain ':' so each split is
+        tried.
+        """
+        parts = tiddler_id.split(':')
+        candidates = [(':'.join(parts[:index]), ':'.join(parts[index:]))
+                for index in range(1, len(parts))]
+        if self.shards is not None:
+            for bag_name, title in candidates:
+                if self.shards.client_for_bag(bag_name).get(
+                        'tiddler:%s:%s:tid' % (bag_name, title)):
+                    yield Tiddler(title, bag_name)
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for bag_name, title in candidates:
+            pipe.get('tiddler:%s:%s:tid' % (bag_name, title))
+        for (bag_name, title), tid in zip(candidates, pipe.execute()):
+            if tid:
+                yield Tiddler(title, bag_name)
+
+    def _list_sharded_bags(self):
+        """
+        Yield the names of the bags on each shard, skipping copies of
+        bags which are being moved.
+        """
+        for client in self.shards.clients.values():
+            names = on_node(self, client, self._list_attribute, 'bags',
+                    'bid', 'name')
+            for name in node_iterator(self, client, names):
+                if self.shards.client_for_bag(name) is client:
+                    yield name
+
+    def _list_attribute(self, set_key, kind, attribute):
+        """
+        Yield one attribute of each of the records whose ids are in the
+        set ``set_key``. The set is walked with SSCAN and the attribute
+        read for each chunk of ids in one round trip, so large sets are
+        not loaded all at once.
+        """
+        # SSCAN may return an id more than once if the set is rehashed
+        # while we walk it.
+        seen = set()
+        cursor = 0
+        while True:
+            cursor, entity_ids = self.redis.sscan(set_key, cursor,
+                    count=self.options['scan_count'])
+            entity_ids = [entity_id for entity_id in entity_ids
+                    if entity_id not in seen]
+            seen.update(entity_ids)
+            pipe = self.redis.pipeline(transaction=False)
+            reader = self.layout.read_attribute(pipe, kind, entity_ids,
+                    attribute)
+            for value in reader(iter(pipe.execute())):
+                # the record may have been deleted since the scan
+                if value is not None:
+                    yield self.redis.decode(value)
+            if not cursor:
+                break
+
+    def _new_tiddler_ids(self):
+        """
+        The tid for tiddler_put to give the tiddler if it is new, and
+        the rvid of the revision, or '' for the script to allocate
+        them. They are allocated on the coordinator of a sharded store,
+        and otherwise only taken here if allocated in blocks. The tid
+        is to be given back to the allocator if the tiddler was not
+        new.
+        """
+        counters = [TIDDLER_COUNTER, REVISION_COUNTER]
+        if self.shards is None:
+            counters = [counter for counter in counters
+                    if self.allocator.blocked(counter)]
+        ids = dict(zip(counters, self.allocator.take(counters)))
+        return [ids.get(TIDDLER_COUNTER, ''), ids.get(REVISION_COUNTER, '')]
+
+    def _nodes(self):
+        """
+        The clients of all the servers of the store, the primary, or
+        coordinator, first.
+        """
+        if self.shards is None:
+            return [self.primary]
+        return [self.primary] + self.shards.clients.values()
+
+    def _read_bag(self, name, memo=True):
+        """
+        Read the description and policy of a bag.
+        """
+        bid = self._id_for_entity('bag', name, memo)
+        if not bid:
+            raise NoBagError('unable to get id for %s' % name)
+
+        stored_name, desc, pid = self._read_record('bid', bid,
+                ['name', 'desc', 'policy'])
+        if stored_name is None and self._forget_id('bag', name, memo):
+            return self._read_bag(name, False)
+        return desc, self._get_policy(pid)
+
+    def _read_recipe(self, name, memo=True):
+        """
+        Read the description, policy and recipe items of a recipe.
+        """
+        rid = self._id_for_entity('recipe', name, memo)
+        if not rid:
+            raise NoRecipeError('unable to get id for %s' % name)
+
+        pipe = self.redis.pipeline(transaction=False)
+        reader = self.layout.read_record(pipe, 'rid', rid,
+                ['name', 'desc', 'policy'])
+        pipe.lrange('rid:%s:rlist' % rid, 0, -1)
+        results = iter(pipe.execute())
+        stored_name, desc, pid = self._decode_all(reader(results))
+        recipe_list = self._decode_all(next(results))
+        if stored_name is None and self._forget_id('recipe', name, memo):
+            return self._read_recipe(name, False)
+
+        recipe_items = []
+        for bag_filter in recipe_list:
+            bag, filter_string = bag_filter.split('?', 1)
+            recipe_items.append((bag, filter_string))
+        return desc, self._get_policy(pid), tuple(recipe_items)
+
+    def _read_user(self, usersign, memo=True):
+        """
+        Read the password, note and roles of a user.
+        """
+        uid = self._id_for_entity('user', usersign, memo)
+        if not uid:
+            raise NoUserError('no user found for %s' % usersign)
+
+        pipe = self.redis.pipeline(transaction=False)
+        reader = self.layout.read_record(pipe, 'uid', uid,
+                ['usersign', 'password', 'note'])
+        pipe.smembers('uid:%s:roles' % uid)
+        results = iter(pipe.execute())
+        stored_usersign, password, note = self._decode_all(reader(results))
+        roles = tuple(self._decode_all(next(results)))
+        if stored_usersign is None and self._forget_id('user', usersign,
+                memo):
+            return self._read_user(usersign, False)
+        return password, note, roles
+
+    def _read_record(self, kind, entity_id, attributes):
+        """
+        Read and decode the named attributes of one record.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        reader = self.layout.read_record(pipe, kind, entity_id, attributes)
+        return self._decode_all(reader(iter(pipe.execute())))
+
+    def _set_policy(self, pipe, container_policy, pid):
+        if not pid:
+            pid = self.allocator.next('ids:nextPolicyID')
+        for constraint in Policy.attributes:
+            key = 'pid:%s:%s' % (pid, constraint)
+            if constraint == 'owner':
+                if container_policy.owner:
+                    pipe.set(key, container_policy.owner)
+                else:
+                    pipe.set(key, '')
+            else:
+                pipe.delete(key)
+                for member in getattr(container_policy, constraint):
+                    pipe.sadd(key, member)
+        return pid
+
+    def _tiddlers_for_tids(self, tids, bag_name=None):
+        """
+        Yield a Tiddler for each tid, with its title and bag. If
+        ``bag_name`` is given, all the tiddlers are in that bag.
+        Otherwise tiddlers in tombstoned bags are skipped.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        title_reader = self.layout.read_attribute(pipe, 'tid', tids, 'title')
+        bid_reader = self.layout.read_attribute(pipe, 'tid', tids, 'bid')
+        results = iter(pipe.execute())
+        titles = title_reader(results)
+        bids = bid_reader(results)
+
+        bag_names = {}
+        if not bag_name:
+            unique_bids = list(set(bid for bid in bids if bid))
+            name_reader = self.layout.read_attribute(pipe, 'bid',
+                    unique_bids, 'name')
+            for bid in unique_bids:
+                pipe.sismember('bags:tombstoned', bid)
+            results = iter(pipe.execute())
+            names = self._decode_all(name_reader(results))
+            bag_names = dict((bid, name) for bid, name, tombstoned
+                    in zip(unique_bids, names, results) if not tombstoned)
+
+        for title, bid in zip(titles, bids):
+            if title is None or not (bag_name or bid in bag_names):
+                continue
+            yield Tiddler(self.redis.decode(title),
+                    bag_name or bag_names.get(bid))
+
+    def _tiddler_put_arguments(self, tiddler, ids):
+        """
+        The keys and args of the tiddler_put script storing the tiddler,
+        with ids, the tid to give it if it is new and the rvid of the
+        revision, or '' for the script to allocate them.
+        """
+        text, compression = compress(tiddler.text,
+                self.options['compression'],
+                self.options['compression_threshold'],
+                self.options['compression_level'])
+        digest = ''
+        if self.options['dedup_text']:
+            digest = text_digest(tiddler.text,
+                    self.options['dedup_threshold'])
+        args = [self.layout.version]
+        args.extend(ids)
+        args.extend([tiddler.title, text, tiddler.modifier,
+            tiddler.modified, tiddler.type, compression, digest])
+        if self.options['retention_trim_size']:
+            args.extend(self._retention(tiddler.bag))
+        else:
+            args.extend([0, ''])
+        args.extend([self.options['retention_trim_size'], len(tiddler.tags)])
+        args.extend(tiddler.tags)
+        fields = [field for field in tiddler.fields.keys()
+                if not field.startswith('server.')]
+        args.append(len(fields))
+        for field in fields:
+            args.extend([field, tiddler.fields[field]])
+        indexed = self._indexed_values(tiddler)
+        args.append(len(indexed))
+        for name, value in indexed:
+            args.extend([name, value])
+        keys = ['bag:%s:bid' % tiddler.bag,
+                'tiddler:%s:%s:tid' % (tiddler.bag, tiddler.title),
+                MOVED_KEY % tiddler.bag]
+        return keys, args
+
+    def _retention(self, bag_name):
+        """
+        How many revisions of the tiddlers in the bag to keep, 0 for
+        all, and the modified time before which not to keep them, ''
+        for none.
+        """
+        retention = self.options['bag_retention'].get(bag_name, {})
+        keep = retention.get('revisions', self.options['retain_revisions'])
+        seconds = retention.get('seconds', self.options['retain_seconds'])
+        cutoff = ''
+        if seconds:
+            cutoff = time.strftime('%Y%m%d%H%M%S',
+                    time.gmtime(time.time() - seconds))
+        return [keep or 0, cutoff]
+
+    def _tiddler_put_done(self, tiddler, result):
+        """
+        Check the result of the tiddler_put script storing the tiddler,
+        and give the tiddler its new revision.
+        """
+        if result == -1:
+            raise BagMoved('bag has moved: %s' % tiddler.bag)
+        if not result:
+            raise NoBagError('No bag while trying to put tiddler: %s:%s'
+                    % (tiddler.bag, tiddler.title))
+        tiddler.revision = result[0]
+
+    def _tid_for_tiddler(self, tiddler, memo=False):
+        """
+        Return the bid of the tiddler's bag and the tid of the tiddler,
+        None if there is no such tiddler. If memo, use the remembered
+        ids, if any.
+
+        The tid may be left over from a tombstoned bag of the same
+        name, so callers must check it is in the bag. If there is a tid
+        and no bag, the bag is tombstoned and NoBagError is raised.
+        """
+        keys = ['bag:%s:bid' % tiddler.bag,
+                'tiddler:%s:%s:tid' % (tiddler.bag, tiddler.title)]
+        if memo:
+            bid, tid = self.cache.ids.get_many(keys, self._get_ids)
+        else:
+            bid, tid = self._get_ids(keys)
+        if tid and not bid:
+            raise NoBagError('bag has been deleted: %s:%s'
+                    % (tiddler.bag, tiddler.title))
+        return bid, tid
+
+    def _get_ids(self, keys):
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        return pipe.execute()
+
+    def _retry_with_fresh_ids(self, method, tiddler):
+        """
+        Call method with the tiddler, using remembered ids. If the
+        tiddler or its bag is missing and its tid was remembered, the
+        ids may be stale, so forget them and call it again without.
+        """
+        try:
+            return method(tiddler, True)
+        except (NoBagError, NoTiddlerError):
+            ids = self.cache.ids
+            if not ids.forget(['tiddler:%s:%s:tid'
+                    % (tiddler.bag, tiddler.title)]):
+                raise
+            ids.forget(['bag:%s:bid' % tiddler.bag])
+        return method(tiddler, False)
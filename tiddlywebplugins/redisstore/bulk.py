@@ -0,0 +1,388 @@
+"""
+Loading a whole TiddlyWeb instance into the store, and dumping one
+out, used by the twanager commands redisimport and redisexport.
+
+Both stream: records are read, and written, in batches of batch_size
+tiddler revisions, and each batch is logged as progress. So that an
+export can carry on from its checkpoint, entities are taken in order
+of name, which means holding the names of all the users, recipes and
+bags, and the titles of the bag being read, at once: memory grows
+with those, and with the largest bag, but not with the revisions or
+text of the instance.
+
+A dump has one JSON object per line, with 'kind' one of user, recipe,
+bag or tiddler. Users come first, then recipes, then each bag followed
+by the revisions of its tiddlers, oldest first. Binary tiddler text
+is base64 encoded, with 'encoding' set to 'base64'.
+
+The revisions of a batch are written by the tiddler_put script in one
+pipeline on each server, with their tids and rvids taken from blocks
+allocated by one INCRBY of each counter. Only the first revision of
+each tiddler in the batch is given a tid, and those of tiddlers which
+were not new are given back to the store's allocator. How many
+records of a source have been imported is kept in the key
+import:#source:done, set in the same transaction as the batch, so an
+interrupted import carries on where it left off when run again. On a
+sharded store the batch is written to each shard before the count is,
+so at most one batch may be written twice. With revision_deltas set,
+the revisions a batch writes of each tiddler are then rewritten as
+deltas, as they would have been put one at a time, in two more round
+trips.
+
+An export keeps the bag and title of the last tiddler written, and
+the length of the dump then, in a checkpoint file, dump.checkpoint,
+from which an interrupted export carries on.
+"""
+
+import json
+import logging
+import os
+import time
+
+from base64 import b64decode, b64encode
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.policy import Policy
+from tiddlyweb.model.recipe import Recipe
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.user import User
+from tiddlyweb.stores.text import Store as TextStore
+from tiddlyweb.util import binary_tiddler
+
+from tiddlywebplugins.redisstore import STALE_REVISION, tiddler_created
+from tiddlywebplugins.redisstore.ids import REVISION_COUNTER, TIDDLER_COUNTER
+from tiddlywebplugins.redisstore.shard import on_node
+
+
+LOGGER = logging.getLogger(__name__)
+
+# The key counting the records imported from a source.
+IMPORTED_KEY = 'import:%s:done'
+
+# The suffix of the checkpoint file of a dump.
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+def entity_record(entity):
+    """
+    The dump record of a user, recipe, bag or tiddler.
+    """
+    if isinstance(entity, Tiddler):
+        record = {'kind': 'tiddler', 'bag': entity.bag,
+                'title': entity.title, 'modifier': entity.modifier,
+                'modified': entity.modified, 'type': entity.type,
+                'tags': entity.tags, 'fields': dict((key, value)
+                    for key, value in entity.fields.items()
+                    if not key.startswith('server.'))}
+        if binary_tiddler(entity):
+            record['text'] = b64encode(entity.text)
+            record['encoding'] = 'base64'
+        else:
+            record['text'] = entity.text
+        return record
+    if isinstance(entity, User):
+        return {'kind': 'user', 'usersign': entity.usersign,
+                'password': entity._password, 'note': entity.note,
+                'roles': entity.list_roles()}
+    record = {'kind': entity.__class__.__name__.lower(),
+            'name': entity.name, 'desc': entity.desc,
+            'policy': dict((constraint, getattr(entity.policy, constraint))
+                for constraint in Policy.attributes)}
+    if isinstance(entity, Recipe):
+        record['recipe'] = entity.get_recipe()
+    return record
+
+
+def record_entity(record):
+    """
+    The user, recipe, bag or tiddler of a dump record.
+    """
+    kind = record['kind']
+    if kind == 'tiddler':
+        tiddler = Tiddler(record['title'], record['bag'])
+        for attribute in ['modifier', 'modified', 'type', 'tags', 'fields']:
+            setattr(tiddler, attribute, record[attribute])
+        if record.get('encoding') == 'base64':
+            tiddler.text = b64decode(record['text'])
+        else:
+            tiddler.text = record['text']
+        return tiddler
+    if kind == 'user':
+        user = User(record['usersign'], note=record['note'])
+        user._password = record['password']
+        for role in record['roles']:
+            user.add_role(role)
+        return user
+    if kind == 'recipe':
+        entity = Recipe(record['name'])
+        entity.set_recipe(record['recipe'])
+    elif kind == 'bag':
+        entity = Bag(record['name'])
+    else:
+        raise ValueError('unknown kind of record: %s' % kind)
+    entity.desc = record['desc']
+    for constraint, value in record['policy'].items():
+        setattr(entity.policy, constraint, value)
+    return entity
+
+
+def dump_source(path, start=0):
+    """
+    Yield the entities of the dump at path, after the first start.
+    """
+    with open(path) as dump:
+        for line in dump:
+            if start:
+                start -= 1
+                continue
+            yield record_entity(json.loads(line))
+
+
+def text_source(store_root, start=0, environ=None):
+    """
+    Yield the users, recipes, bags and tiddler revisions, oldest first,
+    of the text store in the directory store_root, after the first
+    start.
+    """
+    store = TextStore({'store_root': os.path.abspath(store_root)},
+            environ or {})
+    for entity in _instance_entities(store):
+        if not isinstance(entity, Tiddler):
+            if start:
+                start -= 1
+            else:
+                yield _call(store, 'get', entity)
+            continue
+        revisions = store.list_tiddler_revisions(entity)
+        if start >= len(revisions):
+            start -= len(revisions)
+            continue
+        for revision in reversed(revisions[:len(revisions) - start]):
+            tiddler = Tiddler(entity.title, entity.bag)
+            tiddler.revision = revision
+            yield store.tiddler_get(tiddler)
+        start = 0
+
+
+def _call(storage, action, entity):
+    """
+    Call the method of storage which does action to entity, a user,
+    recipe, bag or tiddler.
+    """
+    return getattr(storage, '%s_%s' % (entity.__class__.__name__.lower(),
+        action))(entity)
+
+
+def _instance_entities(store):
+    """
+    Yield the users, recipes and bags of the storage, each bag followed
+    by its tiddlers, in order of name. Only the names are sorted, and
+    each entity is made as it is yielded.
+    """
+    for usersign in sorted(user.usersign for user in store.list_users()):
+        yield User(usersign)
+    for name in sorted(recipe.name for recipe in store.list_recipes()):
+        yield Recipe(name)
+    for name in sorted(bag.name for bag in store.list_bags()):
+        bag = Bag(name)
+        yield bag
+        for title in sorted(tiddler.title
+                for tiddler in store.list_bag_tiddlers(bag)):
+            yield Tiddler(title, name)
+
+
+def import_source(storage, source, batch_size=1000):
+    """
+    Import the users, recipes, bags and tiddlers of source, a text
+    store directory or a dump, into the store of storage, carrying on
+    from where an earlier import of it left off.
+    """
+    source = os.path.abspath(source)
+    imported_key = IMPORTED_KEY % source
+    done = int(storage.primary.get(imported_key) or 0)
+    if done:
+        LOGGER.info('carrying on after %s records of %s', done, source)
+    if os.path.isdir(source):
+        entities = text_source(source, done, storage.environ)
+    else:
+        entities = dump_source(source, done)
+
+    started = time.time()
+    tiddlers = []
+    for entity in entities:
+        done += 1
+        if not isinstance(entity, Tiddler):
+            _call(storage, 'put', entity)
+            continue
+        tiddlers.append(entity)
+        if len(tiddlers) >= batch_size:
+            _put_tiddlers(storage, tiddlers, imported_key, done)
+            _progress('imported', done, started)
+            tiddlers = []
+    _put_tiddlers(storage, tiddlers, imported_key, done)
+    _progress('imported', done, started)
+
+
+def _put_tiddlers(storage, tiddlers, imported_key, done):
+    """
+    Store a revision of each of the tiddlers, and record that done
+    records of the source have been imported, then, if revision_deltas
+    is set, delta the revisions stored.
+    """
+    # the later revisions of a tiddler in the batch take its tid from
+    # the first
+    firsts = [index == 0 or (tiddler.bag, tiddler.title) != (
+        tiddlers[index - 1].bag, tiddlers[index - 1].title)
+        for index, tiddler in enumerate(tiddlers)]
+    pipe = storage.primary.pipeline(transaction=False)
+    pipe.incrby(TIDDLER_COUNTER, firsts.count(True))
+    pipe.incrby(REVISION_COUNTER, len(tiddlers))
+    last_tid, last_rvid = pipe.execute()
+    tids = iter(range(last_tid - firsts.count(True) + 1, last_tid + 1))
+
+    pipes = {}
+    puts = []
+    for index, tiddler in enumerate(tiddlers):
+        ids = ['', last_rvid - len(tiddlers) + index + 1]
+        if firsts[index]:
+            ids[0] = next(tids)
+        if storage.shards is None:
+            client = storage.primary
+        else:
+            client = storage.shards.client_for_bag(tiddler.bag)
+        if client not in pipes:
+            pipes[client] = client.pipeline()
+        keys, args = storage._tiddler_put_arguments(tiddler, ids)
+        client.scripts['tiddler_put'](keys=keys, args=args,
+                client=pipes[client])
+        puts.append((tiddler, pipes[client], ids[0]))
+
+    primary = pipes.pop(storage.primary, None) or storage.primary.pipeline()
+    primary.set(imported_key, done)
+    results = dict((pipe, iter(pipe.execute())) for pipe in pipes.values())
+    results[primary] = iter(primary.execute())
+    groups = []
+    stale = set()
+    for tiddler, pipe, tid in puts:
+        result = next(results[pipe])
+        if tid != '' and not tiddler_created(result):
+            storage.allocator.give_back(TIDDLER_COUNTER, tid)
+        if result == STALE_REVISION:
+            # a later revision was stored meanwhile, by another process
+            storage.tiddler_put(tiddler)
+            stale.add((tiddler.bag, tiddler.title))
+            continue
+        storage._tiddler_put_done(tiddler, result)
+        if (groups and groups[-1][0] == pipe
+                and groups[-1][1][-1].bag == tiddler.bag
+                and groups[-1][1][-1].title == tiddler.title):
+            groups[-1][1].append(tiddler)
+        else:
+            groups.append((pipe, [tiddler]))
+
+    if storage.options['revision_deltas']:
+        _delta_groups(storage, [(pipe, group) for pipe, group in groups
+            if (group[0].bag, group[0].title) not in stale],
+            dict((pipe, client) for client, pipe in pipes.items()))
+
+
+def _delta_groups(storage, groups, clients):
+    """
+    Have the revisions of each group, stored of one tiddler by a pipe,
+    rewritten as deltas on the server of the pipe.
+    """
+    by_client = {}
+    for pipe, group in groups:
+        by_client.setdefault(clients.get(pipe, storage.primary),
+                []).append(group)
+    for client, client_groups in by_client.items():
+        on_node(storage, client, storage._delta_revision_groups,
+                client_groups)
+
+
+def export_dump(storage, path, batch_size=1000):
+    """
+    Write the users, recipes, bags and tiddler revisions of the store
+    of storage to the dump at path, carrying on from the checkpoint of
+    an earlier export to it, if any.
+    """
+    checkpoint_path = path + CHECKPOINT_SUFFIX
+    checkpoint = None
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        LOGGER.info('carrying on after tiddler %s in bag %s',
+                checkpoint['title'], checkpoint['bag'])
+        dump = open(path, 'r+')
+        dump.truncate(checkpoint['offset'])
+        dump.seek(checkpoint['offset'])
+    else:
+        dump = open(path, 'w')
+
+    started = time.time()
+    done = 0
+    batch = 0
+    with dump:
+        for entity in _export_entities(storage, checkpoint):
+            if not isinstance(entity, Tiddler):
+                _write_record(dump, _call(storage, 'get', entity))
+                done += 1
+                continue
+            revisions = storage.list_tiddler_revisions(entity)
+            for revision in reversed(revisions):
+                tiddler = Tiddler(entity.title, entity.bag)
+                tiddler.revision = revision
+                _write_record(dump, storage.tiddler_get(tiddler))
+            done += len(revisions)
+            batch += len(revisions)
+            if batch >= batch_size:
+                _write_checkpoint(dump, checkpoint_path, entity)
+                _progress('exported', done, started)
+                batch = 0
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    _progress('exported', done, started)
+
+
+def _export_entities(storage, checkpoint):
+    """
+    Yield the entities of the store, skipping those before the
+    checkpoint.
+    """
+    for entity in _instance_entities(storage):
+        if checkpoint is None:
+            yield entity
+            continue
+        if isinstance(entity, Tiddler):
+            position = (entity.bag, entity.title)
+        elif isinstance(entity, Bag):
+            position = (entity.name, '')
+        else:
+            continue
+        if position > (checkpoint['bag'], checkpoint['title']):
+            yield entity
+
+
+def _write_record(dump, entity):
+    dump.write(json.dumps(entity_record(entity)))
+    dump.write('\n')
+
+
+def _write_checkpoint(dump, checkpoint_path, tiddler):
+    """
+    Record that the dump holds everything up to the tiddler, once it
+    is on disk, replacing the checkpoint file atomically.
+    """
+    dump.flush()
+    os.fsync(dump.fileno())
+    partial_path = checkpoint_path + '.new'
+    with open(partial_path, 'w') as checkpoint_file:
+        json.dump({'bag': tiddler.bag, 'title': tiddler.title,
+            'offset': dump.tell()}, checkpoint_file)
+    os.rename(partial_path, checkpoint_path)
+
+
+def _progress(action, done, started):
+    elapsed = time.time() - started
+    LOGGER.info('%s %s records in %.1fs, %.0f a second', action, done,
+            elapsed, elapsed and done / elapsed)
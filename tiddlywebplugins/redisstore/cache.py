@@ -0,0 +1,187 @@
+"""
+In-process caches of bags, recipes and users, which are read on
+nearly every request and rarely change, and of the ids of named
+entities, which never change until the entity is deleted.
+
+A process has one set of caches for each store configuration, shared
+by its Store instances. Entries are evicted when least recently used,
+when older than a time to live, and when a message naming them arrives
+on the invalidation channel. Stores publish such a message whenever
+they change or delete an entity, in the same pipeline as the change,
+so every process drops its stale copy. A sharded store publishes on
+the server changed, so the caches listen on every server.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from redis.exceptions import ConnectionError
+
+
+LOGGER = logging.getLogger(__name__)
+
+CHANNEL = 'redisstore:invalidate'
+
+# The caches of this process, by servers, size and time to live, see
+# get_cache.
+CACHES = {'pid': None, 'caches': {}}
+
+
+class LRUCache(object):
+    """
+    A mapping of at most ``size`` entries, each kept for at most
+    ``ttl`` seconds. A size of 0 keeps nothing.
+    """
+
+    def __init__(self, size=1000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # counts evictions and clears, so that a value loaded while
+        # its key was invalidated is not kept
+        self.generation = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0,
+                'invalidations': 0}
+
+    def get(self, key, loader):
+        """
+        Return the value for key, calling loader to get it on a miss.
+        Exceptions from loader are raised and nothing is cached.
+        """
+        return self.get_many([key], lambda keys: [loader()])[0]
+
+    def get_many(self, keys, loader):
+        """
+        Return the values for keys, calling loader with a list of the
+        keys missed to get a list of their values. None is not cached.
+        """
+        values = {}
+        with self.lock:
+            now = time.time()
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry and entry[0] > now:
+                    self.entries[key] = entry
+                    values[key] = entry[1]
+            self.stats['hits'] += len(values)
+            missed = [key for key in keys if key not in values]
+            self.stats['misses'] += len(missed)
+            generation = self.generation
+
+        if missed:
+            loaded = dict(zip(missed, loader(missed)))
+            values.update(loaded)
+            self._put(loaded, generation)
+        return [values[key] for key in keys]
+
+    def forget(self, keys):
+        """
+        Evict keys here only, returning True if any were cached.
+        """
+        with self.lock:
+            self.generation += 1
+            return bool([self.entries.pop(key, None) for key in keys
+                if key in self.entries])
+
+    def _put(self, values, generation):
+        with self.lock:
+            if not self.size or generation != self.generation:
+                return
+            expires = time.time() + self.ttl
+            for key, value in values.items():
+                if value is not None:
+                    self.entries[key] = (expires, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def evict(self, key):
+        with self.lock:
+            self.generation += 1
+            self.stats['invalidations'] += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+class StoreCache(object):
+    """
+    The caches of a process: ``entities`` of bags, recipes and users
+    and ``ids`` of the keys mapping names to ids. Listens for
+    invalidation messages from each of the ``nodes``, the clients of
+    the servers of the store, in a thread for each, if either caches
+    anything, and publishes them.
+    """
+
+    def __init__(self, nodes, size=1000, ttl=60, id_size=0):
+        self.entities = LRUCache(size, ttl)
+        self.ids = LRUCache(id_size, ttl)
+        if size or id_size:
+            for node in nodes:
+                listener = threading.Thread(target=self._listen,
+                        args=(node, self._subscribe(node)),
+                        name='redisstore-invalidate')
+                listener.daemon = True
+                listener.start()
+
+    def invalidate(self, pipe, key):
+        """
+        Evict key here and queue a message on pipe to evict it in
+        every other process.
+        """
+        self.evict(key)
+        pipe.publish(CHANNEL, key)
+
+    def evict(self, key):
+        self.entities.evict(key)
+        self.ids.evict(key)
+
+    def clear(self):
+        self.entities.clear()
+        self.ids.clear()
+
+    def _subscribe(self, node):
+        pubsub = node.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CHANNEL)
+        return pubsub
+
+    def _listen(self, node, pubsub):
+        while True:
+            try:
+                for message in pubsub.listen():
+                    self.evict(message['data'].decode(node.encoding))
+            except ConnectionError as exc:
+                LOGGER.warning('lost invalidation channel: %s', exc)
+                time.sleep(1)
+                try:
+                    pubsub = self._subscribe(node)
+                except ConnectionError:
+                    continue
+            # messages may have been missed while not subscribed
+            self.clear()
+
+
+def get_cache(nodes, size, ttl, id_size=0):
+    """
+    Return the caches of this process for the servers with clients
+    ``nodes``, with the given sizes and time to live. A process forked
+    from one which already had caches gets new ones, as the listening
+    threads are not copied.
+    """
+    pid = os.getpid()
+    if CACHES['pid'] != pid:
+        CACHES['caches'] = {}
+        CACHES['pid'] = pid
+    caches = CACHES['caches']
+    config = (tuple(nodes), size, ttl, id_size)
+    if config not in caches:
+        caches[config] = StoreCache(nodes, size, ttl, id_size)
+    return caches[config]
@@ -0,0 +1,69 @@
+"""
+Compressing the text of tiddler revisions.
+
+With the 'compression' store option set to a codec, 'zlib' or 'lz4',
+the text of a revision at least 'compression_threshold' bytes long is
+stored compressed at 'compression_level', if that makes it smaller.
+The revision's 'compression' attribute names the codec, so revisions
+stored without it, before or since, are read as they are. Text is
+compressed as UTF-8, or as it is for binary tiddlers.
+
+lz4 needs the lz4 package.
+"""
+
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+def _lz4_compress(value, level):
+    return lz4.frame.compress(value, compression_level=level)
+
+
+def _lz4_decompress(value):
+    return lz4.frame.decompress(value)
+
+
+# The compress and decompress functions of each codec.
+CODECS = {
+        'zlib': (zlib.compress, zlib.decompress),
+        'lz4': (_lz4_compress, _lz4_decompress),
+        }
+
+
+def check_codec(codec):
+    """
+    Raise ValueError if codec, if set, cannot be used.
+    """
+    if codec and codec not in CODECS:
+        raise ValueError('unknown compression: %s' % codec)
+    if codec == 'lz4' and lz4 is None:
+        raise ValueError('lz4 compression needs the lz4 package')
+
+
+def compress(text, codec, threshold, level):
+    """
+    Return the value to store for text, and the codec it is compressed
+    with, or '' if it is not.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    if not codec or text is None or len(text) < threshold:
+        return text, ''
+    compressed = CODECS[codec][0](text, level)
+    if len(compressed) >= len(text):
+        return text, ''
+    return compressed, codec
+
+
+def decompress(value, codec):
+    """
+    Return the text stored as value, compressed with codec if set.
+    """
+    if not codec or value is None:
+        return value
+    check_codec(codec)
+    return CODECS[codec][1](value)
@@ -0,0 +1,127 @@
+"""
+The redis clients used by stores, one per process for each connection
+configuration, with connection pools which are safe across fork.
+
+redis-py notices when its pool is used in a process forked from the
+one which made it, and disconnects the inherited connections. That
+shuts down sockets the parent is still using. The pools here instead
+drop the inherited connections without touching their sockets, and
+start afresh.
+
+The connection configuration is the store config without the store
+options. As well as the settings of redis.Redis (host, port, db,
+password, socket_timeout, socket_connect_timeout, socket_keepalive,
+socket_keepalive_options, unix_socket_path, retry_on_timeout) it may
+have:
+
+    max_connections: the most connections the pool will open
+    pool_timeout: if set, wait up to this many seconds for a free
+                  connection when max_connections are in use, rather
+                  than fail
+"""
+
+import os
+
+from redis.connection import (BlockingConnectionPool, ConnectionPool,
+        UnixDomainSocketConnection)
+
+
+# The clients of this process by their connection configuration.
+CLIENTS = {}
+
+# Settings which only apply to TCP connections.
+TCP_SETTINGS = ['host', 'port', 'socket_connect_timeout',
+        'socket_keepalive', 'socket_keepalive_options']
+
+# Settings which locate a server, which the configuration of another
+# server of the store, a replica or shard, does not inherit.
+LOCATION_SETTINGS = ['host', 'port', 'unix_socket_path']
+
+
+def _abandon(connection):
+    """
+    Forget the socket of a connection inherited from the parent
+    process, closing only this process's copy of it.
+    """
+    connection._parser.on_disconnect()
+    connection._sock = None
+
+
+class ForkSafeConnectionPool(ConnectionPool):
+    """
+    A ConnectionPool which abandons, rather than disconnects, the
+    connections made in the parent of a forked process.
+    """
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            with self._check_lock:
+                if self.pid == os.getpid():
+                    return
+                for connection in (self._available_connections
+                        + list(self._in_use_connections)):
+                    _abandon(connection)
+                self.reset()
+
+
+class ForkSafeBlockingConnectionPool(BlockingConnectionPool):
+    """
+    A BlockingConnectionPool which abandons, rather than disconnects,
+    the connections made in the parent of a forked process.
+    """
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            with self._check_lock:
+                if self.pid == os.getpid():
+                    return
+                for connection in self._connections:
+                    _abandon(connection)
+                self.reset()
+
+
+def make_pool(redis_config):
+    """
+    Make a connection pool for the connection configuration.
+    """
+    kwargs = dict(redis_config)
+    max_connections = kwargs.pop('max_connections', None)
+    pool_timeout = kwargs.pop('pool_timeout', None)
+    path = kwargs.pop('unix_socket_path', None)
+    kwargs.setdefault('db', 0)
+    if path:
+        for setting in TCP_SETTINGS:
+            kwargs.pop(setting, None)
+        kwargs['path'] = path
+        kwargs['connection_class'] = UnixDomainSocketConnection
+    else:
+        kwargs.setdefault('host', 'localhost')
+        kwargs.setdefault('port', 6379)
+    if pool_timeout is not None:
+        return ForkSafeBlockingConnectionPool(
+                max_connections=max_connections or 50,
+                timeout=pool_timeout, **kwargs)
+    return ForkSafeConnectionPool(max_connections=max_connections, **kwargs)
+
+
+def server_config(redis_config, server):
+    """
+    The connection configuration of another server of the store, a
+    replica or shard configured by the dict ``server``, which has the
+    settings in redis_config other than those locating the server.
+    """
+    config = dict((key, value) for key, value in redis_config.items()
+            if key not in LOCATION_SETTINGS)
+    config.update(server)
+    return config
+
+
+def get_client(client_class, redis_config):
+    """
+    Return the client of class client_class for the connection
+    configuration, making it and its pool the first time.
+    """
+    key = (client_class, repr(sorted(redis_config.items())))
+    if key not in CLIENTS:
+        CLIENTS[key] = client_class(connection_pool=make_pool(redis_config))
+    return CLIENTS[key]
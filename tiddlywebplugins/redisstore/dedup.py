@@ -0,0 +1,35 @@
+"""
+Sharing the text of revisions which have the same text.
+
+With the 'dedup_text' store option set, text at least 'dedup_threshold'
+bytes long is stored once on each server, in a hash named for the SHA1
+digest of the text, ``text:#digest``, with its compression and
+``refs``, the number of revisions referring to it. Such a revision has
+a 'digest' attribute in place of its text and compression. Revisions
+which change only tags or fields, and copies of a tiddler in other
+bags, then share one copy of the text.
+
+References are dropped, and a text nothing refers to is deleted, in
+the same scripts which delete or trim revisions or rewrite them as
+deltas, so the counts cannot drift. A revision whose text is shared
+with others is not rewritten as a delta.
+
+Reading a tiddler gets the shared text in the same round trip as the
+revision. Revisions stored before the option was set keep their own
+text, and shared texts are read whether or not it is set, with another
+round trip if it is not.
+"""
+
+import hashlib
+
+
+def text_digest(text, threshold):
+    """
+    Return the digest to share text under, or '' if it is too short
+    to share.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    if text is None or len(text) < threshold:
+        return ''
+    return hashlib.sha1(text).hexdigest()
@@ -0,0 +1,66 @@
+"""
+Keeping older revisions of a tiddler as differences from the next.
+
+With the 'revision_deltas' store option set, when a revision is stored
+the one before it, which was the tiddler's latest and so held its full
+text, is rewritten as a delta against the new one, unless it is a
+keyframe: a revision following 'delta_keyframe_interval' - 1 deltas
+keeps its full text. Keyframes are found from the deltas before them,
+so trimming the oldest revisions, which are deltas against newer ones,
+does not lengthen the chains. The revision's 'delta' attribute
+is then the rvid of the revision its text is a delta against. The
+latest revision always has its full text, so reading a tiddler costs
+the same as without deltas. The delta is made between two round
+trips, in which other processes may store, and delta, revisions of the
+tiddler, so the rewrite checks the run of deltas again and leaves the
+revision whole if it would no longer be within the interval.
+
+Reading an older revision gets the chain of revisions up to the next
+with full text, at most delta_keyframe_interval of them, in one round
+trip, and applies their deltas in turn. Binary tiddlers are not
+delta'd, nor is a revision followed by one of another type, whose text
+is not UTF-8 or whose delta is no smaller than its text. Revisions
+stored before the option was set stay as they are.
+
+A delta is a JSON list, with for each run of lines of the old text
+either the [start, end] indexes of the same lines in the new text, or
+the lines themselves.
+"""
+
+import json
+
+from difflib import SequenceMatcher
+
+
+def make_delta(old, new):
+    """
+    Return the delta from new to old, both UTF-8 text, as bytes.
+    """
+    old_lines = old.decode('utf-8').splitlines(True)
+    new_lines = new.decode('utf-8').splitlines(True)
+    delta = []
+    matcher = SequenceMatcher(None, new_lines, old_lines, autojunk=False)
+    for tag, new_start, new_end, old_start, old_end in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([new_start, new_end])
+        elif old_end > old_start:
+            lines = ''.join(old_lines[old_start:old_end])
+            if delta and not isinstance(delta[-1], list):
+                delta[-1] += lines
+            else:
+                delta.append(lines)
+    return json.dumps(delta, separators=(',', ':')).encode('utf-8')
+
+
+def apply_delta(delta, new):
+    """
+    Return the old text, as UTF-8, which delta was made from with new.
+    """
+    new_lines = new.decode('utf-8').splitlines(True)
+    old = []
+    for item in json.loads(delta):
+        if isinstance(item, list):
+            old.extend(new_lines[item[0]:item[1]])
+        else:
+            old.append(item)
+    return ''.join(old).encode('utf-8')
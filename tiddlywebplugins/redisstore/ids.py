@@ -0,0 +1,133 @@
+"""
+Allocating the ids of new bags, recipes, users, policies, tiddlers and
+revisions from the ids:next* counters of the primary, or coordinator.
+
+With the 'id_block_size' store option above 1, each process reserves
+that many ids of a counter at a time with INCRBY, and hands them out
+itself, saving a round trip, and a write to the counter, for most new
+entities. Ids are then unique but no longer in the order they were
+handed out across processes, and ids left in a block when a process
+ends are never used.
+
+The revisions of a tiddler must have increasing rvids. A process may
+put a revision with an rvid from its block after another process has
+put one with a later rvid, so the tiddler_put script refuses an rvid
+which is not greater than that of the tiddler's latest revision, and
+the store allocates a fresh one from the counter and tries again.
+
+With 'id_strict' set, rvids are not taken from blocks but allocated by
+tiddler_put as each revision is stored, so they follow the order in
+which revisions are written over all processes, at the cost of keeping
+ids:nextRevisionID a write per revision.
+
+A tid is taken for every put, as the store does not know whether the
+tiddler is new until tiddler_put has run, and given back, to be handed
+out again, if it was not.
+"""
+
+import os
+import threading
+
+
+# The allocators of this process, by client and block sizes, so that
+# a forked process reserves its own blocks.
+ALLOCATORS = {}
+
+# The counters of the ids of tiddlers and revisions.
+TIDDLER_COUNTER = 'ids:nextTiddlerID'
+REVISION_COUNTER = 'ids:nextRevisionID'
+
+
+class IdAllocator(object):
+    """
+    Hand out the ids of counters on client, reserving block_size at a
+    time, except for the counters in strict, which are incremented for
+    each id.
+    """
+
+    def __init__(self, client, block_size=1, strict=()):
+        self.client = client
+        self.block_size = block_size
+        self.strict = strict
+        # the next id and the last reserved of each counter
+        self.blocks = {}
+        # ids given back, to hand out first, of each counter
+        self.spare = {}
+        self.lock = threading.Lock()
+
+    def blocked(self, counter):
+        """
+        Whether ids of counter are reserved in blocks.
+        """
+        return self.block_size > 1 and counter not in self.strict
+
+    def next(self, counter):
+        """
+        Return a new id of counter.
+        """
+        return self.take([counter])[0]
+
+    def take(self, counters):
+        """
+        Return a new id of each of counters, reserving any blocks needed
+        in one round trip.
+        """
+        with self.lock:
+            needed = [counter for counter in counters
+                    if not self._available(counter)
+                    and not self.spare.get(counter)]
+            if needed:
+                pipe = self.client.pipeline(transaction=False)
+                for counter in needed:
+                    if self.blocked(counter):
+                        pipe.incrby(counter, self.block_size)
+                    else:
+                        pipe.incr(counter)
+                for counter, last in zip(needed, pipe.execute()):
+                    size = self.block_size if self.blocked(counter) else 1
+                    self.blocks[counter] = [last - size + 1, last]
+            ids = []
+            for counter in counters:
+                if self.spare.get(counter):
+                    ids.append(self.spare[counter].pop())
+                    continue
+                block = self.blocks[counter]
+                ids.append(block[0])
+                block[0] += 1
+            return ids
+
+    def give_back(self, counter, value):
+        """
+        Hand out value, an id of counter taken but not used, again.
+        """
+        with self.lock:
+            self.spare.setdefault(counter, []).append(value)
+
+    def _available(self, counter):
+        block = self.blocks.get(counter)
+        return block is not None and block[0] <= block[1]
+
+
+def get_allocator(client, options):
+    """
+    Return the IdAllocator of this process for client with the
+    id_block_size and id_strict options.
+    """
+    strict = ()
+    if options['id_strict']:
+        strict = (REVISION_COUNTER,)
+    key = (os.getpid(), client, options['id_block_size'], strict)
+    if key not in ALLOCATORS:
+        ALLOCATORS[key] = IdAllocator(client, options['id_block_size'],
+                strict)
+    return ALLOCATORS[key]
+
+
+def forget_allocators(client):
+    """
+    Drop the allocators of this process for client, whose counters
+    have been reset.
+    """
+    for key in list(ALLOCATORS):
+        if key[1] is client:
+            del ALLOCATORS[key]
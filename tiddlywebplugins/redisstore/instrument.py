@@ -0,0 +1,201 @@
+"""
+Count the redis commands and round trips made by each Store method,
+and the time spent in them and in redis.
+
+A Store keeps its counts in a Stats object in its environ, under
+``tiddlyweb.redisstore.stats``, shared by all Stores made with that
+environ, so a request's stats cover all its Store calls. While a Store
+method runs, the commands it sends to redis are counted against it.
+Calls of Store methods from other Store methods are counted against
+the outer one. Stats may be shared by threads, such as those of an
+ThreadedStore, so their counts are changed under a lock.
+
+The RedisStats WSGI middleware logs a summary of each request's stats,
+and a warning for each Store method slower, in total, than the
+``redisstore.slow_threshold`` config setting in milliseconds.
+"""
+
+import functools
+import logging
+import threading
+import time
+
+from redis.client import Pipeline
+
+
+LOGGER = logging.getLogger(__name__)
+
+ENVIRON_KEY = 'tiddlyweb.redisstore.stats'
+
+# The Stats and counts of the Store method running in the current
+# thread, which the commands it sends are added to.
+_LOCAL = threading.local()
+
+
+class Stats(object):
+    """
+    Counts of calls, commands, round trips and time for each Store
+    method.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def operation(self, name):
+        with self.lock:
+            return self.operations.setdefault(name, {'calls': 0,
+                'commands': 0, 'round_trips': 0, 'redis_time': 0.0,
+                'time': 0.0})
+
+    def add(self, counts, **amounts):
+        """
+        Add amounts to the counts of a method.
+        """
+        with self.lock:
+            for key, amount in amounts.items():
+                counts[key] += amount
+
+    def summary(self):
+        """
+        The counts added up over all the methods.
+        """
+        totals = {'calls': 0, 'commands': 0, 'round_trips': 0,
+                'redis_time': 0.0, 'time': 0.0}
+        with self.lock:
+            for counts in self.operations.values():
+                for key in totals:
+                    totals[key] += counts[key]
+        return totals
+
+
+def get_stats(environ):
+    """
+    Return the Stats in the environ, adding one if there is none.
+    """
+    if environ is None:
+        return Stats()
+    return environ.setdefault(ENVIRON_KEY, Stats())
+
+
+def count_commands(commands, started):
+    """
+    Count commands sent in one round trip which started at the time
+    ``started`` against the current Store method, if any.
+    """
+    counts = getattr(_LOCAL, 'counts', None)
+    if counts is not None:
+        _LOCAL.stats.add(counts, commands=commands, round_trips=1,
+                redis_time=time.time() - started)
+
+
+def measured(method):
+    """
+    Decorate a Store method to count the commands it sends and the
+    time it takes. Generators are measured as they are consumed.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if getattr(_LOCAL, 'counts', None) is not None:
+            return method(self, *args, **kwargs)
+        stats = self.stats
+        counts = stats.operation(method.__name__)
+        stats.add(counts, calls=1)
+        result = _measure(stats, counts, method, self, *args, **kwargs)
+        if hasattr(result, 'next') and not isinstance(result, list):
+            return _measure_iterator(stats, counts, result)
+        return result
+    return wrapper
+
+
+def _measure(stats, counts, func, *args, **kwargs):
+    started = time.time()
+    _LOCAL.stats = stats
+    _LOCAL.counts = counts
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _LOCAL.counts = None
+        stats.add(counts, time=time.time() - started)
+
+
+def _measure_iterator(stats, counts, iterator):
+    while True:
+        try:
+            item = _measure(stats, counts, next, iterator)
+        except StopIteration:
+            return
+        yield item
+
+
+class MeasuredPipeline(Pipeline):
+    """
+    A pipeline which counts the commands it sends: those it queues when
+    executed, and those sent at once while it watches keys, such as
+    WATCH and the reads of a check-and-set.
+    """
+
+    def immediate_execute_command(self, *args, **options):
+        started = time.time()
+        try:
+            return super(MeasuredPipeline, self).immediate_execute_command(
+                    *args, **options)
+        finally:
+            count_commands(1, started)
+
+    def reset(self):
+        # a pipeline still watching keys sends UNWATCH
+        if self.watching and self.connection:
+            started = time.time()
+            try:
+                return super(MeasuredPipeline, self).reset()
+            finally:
+                count_commands(1, started)
+        return super(MeasuredPipeline, self).reset()
+
+    def execute(self, raise_on_error=True):
+        commands = len(self.command_stack)
+        started = time.time()
+        try:
+            return super(MeasuredPipeline, self).execute(raise_on_error)
+        finally:
+            if commands:
+                count_commands(commands, started)
+
+
+class RedisStats(object):
+    """
+    WSGI middleware which logs the redis stats of each request.
+    Add it to the config's server_request_filters.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        stats = get_stats(environ)
+        try:
+            for chunk in self.application(environ, start_response):
+                yield chunk
+        finally:
+            self._report(environ, stats)
+
+    def _report(self, environ, stats):
+        totals = stats.summary()
+        request = '%s %s' % (environ.get('REQUEST_METHOD'),
+                environ.get('PATH_INFO'))
+        LOGGER.info('%s: %s store calls, %s commands, %s round trips, '
+                '%.1fms in redis', request, totals['calls'],
+                totals['commands'], totals['round_trips'],
+                totals['redis_time'] * 1000)
+        threshold = environ.get('tiddlyweb.config', {}).get(
+                'redisstore.slow_threshold')
+        if threshold is None:
+            return
+        for name, counts in sorted(stats.operations.items()):
+            if counts['time'] * 1000 >= threshold:
+                LOGGER.warning('slow %s in %s: %s calls, %s commands, '
+                        '%s round trips, %.1fms, %.1fms in redis', name,
+                        request, counts['calls'], counts['commands'],
+                        counts['round_trips'], counts['time'] * 1000,
+                        counts['redis_time'] * 1000)
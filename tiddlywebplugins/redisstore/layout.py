@@ -0,0 +1,252 @@
+"""
+How the attributes of records (bags, recipes, users, tiddlers and
+tiddler revisions) are laid out in redis keys.
+
+A layout queues commands on a pipeline and returns a reader. Once the
+pipeline has been executed the reader is called with an iterator over
+the results, consumes the results of the commands it queued and returns
+the values. This lets a store method gather the reads of several
+records into one round trip without knowing how the records are kept.
+
+Values are returned as they come from redis, except tags and fields of
+revisions, which are decoded.
+
+Schema 1 keeps each attribute in its own key: ``bid:#bid:name``.
+
+Schema 2 keeps each record in one hash: ``bid:#bid`` with a ``name``
+field. A revision's tags are a JSON list in its ``tags`` field and its
+tiddler fields are stored with a ``field:`` prefix. Small hashes are
+kept in a compact encoding by redis, so this uses less memory and fewer
+commands.
+"""
+
+import json
+
+
+REVISION_ATTRIBUTES = ['text', 'modifier', 'modified', 'type', 'tid',
+        'compression', 'delta', 'digest']
+
+TIDDLER_ATTRIBUTES = ['title', 'bid', 'creator', 'created']
+
+FIELD_PREFIX = 'field:'
+
+
+class LayoutV1(object):
+    """
+    Each attribute in its own key.
+    """
+
+    version = 1
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+
+    def attribute_key(self, kind, entity_id, attribute):
+        return '%s:%s:%s' % (kind, entity_id, attribute)
+
+    def record_keys(self, kind, entity_id, attributes):
+        """
+        The keys holding the named attributes of a record.
+        """
+        return [self.attribute_key(kind, entity_id, attribute)
+                for attribute in attributes]
+
+    def read_record(self, pipe, kind, entity_id, attributes):
+        """
+        Read the named attributes of one record, as a list.
+        """
+        pipe.mget(self.record_keys(kind, entity_id, attributes))
+        return next
+
+    def read_attribute(self, pipe, kind, entity_ids, attribute):
+        """
+        Read one attribute of many records, as a list.
+        """
+        if not entity_ids:
+            return lambda results: []
+        pipe.mget([self.attribute_key(kind, entity_id, attribute)
+            for entity_id in entity_ids])
+        return next
+
+    def write_record(self, pipe, kind, entity_id, mapping):
+        pipe.mset(dict((self.attribute_key(kind, entity_id, attribute),
+            value) for attribute, value in mapping.items()))
+
+    def revision_keys(self, rvid):
+        return self.record_keys('rvid', rvid,
+                REVISION_ATTRIBUTES + ['tags', 'fields'])
+
+    def read_revision(self, pipe, rvid):
+        """
+        Read a revision as a dict of its attributes, tags and fields.
+        """
+        pipe.mget(self.record_keys('rvid', rvid, REVISION_ATTRIBUTES))
+        pipe.smembers(self.attribute_key('rvid', rvid, 'tags'))
+        pipe.hgetall(self.attribute_key('rvid', rvid, 'fields'))
+
+        def reader(results):
+            revision = dict(zip(REVISION_ATTRIBUTES, next(results)))
+            revision['tags'] = [tag.decode(self.encoding)
+                    for tag in next(results)]
+            revision['fields'] = self._decode_fields(next(results).items())
+            return revision
+        return reader
+
+    def _decode_fields(self, items):
+        return dict((key.decode(self.encoding), value.decode(self.encoding))
+                for key, value in items)
+
+
+class LayoutV2(LayoutV1):
+    """
+    Each record in one hash.
+    """
+
+    version = 2
+
+    def record_key(self, kind, entity_id):
+        return '%s:%s' % (kind, entity_id)
+
+    def record_keys(self, kind, entity_id, attributes):
+        return [self.record_key(kind, entity_id)]
+
+    def read_record(self, pipe, kind, entity_id, attributes):
+        pipe.hmget(self.record_key(kind, entity_id), attributes)
+        return next
+
+    def read_attribute(self, pipe, kind, entity_ids, attribute):
+        for entity_id in entity_ids:
+            pipe.hget(self.record_key(kind, entity_id), attribute)
+
+        def reader(results):
+            return [next(results) for _ in entity_ids]
+        return reader
+
+    def write_record(self, pipe, kind, entity_id, mapping):
+        pipe.hmset(self.record_key(kind, entity_id), mapping)
+
+    def revision_keys(self, rvid):
+        return [self.record_key('rvid', rvid)]
+
+    def read_revision(self, pipe, rvid):
+        pipe.hgetall(self.record_key('rvid', rvid))
+
+        def reader(results):
+            record = next(results)
+            revision = dict((attribute, record.get(attribute))
+                    for attribute in REVISION_ATTRIBUTES)
+            revision['tags'] = json.loads(record.get('tags', '[]'))
+            revision['fields'] = self._decode_fields(
+                    (key[len(FIELD_PREFIX):], value)
+                    for key, value in record.items()
+                    if key.startswith(FIELD_PREFIX))
+            return revision
+        return reader
+
+
+class MigratingLayout(object):
+    """
+    Used while a database is being migrated from one schema to another.
+    Records are written in the new layout and read from whichever layout
+    they are in.
+    """
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.version = new.version
+        self.encoding = new.encoding
+
+    def record_keys(self, kind, entity_id, attributes):
+        return (self.old.record_keys(kind, entity_id, attributes)
+                + self.new.record_keys(kind, entity_id, attributes))
+
+    def read_record(self, pipe, kind, entity_id, attributes):
+        old_reader = self.old.read_record(pipe, kind, entity_id, attributes)
+        new_reader = self.new.read_record(pipe, kind, entity_id, attributes)
+
+        def reader(results):
+            old_values = old_reader(results)
+            new_values = new_reader(results)
+            if [value for value in new_values if value is not None]:
+                return new_values
+            return old_values
+        return reader
+
+    def read_attribute(self, pipe, kind, entity_ids, attribute):
+        old_reader = self.old.read_attribute(pipe, kind, entity_ids,
+                attribute)
+        new_reader = self.new.read_attribute(pipe, kind, entity_ids,
+                attribute)
+
+        def reader(results):
+            old_values = old_reader(results)
+            new_values = new_reader(results)
+            return [new if new is not None else old
+                    for old, new in zip(old_values, new_values)]
+        return reader
+
+    def write_record(self, pipe, kind, entity_id, mapping):
+        self.new.write_record(pipe, kind, entity_id, mapping)
+        pipe.delete(*self.old.record_keys(kind, entity_id, mapping.keys()))
+
+    def revision_keys(self, rvid):
+        return self.old.revision_keys(rvid) + self.new.revision_keys(rvid)
+
+    def read_revision(self, pipe, rvid):
+        old_reader = self.old.read_revision(pipe, rvid)
+        new_reader = self.new.read_revision(pipe, rvid)
+
+        def reader(results):
+            old_revision = old_reader(results)
+            new_revision = new_reader(results)
+            if new_revision['modifier'] is not None:
+                return new_revision
+            return old_revision
+        return reader
+
+
+LAYOUTS = {
+        1: LayoutV1,
+        2: LayoutV2,
+        }
+
+
+def get_layout(version, target=None, encoding='utf-8'):
+    """
+    Return the layout for the schema ``version``, or, if a migration to
+    schema ``target`` is underway, a layout that handles both.
+    """
+    layout = LAYOUTS[version](encoding)
+    if target and target != version:
+        return MigratingLayout(layout, LAYOUTS[target](encoding))
+    return layout
+
+
+def read_schema(redis, default=1, indexes=()):
+    """
+    Return the schema version of the database, the version being
+    migrated to, if any, and the names of the indexes which are built.
+
+    A database without a recorded version is marked as ``default`` if
+    it is empty, otherwise as schema 1, which is what existed before
+    versions were recorded. If it is empty the named ``indexes`` are
+    marked as built, as there is nothing yet to index.
+    """
+    pipe = redis.pipeline(transaction=False)
+    pipe.mget(['schema:version', 'schema:target'])
+    pipe.smembers('indexes:built')
+    (version, target), built = pipe.execute()
+    if version is None:
+        if redis.randomkey() is None:
+            version = default
+            if indexes:
+                redis.sadd('indexes:built', *indexes)
+                built = set(indexes)
+        else:
+            version = 1
+        redis.setnx('schema:version', version)
+        version = redis.get('schema:version')
+    if target is not None:
+        target = int(target)
+    return int(version), target, set(built)
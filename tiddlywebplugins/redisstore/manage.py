@@ -0,0 +1,401 @@
+"""
+Maintenance of the data in a redis store, used by the twanager commands
+established in :py:func:`tiddlywebplugins.redisstore.init`.
+"""
+
+import logging
+import time
+
+from collections import Counter
+
+from tiddlyweb.model.policy import Policy
+from tiddlyweb.store import NoBagError
+
+from tiddlywebplugins.redisstore import BAG_ATTRIBUTES
+from tiddlywebplugins.redisstore.layout import (REVISION_ATTRIBUTES,
+        TIDDLER_ATTRIBUTES, LayoutV1, LayoutV2, read_schema)
+from tiddlywebplugins.redisstore.shard import (MOVED_KEY, PLACEMENT_KEY,
+        node_iterator, on_node)
+
+
+LOGGER = logging.getLogger(__name__)
+
+# The records moved by a migration, the keys that find them and the
+# attributes they have.
+MIGRATED_RECORDS = [
+        ('bid', 'bid:*:name', ['name', 'desc', 'policy']),
+        ('rid', 'rid:*:name', ['name', 'desc', 'policy']),
+        ('uid', 'uid:*:usersign', ['usersign', 'password', 'note']),
+        ('tid', 'tid:*:title', TIDDLER_ATTRIBUTES),
+        ('rvid', 'rvid:*:tid', REVISION_ATTRIBUTES),
+        ]
+
+
+def migrate(storage, target=2, batch_size=1000):
+    """
+    Migrate the database used by ``storage`` from schema 1 to schema
+    ``target``, while it is in use.
+
+    The target is recorded first and then we wait until every running
+    store has noticed it and is writing the new layout, while reading
+    both. Records are then rewritten in batches found by SCAN, each
+    record atomically, on every server of the store. When done the new
+    version is recorded. If interrupted, running the migration again
+    carries on.
+    """
+    redis = storage.primary
+    version, current_target, _ = read_schema(redis)
+    if version == target:
+        LOGGER.info('database is already at schema %s', target)
+        return
+    if (version, target) != (1, 2):
+        raise ValueError('unable to migrate from schema %s to %s'
+                % (version, target))
+
+    redis.set('schema:target', target)
+    if current_target != target:
+        time.sleep(storage.options['schema_check_interval'])
+
+    for node in storage._nodes():
+        migrate_record = node.scripts['migrate_record']
+        for kind, match, attributes in MIGRATED_RECORDS:
+            moved = 0
+            cursor = 0
+            while True:
+                cursor, keys = node.scan(cursor, match=match,
+                        count=batch_size)
+                pipe = node.pipeline(transaction=False)
+                for key in keys:
+                    entity_id = key.split(':', 2)[1]
+                    migrate_record(args=[kind, entity_id] + attributes,
+                            client=pipe)
+                moved += len([result for result in pipe.execute()
+                    if result])
+                if not cursor:
+                    break
+            LOGGER.info('migrated %s %s records', moved, kind)
+
+    pipe = redis.pipeline()
+    pipe.set('schema:version', target)
+    pipe.delete('schema:target')
+    pipe.execute()
+
+
+def reindex(storage, batch_size=1000):
+    """
+    Rebuild the index entries of every tiddler, in batches found by
+    SCAN, and then mark the indexes as built so that queries use them.
+    """
+    redis = storage.primary
+    version, target, _ = read_schema(redis)
+    if target:
+        raise ValueError('unable to reindex while migrating to schema %s'
+                % target)
+
+    indexed = 0
+    for node in storage._nodes():
+        tiddler_reindex = node.scripts['tiddler_reindex']
+        cursor = 0
+        while True:
+            cursor, keys = node.scan(cursor, match='tid:*:revisions',
+                    count=batch_size)
+            pipe = node.pipeline(transaction=False)
+            for key in keys:
+                tiddler_reindex(args=[version, key.split(':', 2)[1]]
+                        + storage.options['indexed_fields'], client=pipe)
+            indexed += len([result for result in pipe.execute() if result])
+            if not cursor:
+                break
+    LOGGER.info('reindexed %s tiddlers', indexed)
+
+    redis.sadd('indexes:built', *storage._index_names())
+
+
+def reap(storage, batch_size=None, pause=0.1):
+    """
+    Remove the tiddlers and records of the bags tombstoned by
+    ``bag_delete`` when the tombstone_bags option is set.
+
+    Tiddlers are removed ``batch_size`` at a time (by default the
+    delete_chunk_size option) using UNLINK, so their memory is freed
+    off the main thread of redis, sleeping ``pause`` seconds between
+    batches to limit the load on the server. If interrupted, running
+    it again carries on.
+    """
+    reaped = 0
+    for node in storage._nodes():
+        reaped += on_node(storage, node, _reap_node, storage, batch_size,
+                pause)
+    LOGGER.info('reaped %s bags', reaped)
+
+
+def _reap_node(storage, batch_size, pause):
+    reaped = 0
+    for bid in list(storage.redis.smembers('bags:tombstoned')):
+        name = storage._read_record('bid', bid, ['name'])[0]
+        LOGGER.info('reaping bag %s (%s)', name, bid)
+        storage._delete_bag_tiddlers(name, bid, batch_size, 'UNLINK', pause,
+                fenced=False)
+        storage._delete_bag_record(bid)
+        reaped += 1
+    return reaped
+
+
+def prune(storage, batch_size=1000, pause=0):
+    """
+    Remove the revisions which the retention options do not keep, from
+    the tiddlers of every bag, batch_size tiddlers at a time found by
+    SSCAN, each tiddler atomically and using UNLINK, sleeping pause
+    seconds between batches. Bags moving to another shard are skipped.
+    """
+    pruned = 0
+    for node in storage._nodes():
+        pruned += on_node(storage, node, _prune_node, storage, batch_size,
+                pause)
+    LOGGER.info('pruned %s revisions', pruned)
+
+
+def _prune_node(storage, batch_size, pause):
+    pruned = 0
+    redis = storage.redis
+    tiddler_trim = redis.scripts['tiddler_trim']
+    for bid in list(redis.smembers('bags')):
+        name = storage._read_record('bid', bid, ['name'])[0]
+        if name is None:
+            continue
+        keep, cutoff = storage._retention(name)
+        if not keep and not cutoff:
+            continue
+        cursor = 0
+        while True:
+            cursor, tids = redis.sscan('bid:%s:tiddlers' % bid, cursor,
+                    count=batch_size)
+            pipe = redis.pipeline(transaction=False)
+            for tid in tids:
+                tiddler_trim(keys=[MOVED_KEY % name],
+                        args=[tid, 'UNLINK', keep, cutoff, 0], client=pipe)
+            results = pipe.execute()
+            if -1 in results:
+                LOGGER.info('skipping bag %s, which is moving', name)
+                break
+            pruned += sum(results)
+            if not cursor:
+                break
+            time.sleep(pause)
+    return pruned
+
+
+def move_bag(storage, bag_name, target, batch_size=100, grace=None):
+    """
+    Move a bag of a sharded store, with its tiddlers, to the shard
+    named ``target``, while the store is in use.
+
+    The bag is fenced on its shard, so it cannot be changed, and copied,
+    ``batch_size`` tiddlers at a time, to the target. Once the bag is
+    placed on the target we wait ``grace`` seconds (by default
+    schema_check_interval) for every running store to notice, and
+    then delete it from the old shard. See
+    :py:mod:`tiddlywebplugins.redisstore.shard`.
+
+    Shared texts the bag's revisions refer to are copied with them. A
+    move which is interrupted and run again counts references to them
+    on the target twice, which only keeps them from being deleted.
+    """
+    shards = storage.shards
+    if shards is None:
+        raise ValueError('the store is not sharded')
+    if target not in shards.clients:
+        raise ValueError('no such shard: %s' % target)
+    shards.refresh()
+    source_name = shards.name_for_bag(bag_name)
+    if source_name == target:
+        LOGGER.info('bag %s is already on %s', bag_name, target)
+        return
+    source = shards.clients[source_name]
+    destination = shards.clients[target]
+
+    source.set(MOVED_KEY % bag_name, target)
+    bid = source.get('bag:%s:bid' % bag_name)
+    if not bid:
+        source.delete(MOVED_KEY % bag_name)
+        raise NoBagError('no such bag: %s' % bag_name)
+
+    LOGGER.info('moving bag %s (%s) from %s to %s', bag_name, bid,
+            source_name, target)
+    copied = 0
+    for keys, tags_tids, digests in _bag_key_batches(storage, source,
+            bag_name, bid, batch_size):
+        _copy_keys(source, destination, keys)
+        _copy_texts(source, destination, digests)
+        pipe = destination.pipeline(transaction=False)
+        for key, tid in tags_tids:
+            pipe.sadd(key, tid)
+        pipe.execute()
+        copied += len(keys)
+    pipe = destination.pipeline()
+    pipe.sadd('bags', bid)
+    pipe.delete(MOVED_KEY % bag_name)
+    pipe.execute()
+
+    if shards.ring_name(bag_name) == target:
+        storage.primary.hdel(PLACEMENT_KEY, bag_name)
+    else:
+        storage.primary.hset(PLACEMENT_KEY, bag_name, target)
+    LOGGER.info('copied %s keys of bag %s to %s', copied, bag_name, target)
+
+    if grace is None:
+        grace = storage.options['schema_check_interval']
+    time.sleep(grace)
+
+    for keys, tags_tids, digests in _bag_key_batches(storage, source,
+            bag_name, bid, batch_size):
+        pipe = source.pipeline(transaction=False)
+        pipe.delete(*keys)
+        for key, tid in tags_tids:
+            pipe.srem(key, tid)
+        if digests:
+            release = ['DEL']
+            for digest, count in digests.items():
+                release.extend([digest, count])
+            source.scripts['texts_release'](args=release, client=pipe)
+        pipe.execute()
+    source.srem('bags', bid)
+    shards.refresh()
+
+
+def rebalance(storage, pin=False, batch_size=100, grace=None):
+    """
+    Move each bag of a sharded store which is not on the shard the hash
+    ring places it on to that shard.
+
+    Adding a shard to the store config changes where the ring places
+    some bags, so before running stores are given the new config, the
+    bags are pinned, with ``pin``, by recording the shards they are on
+    as their placements. Once the stores have the new config, rebalance
+    moves the bags.
+    """
+    shards = storage.shards
+    if shards is None:
+        raise ValueError('the store is not sharded')
+    shards.refresh()
+    misplaced = []
+    for name, client in shards.clients.items():
+        names = on_node(storage, client, storage._list_attribute, 'bags',
+                'bid', 'name')
+        for bag_name in node_iterator(storage, client, names):
+            # skip copies of bags being moved here
+            if shards.placements.get(bag_name, name) != name:
+                continue
+            if shards.ring_name(bag_name) != name:
+                misplaced.append((bag_name, name))
+
+    if pin:
+        for bag_name, name in misplaced:
+            storage.primary.hset(PLACEMENT_KEY, bag_name, name)
+        shards.refresh()
+        LOGGER.info('pinned %s bags', len(misplaced))
+        return
+
+    for bag_name, name in misplaced:
+        move_bag(storage, bag_name, shards.ring_name(bag_name), batch_size,
+                grace)
+    LOGGER.info('moved %s bags', len(misplaced))
+
+
+def _bag_key_batches(storage, source, bag_name, bid, batch_size):
+    """
+    Yield the keys of the bag on the shard with client source, in
+    batches: the keys of batch_size tiddlers at a time and lastly those
+    of the bag itself. Each batch is yielded with the tag sets shared
+    with other bags and the tids in them, as (key, tid) pairs, and a
+    Counter of the digests of the shared texts its revisions refer to.
+    Keys of both layouts are included, as a layout's keys may be
+    missing.
+    """
+    layouts = [LayoutV1(), LayoutV2()]
+    tids = list(source.smembers('bid:%s:tiddlers' % bid))
+    bag_indexes = set()
+    for start in range(0, len(tids), batch_size):
+        batch = tids[start:start + batch_size]
+        pipe = source.pipeline(transaction=False)
+        title_reader = storage.layout.read_attribute(pipe, 'tid', batch,
+                'title')
+        for tid in batch:
+            pipe.lrange('tid:%s:revisions' % tid, 0, -1)
+            pipe.smembers('tid:%s:indexes' % tid)
+        results = iter(pipe.execute())
+        titles = title_reader(results)
+
+        keys = []
+        tags_tids = []
+        batch_rvids = []
+        for tid, title in zip(batch, titles):
+            rvids, indexes = next(results), next(results)
+            batch_rvids.extend(rvids)
+            for layout in layouts:
+                keys.extend(layout.record_keys('tid', tid,
+                    TIDDLER_ATTRIBUTES))
+                for rvid in rvids:
+                    keys.extend(layout.revision_keys(rvid))
+            keys.extend(['tid:%s:revisions' % tid, 'tid:%s:indexes' % tid])
+            if title is not None:
+                keys.append('tiddler:%s:%s:tid'
+                        % (bag_name, source.decode(title)))
+            for index in indexes:
+                if index.startswith('tags:'):
+                    tags_tids.append((index, tid))
+                else:
+                    bag_indexes.add(index)
+        pipe = source.pipeline(transaction=False)
+        digest_reader = storage.layout.read_attribute(pipe, 'rvid',
+                batch_rvids, 'digest')
+        digests = Counter(digest for digest in
+                digest_reader(iter(pipe.execute())) if digest)
+        yield keys, tags_tids, digests
+
+    pid = on_node(storage, source, storage._read_record, 'bid', bid,
+            ['policy'])[0]
+    keys = ['bag:%s:bid' % bag_name, 'bid:%s:tiddlers' % bid,
+            'bid:%s:recent' % bid]
+    for layout in layouts:
+        keys.extend(layout.record_keys('bid', bid, BAG_ATTRIBUTES))
+    if pid:
+        keys.extend('pid:%s:%s' % (pid, attribute)
+                for attribute in Policy.attributes)
+    keys.extend(bag_indexes)
+    yield keys, [], Counter()
+
+
+def _copy_texts(source, destination, digests):
+    """
+    Add the references, counted in digests, to shared texts on source
+    to the same texts on destination.
+    """
+    if not digests:
+        return
+    digests = list(digests.items())
+    pipe = source.pipeline(transaction=False)
+    for digest, _ in digests:
+        pipe.hmget('text:%s' % digest, ['text', 'compression'])
+    acquire = []
+    for (digest, count), (text, compression) in zip(digests,
+            pipe.execute()):
+        if text is not None:
+            acquire.extend([digest, count, text, compression or ''])
+    if acquire:
+        destination.scripts['texts_acquire'](args=acquire)
+
+
+def _copy_keys(source, destination, keys):
+    """
+    Copy keys, those which exist, from source to destination.
+    """
+    pipe = source.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+    values = pipe.execute()
+    pipe = destination.pipeline(transaction=False)
+    for key, value in zip(keys, values):
+        if value is not None:
+            pipe.restore(key, 0, value, replace=True)
+    pipe.execute()
@@ -0,0 +1,173 @@
+"""
+Finding the most recently modified tiddlers of bags and recipes.
+
+The tiddlers of each bag are kept in the sorted set ``bid:#bid:recent``
+scored by the modified time of their latest revision, as a number of
+14 digits, so that the newest come first from ZREVRANGE. The index is
+'recent' in indexes:built: a database with tiddlers from before it was
+added needs 'twanager redisreindex' before it is used.
+
+:py:meth:`Store.recent_tiddlers` merges the sets of several bags, a
+window at a time, and as in a recipe a tiddler hides tiddlers with the
+same title in the bags before its own.
+:py:meth:`Store.recent_recipe_tiddlers` does so for the bags of a
+recipe.
+
+When 'indexer' is 'tiddlywebplugins.redisstore' in the config, a
+'sort=-modified' filter first on the tiddlers of a bag is answered
+from the index, lazily, so a 'limit' after it reads only what it
+keeps. TiddlyWeb says which bag the tiddlers are of, by passing it as
+indexable, only when finding which bag of a recipe holds a tiddler,
+filtering each bag by the filter of its line. The filters of a
+request, on the tiddlers of a bag or recipe URI, and those of recipe
+lines when listing a recipe, are given tiddlers already listed, and
+sorted by the sort parser the store's was installed over.
+"""
+
+import heapq
+
+# How many tiddlers to read from each bag at first, when not told how
+# many are wanted: enough for a page of recent changes.
+FIRST_WINDOW = 50
+
+
+def merge_recent(layout, sources, start=0, count=None, scan_count=500):
+    """
+    Yield the titles and bag names of the tiddlers in sources, a list
+    of (client, bag name, bid), newest first, skipping start of them
+    and yielding at most count. Each bag is read a window at a time,
+    the first only as big as is needed and later ones twice the last,
+    up to scan_count.
+    """
+    if count is not None:
+        if count <= 0:
+            return
+        window = min(scan_count, start + count)
+    else:
+        window = min(scan_count, FIRST_WINDOW)
+    heap = []
+    offsets = [0] * len(sources)
+
+    def fill(indexes):
+        """
+        Read the next window of each of the sources, with one pipeline
+        for each client.
+        """
+        pipes = {}
+        for index in indexes:
+            client, _, bid = sources[index]
+            pipe = pipes.setdefault(id(client),
+                    client.pipeline(transaction=False))
+            pipe.zrevrange('bid:%s:recent' % bid, offsets[index],
+                    offsets[index] + window - 1, withscores=True)
+        results = dict((key, iter(pipe.execute()))
+                for key, pipe in pipes.items())
+        for index in indexes:
+            entries = next(results[id(sources[index][0])])
+            full = len(entries) == window
+            for position, (tid, score) in enumerate(entries):
+                last = full and position == len(entries) - 1
+                heapq.heappush(heap, (-score, -index,
+                    offsets[index] + position, tid, last))
+            offsets[index] += len(entries)
+
+    # a source whose last read entry is taken is read again before any
+    # more are taken, as its next entries may come before the others
+    exhausted = list(range(len(sources)))
+    while True:
+        if exhausted:
+            fill(exhausted)
+        exhausted = []
+        if not heap:
+            return
+        batch = []
+        while heap and len(batch) < window and not exhausted:
+            _, negative_index, _, tid, last = heapq.heappop(heap)
+            batch.append((-negative_index, tid))
+            if last:
+                exhausted.append(-negative_index)
+        for title, bag_name in _visible(layout, sources, batch):
+            if start:
+                start -= 1
+                continue
+            yield title, bag_name
+            if count is not None:
+                count -= 1
+                if not count:
+                    return
+        window = min(window * 2, scan_count)
+
+
+def _visible(layout, sources, batch):
+    """
+    Return the titles and bag names of the (source index, tid) pairs in
+    batch, in order, leaving out tiddlers since deleted and those
+    hidden by a tiddler with the same title in a later bag. Each client
+    is sent one pipeline for the titles and one for the later bags.
+    """
+    pipes = {}
+    readers = []
+    for index, (client, _, _) in enumerate(sources):
+        tids = [tid for source, tid in batch if source == index]
+        if tids:
+            pipe = pipes.setdefault(id(client),
+                    client.pipeline(transaction=False))
+            readers.append((index, tids, layout.read_attribute(pipe, 'tid',
+                tids, 'title')))
+    results = dict((key, iter(pipe.execute()))
+            for key, pipe in pipes.items())
+    titles = {}
+    for index, tids, reader in readers:
+        client = sources[index][0]
+        for tid, title in zip(tids, reader(results[id(client)])):
+            if title is not None:
+                titles[(index, tid)] = client.decode(title)
+
+    pipes = {}
+    checks = []
+    for later, (client, bag_name, _) in enumerate(sources):
+        for candidate in titles:
+            if candidate[0] < later:
+                pipe = pipes.setdefault(id(client),
+                        client.pipeline(transaction=False))
+                pipe.exists('tiddler:%s:%s:tid'
+                        % (bag_name, titles[candidate]))
+                checks.append((id(client), candidate))
+    results = dict((key, iter(pipe.execute()))
+            for key, pipe in pipes.items())
+    hidden = set(candidate for key, candidate in checks
+            if next(results[key]))
+
+    return [(titles[entry], sources[entry[0]][1]) for entry in batch
+            if entry in titles and entry not in hidden]
+
+
+def sort_parser(previous):
+    """
+    Return a sort filter parser which parses with previous, the one in
+    place before it, but answers 'sort=-modified' on the tiddlers of a
+    bag from the recent index when the store is the indexer. If the
+    index is not built FilterIndexRefused is raised, and the tiddlers
+    are sorted by the filter of previous. A parser made here is
+    returned as it is, so that installing it again does not wrap it
+    twice.
+    """
+    if getattr(previous, 'recent_index', False):
+        return previous
+
+    def sort_parse(attribute):
+        sorter = previous(attribute)
+        if attribute != '-modified':
+            return sorter
+
+        def recent_sorter(entities, indexable=False, environ=None):
+            environ = environ or {}
+            indexer = environ.get('tiddlyweb.config', {}).get('indexer')
+            if indexable and indexer == 'tiddlywebplugins.redisstore':
+                store = environ['tiddlyweb.store']
+                tiddlers = store.storage.recent_tiddlers([indexable.name])
+                return (store.get(tiddler) for tiddler in tiddlers)
+            return sorter(entities, indexable, environ)
+        return recent_sorter
+    sort_parse.recent_index = True
+    return sort_parse
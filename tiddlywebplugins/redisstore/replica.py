@@ -0,0 +1,190 @@
+"""
+Sending the reads of a store to redis replicas.
+
+The 'replicas' store option lists the connection configurations of
+replicas of the primary server, each as a dict like the store config,
+e.g. {'host': 'replica1'}. A replica's configuration has the settings
+of the primary's, such as db and password, except those locating the
+server.
+
+Store methods which only read use a replica chosen by the
+'replica_selection' option: 'round_robin' takes each healthy replica
+in turn, 'latency' the healthy replica which has lately been quickest
+to answer. Every 'replica_check_interval' seconds each process asks
+every replica for its replication status, timing the answer. A replica
+which does not answer, or which has lost its link to the primary, is
+not used until it is healthy again. With no healthy replica, reads use
+the primary.
+
+A replica lags the primary, so once a request writes, its reads use
+the primary for the next 'read_your_writes' seconds.
+"""
+
+import functools
+import itertools
+import threading
+import time
+
+from redis.exceptions import ConnectionError, RedisError
+
+from tiddlywebplugins.redisstore.connection import get_client, server_config
+
+
+# When the store last wrote during the request, in the request's environ.
+ENVIRON_KEY = 'tiddlyweb.redisstore.wrote'
+
+# The weight of the latest timing in a replica's latency.
+SMOOTHING = 0.5
+
+# The replica sets of this process, by their configuration.
+REPLICA_SETS = {}
+
+
+class ReplicaSet(object):
+    """
+    The clients of the replicas of a primary, and their health and
+    latency.
+    """
+
+    def __init__(self, clients, selection='round_robin', check_interval=5):
+        self.clients = clients
+        self.selection = selection
+        self.check_interval = check_interval
+        # seconds for each client, None for those not to be used
+        self.latencies = [None] * len(clients)
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.turns = itertools.count()
+
+    def choose(self):
+        """
+        Return the client of the replica to read from, or None to read
+        from the primary.
+        """
+        if not self.clients:
+            return None
+        if time.time() - self.checked > self.check_interval:
+            self.check()
+        healthy = [(latency, index) for index, latency
+                in enumerate(self.latencies) if latency is not None]
+        if not healthy:
+            return None
+        if self.selection == 'latency':
+            return self.clients[min(healthy)[1]]
+        return self.clients[healthy[next(self.turns) % len(healthy)][1]]
+
+    def check(self):
+        """
+        Time each replica answering for its replication status, and
+        note those which are unhealthy. Only one thread checks at a
+        time; the others carry on with the last results.
+        """
+        if not self.lock.acquire(False):
+            return
+        try:
+            for index, client in enumerate(self.clients):
+                started = time.time()
+                try:
+                    info = client.info('replication')
+                except RedisError:
+                    self.latencies[index] = None
+                    continue
+                if (info.get('role') == 'slave'
+                        and info.get('master_link_status') != 'up'):
+                    self.latencies[index] = None
+                    continue
+                elapsed = time.time() - started
+                latency = self.latencies[index]
+                if latency is None:
+                    self.latencies[index] = elapsed
+                else:
+                    self.latencies[index] = (SMOOTHING * elapsed
+                            + (1 - SMOOTHING) * latency)
+            self.checked = time.time()
+        finally:
+            self.lock.release()
+
+    def failed(self, client):
+        """
+        Stop using client, which failed to answer, until the next check
+        finds it healthy.
+        """
+        self.latencies[self.clients.index(client)] = None
+
+
+def get_replicas(client_class, redis_config, options):
+    """
+    Return the ReplicaSet of this process for the replicas in options.
+    """
+    configs = [server_config(redis_config, replica)
+            for replica in options['replicas']]
+    key = (client_class, repr([sorted(config.items()) for config in configs]),
+            options['replica_selection'], options['replica_check_interval'])
+    if key not in REPLICA_SETS:
+        REPLICA_SETS[key] = ReplicaSet(
+                [get_client(client_class, config) for config in configs],
+                options['replica_selection'],
+                options['replica_check_interval'])
+    return REPLICA_SETS[key]
+
+
+def reads(method):
+    """
+    Decorate a Store method which only reads to send its commands to a
+    replica, unless its request has written recently. If the replica
+    cannot be reached the method is tried again with the primary.
+    Generators use one replica as they are consumed.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        client = None
+        if getattr(self.reading, 'client', None) is None:
+            wrote = self.environ.get(ENVIRON_KEY)
+            if (wrote is None or time.time() - wrote
+                    >= self.options['read_your_writes']):
+                client = self.replicas.choose()
+        if client is None:
+            return method(self, *args, **kwargs)
+        try:
+            result = _read(self, client, method, self, *args, **kwargs)
+        except ConnectionError:
+            self.replicas.failed(client)
+            return method(self, *args, **kwargs)
+        if hasattr(result, 'next') and not isinstance(result, list):
+            return _read_iterator(self, client, result)
+        return result
+    return wrapper
+
+
+def writes(method):
+    """
+    Decorate a Store method which writes to note when its request last
+    wrote, so its reads for a while use the primary.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.environ[ENVIRON_KEY] = time.time()
+    return wrapper
+
+
+def _read(store, client, func, *args, **kwargs):
+    store.reading.client = client
+    try:
+        return func(*args, **kwargs)
+    finally:
+        store.reading.client = None
+
+
+def _read_iterator(store, client, iterator):
+    while True:
+        try:
+            item = _read(store, client, next, iterator)
+        except StopIteration:
+            return
+        except ConnectionError:
+            store.replicas.failed(client)
+            raise
+        yield item
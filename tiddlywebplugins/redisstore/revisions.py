@@ -0,0 +1,89 @@
+"""
+Listing the revisions of a tiddler without reading them all at once.
+
+:py:meth:`Store.list_tiddler_revisions` returns a
+:py:class:`RevisionList`, a sequence of the rvids of the tiddler's
+revisions, newest first, whose length comes from LLEN when it is
+listed. Indexing reads one rvid with LINDEX, slicing reads only the
+window asked for with LRANGE, and iterating, forwards or reversed,
+reads scan_count at a time. Callers which want a page of a long
+history, or only the latest revision, as TiddlyWeb does before every
+put, so read no more than they need. Those which walk the whole list,
+as TiddlyWeb's revisions view does, read all of it, a window at a time.
+
+Positions count from the newest revision when each read is made, so a
+revision stored while a list is being walked shifts the rest.
+"""
+
+
+class RevisionList(object):
+    """
+    The rvids of the revisions of the tiddler with tid, newest first,
+    read from client as they are used, window_size at a time.
+    """
+
+    def __init__(self, client, tid, length, window_size):
+        self.client = client
+        self.key = 'tid:%s:revisions' % tid
+        self.length = length
+        self.window_size = window_size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            positions = range(*index.indices(self.length))
+            if not positions:
+                return []
+            low = min(positions)
+            window = self._window(low, max(positions) + 1)
+            return [window[position - low] for position in positions
+                    if position - low < len(window)]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('revision index out of range')
+        rvid = self.client.lindex(self.key, -index - 1)
+        if rvid is None:
+            raise IndexError('revision index out of range')
+        return int(rvid)
+
+    def __iter__(self):
+        for start in range(0, self.length, self.window_size):
+            stop = min(start + self.window_size, self.length)
+            window = self._window(start, stop)
+            for rvid in window:
+                yield rvid
+            if len(window) < stop - start:
+                break
+
+    def __reversed__(self):
+        for stop in range(self.length, 0, -self.window_size):
+            start = max(stop - self.window_size, 0)
+            window = self._window(start, stop)
+            for rvid in reversed(window):
+                yield rvid
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, RevisionList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'RevisionList(%r)' % list(self)
+
+    def _window(self, start, stop):
+        """
+        The rvids from position start to before stop, newest first.
+        """
+        rvids = self.client.lrange(self.key, -stop, -start - 1)
+        return [int(rvid) for rvid in reversed(rvids)]
@@ -0,0 +1,690 @@
+"""
+Lua scripts run on the server so that multi-step operations which
+depend on freshly allocated ids, or on what is already stored, can
+happen atomically in one round trip.
+
+Scripts build the names of id based keys themselves, so they must
+follow the layouts in :py:mod:`tiddlywebplugins.redisstore.layout`.
+
+Tiddlers are indexed by adding their tid to index sets, such as
+``bid:#bid:tag:#tag`` and ``bid:#bid:field:#name:#value``. The index
+sets a tiddler is in are listed in ``tid:#tid:indexes`` so they can be
+updated when its current revision changes, or it is deleted, without
+looking at the old revision.
+
+Each bag's tiddlers are also in the sorted set ``bid:#bid:recent``,
+scored by the modified time of their latest revision, see
+:py:mod:`tiddlywebplugins.redisstore.recent`.
+
+A revision whose text is deduplicated has, instead of text and
+compression, a ``digest`` naming the shared ``text:#digest`` hash,
+which holds the text, its compression and a count of the revisions
+referring to it, see :py:mod:`tiddlywebplugins.redisstore.dedup`.
+"""
+
+from tiddlywebplugins.redisstore.layout import (REVISION_ATTRIBUTES,
+        TIDDLER_ATTRIBUTES)
+
+# Functions shared by the scripts which change indexes.
+INDEX_FUNCTIONS = """
+local function record_attribute(record, attribute)
+    return redis.call('HGET', record, attribute)
+        or redis.call('GET', record .. ':' .. attribute)
+end
+
+-- The place of value in the list at key, counting from the end, the
+-- last 1, or nil if it is not there. The list is read from the end, a
+-- window at a time, as the revisions looked for are the newest.
+local function list_place(key, value)
+    local length = redis.call('LLEN', key)
+    local seen = 0
+    local window = 16
+    while seen < length do
+        local entries = redis.call('LRANGE', key, -seen - window, -seen - 1)
+        if #entries == 0 then
+            return nil
+        end
+        for i = #entries, 1, -1 do
+            if entries[i] == value then
+                return seen + #entries - i + 1
+            end
+        end
+        seen = seen + #entries
+        window = window * 2
+    end
+    return nil
+end
+
+-- The text and compression, or '', of a revision, from the shared text
+-- it refers to if it is deduplicated.
+local function revision_text(record)
+    local digest = record_attribute(record, 'digest')
+    if digest then
+        local values = redis.call('HMGET', 'text:' .. digest, 'text',
+            'compression')
+        return values[1], values[2] or ''
+    end
+    return record_attribute(record, 'text'),
+        record_attribute(record, 'compression') or ''
+end
+
+local function tag_index_keys(bid, tags)
+    local keys = {}
+    for _, tag in ipairs(tags) do
+        table.insert(keys, 'bid:' .. bid .. ':tag:' .. tag)
+        table.insert(keys, 'tags:' .. tag .. ':tids')
+    end
+    return keys
+end
+
+local function field_index_keys(bid, keys, names_and_values)
+    for i = 1, #names_and_values, 2 do
+        table.insert(keys, 'bid:' .. bid .. ':field:' .. names_and_values[i]
+            .. ':' .. names_and_values[i + 1])
+    end
+    return keys
+end
+
+-- The score of a tiddler in the recent index of its bag: its modified
+-- time as a number, padded to 14 digits as TiddlyWeb sorts it.
+local function modified_score(modified)
+    return tonumber(string.sub((modified or '') .. '00000000000000', 1, 14))
+        or 0
+end
+
+local function update_indexes(tid, index_keys)
+    local indexes_key = 'tid:' .. tid .. ':indexes'
+    for _, key in ipairs(redis.call('SMEMBERS', indexes_key)) do
+        redis.call('SREM', key, tid)
+    end
+    redis.call('DEL', indexes_key)
+    for _, key in ipairs(index_keys) do
+        redis.call('SADD', key, tid)
+    end
+    if #index_keys > 0 then
+        redis.call('SADD', indexes_key, unpack(index_keys))
+    end
+end
+"""
+
+# Functions shared by the scripts which delete tiddlers. Keys of both
+# layouts are deleted, so these work during a migration.
+DELETE_FUNCTIONS = INDEX_FUNCTIONS + """
+local REVISION_ATTRIBUTES = {%(revision_attributes)s}
+local TIDDLER_ATTRIBUTES = {%(tiddler_attributes)s}
+
+local function delete_record(command, record, attributes)
+    local keys = {record}
+    for _, attribute in ipairs(attributes) do
+        table.insert(keys, record .. ':' .. attribute)
+    end
+    redis.call(command, unpack(keys))
+end
+
+-- Drop the revision's reference to the shared text it refers to, if
+-- any, deleting the text using command once nothing refers to it.
+local function release_text(command, record)
+    local digest = record_attribute(record, 'digest')
+    if digest then
+        local text_key = 'text:' .. digest
+        if redis.call('HINCRBY', text_key, 'refs', -1) <= 0 then
+            redis.call(command, text_key)
+        end
+    end
+end
+
+-- Delete the tiddler with tid from the bag, using command, DEL or
+-- UNLINK, to remove its keys. The key mapping its name to the tid is
+-- found from the title if not given, and only removed if it still
+-- maps to this tid: a bag with the same name may have been created
+-- since this one was tombstoned.
+local function delete_tiddler(command, bid, bag_name, tid, tiddler_key)
+    local revisions_key = 'tid:' .. tid .. ':revisions'
+    for _, rvid in ipairs(redis.call('LRANGE', revisions_key, 0, -1)) do
+        release_text(command, 'rvid:' .. rvid)
+        delete_record(command, 'rvid:' .. rvid, REVISION_ATTRIBUTES)
+    end
+    if not tiddler_key then
+        local title = record_attribute('tid:' .. tid, 'title')
+        if title then
+            tiddler_key = 'tiddler:' .. bag_name .. ':' .. title .. ':tid'
+        end
+    end
+    update_indexes(tid, {})
+    redis.call('ZREM', 'bid:' .. bid .. ':recent', tid)
+    delete_record(command, 'tid:' .. tid, TIDDLER_ATTRIBUTES)
+    redis.call(command, revisions_key)
+    if tiddler_key and redis.call('GET', tiddler_key) == tid then
+        redis.call(command, tiddler_key)
+    end
+    redis.call('SREM', 'bid:' .. bid .. ':tiddlers', tid)
+end
+
+-- Remove, using command, the oldest revisions of the tiddler with tid
+-- which are neither among the latest keep, if keep is not 0, nor
+-- modified at or after cutoff, if it is not '', at most most of them
+-- if most is not 0. The latest revision is always kept. Before its
+-- first revision goes, the creator and created of the tiddler are
+-- copied to the tiddler record. Returns the number removed.
+local function trim_revisions(command, tid, keep, cutoff, most)
+    if keep == 0 and cutoff == '' then
+        return 0
+    end
+    local revisions_key = 'tid:' .. tid .. ':revisions'
+    local length = redis.call('LLEN', revisions_key)
+    local limit = length - 1
+    if keep > 0 then
+        limit = math.min(limit, length - keep)
+    end
+    if most > 0 then
+        limit = math.min(limit, most)
+    end
+    if limit <= 0 then
+        return 0
+    end
+    local rvids = redis.call('LRANGE', revisions_key, 0, limit - 1)
+    local count = #rvids
+    if cutoff ~= '' then
+        count = 0
+        for _, rvid in ipairs(rvids) do
+            local modified = record_attribute('rvid:' .. rvid, 'modified')
+            if modified and modified >= cutoff then
+                break
+            end
+            count = count + 1
+        end
+    end
+    if count == 0 then
+        return 0
+    end
+    local record = 'tid:' .. tid
+    if not record_attribute(record, 'creator') then
+        local base = 'rvid:' .. rvids[1]
+        local creator = record_attribute(base, 'modifier') or ''
+        local created = record_attribute(base, 'modified') or ''
+        if redis.call('HEXISTS', record, 'bid') == 1 then
+            redis.call('HMSET', record, 'creator', creator,
+                'created', created)
+        else
+            redis.call('MSET', record .. ':creator', creator,
+                record .. ':created', created)
+        end
+    end
+    for i = 1, count do
+        release_text(command, 'rvid:' .. rvids[i])
+        delete_record(command, 'rvid:' .. rvids[i], REVISION_ATTRIBUTES)
+    end
+    redis.call('LTRIM', revisions_key, count, -1)
+    return count
+end
+""" % {
+        'revision_attributes': ', '.join("'%s'" % attribute
+            for attribute in REVISION_ATTRIBUTES + ['tags', 'fields']),
+        'tiddler_attributes': ', '.join("'%s'" % attribute
+            for attribute in TIDDLER_ATTRIBUTES),
+        }
+
+SCRIPTS = {
+        # KEYS: bag:#name:bid, tiddler:#bag_name:#tiddler_name:tid,
+        #       bag:#name:moved
+        # ARGV: schema version, the tid to give a new tiddler and the
+        #       rvid to use, or '' to allocate them here, title, text,
+        #       modifier, modified, type, the compression of the text
+        #       or '', the digest to share the text under or '' to keep
+        #       it in the revision, how many revisions to keep, or 0,
+        #       the modified time before which not to keep them, or '',
+        #       the most to remove (see trim_revisions), tag count,
+        #       tags..., field count, field name/value pairs..., indexed
+        #       field count, indexed field name/value pairs...
+        # Returns the new rvid and 1 if the tiddler is new or 0 if not,
+        # nil if the bag does not exist, -1 if it has moved to another
+        # shard or -2 if the rvid given is not greater than that of the
+        # tiddler's latest revision.
+        'tiddler_put': DELETE_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return -1
+end
+local bid = redis.call('GET', KEYS[1])
+if not bid then
+    return false
+end
+local schema = ARGV[1]
+local tid = redis.call('GET', KEYS[2])
+-- a tid left over from a tombstoned bag of the same name is replaced
+if tid and record_attribute('tid:' .. tid, 'bid') ~= bid then
+    tid = false
+end
+local rvid
+if ARGV[3] ~= '' then
+    rvid = tonumber(ARGV[3])
+    if tid then
+        local latest = redis.call('LINDEX', 'tid:' .. tid .. ':revisions', -1)
+        if latest and tonumber(latest) >= rvid then
+            return -2
+        end
+    end
+else
+    rvid = redis.call('INCR', 'ids:nextRevisionID')
+end
+local new = 0
+if not tid then
+    new = 1
+    if ARGV[2] ~= '' then
+        tid = ARGV[2]
+    else
+        tid = redis.call('INCR', 'ids:nextTiddlerID')
+    end
+    redis.call('SET', KEYS[2], tid)
+    if schema == '2' then
+        redis.call('HMSET', 'tid:' .. tid, 'title', ARGV[4], 'bid', bid)
+    else
+        redis.call('MSET', 'tid:' .. tid .. ':title', ARGV[4],
+            'tid:' .. tid .. ':bid', bid)
+    end
+end
+local position = 15
+local tags = {}
+for i = position, position + tonumber(ARGV[14]) - 1 do
+    table.insert(tags, ARGV[i])
+end
+position = position + #tags
+local fields = {}
+for i = position + 1, position + tonumber(ARGV[position]) * 2 do
+    table.insert(fields, ARGV[i])
+end
+position = position + #fields + 1
+local indexed = {}
+for i = position + 1, position + tonumber(ARGV[position]) * 2 do
+    table.insert(indexed, ARGV[i])
+end
+-- the text and compression attributes of the revision, or the digest
+-- of the shared text
+local text = {'text', ARGV[5]}
+if ARGV[10] ~= '' then
+    local text_key = 'text:' .. ARGV[10]
+    if redis.call('HINCRBY', text_key, 'refs', 1) == 1 then
+        redis.call('HMSET', text_key, 'text', ARGV[5],
+            'compression', ARGV[9])
+    end
+    text = {'digest', ARGV[10]}
+elseif ARGV[9] ~= '' then
+    table.insert(text, 'compression')
+    table.insert(text, ARGV[9])
+end
+if schema == '2' then
+    local record = {'modifier', ARGV[6], 'modified', ARGV[7],
+        'type', ARGV[8], 'tid', tid}
+    for _, value in ipairs(text) do
+        table.insert(record, value)
+    end
+    table.insert(record, 'tags')
+    if #tags > 0 then
+        table.insert(record, cjson.encode(tags))
+    else
+        table.insert(record, '[]')
+    end
+    for i = 1, #fields, 2 do
+        table.insert(record, 'field:' .. fields[i])
+        table.insert(record, fields[i + 1])
+    end
+    redis.call('HMSET', 'rvid:' .. rvid, unpack(record))
+else
+    local prefix = 'rvid:' .. rvid .. ':'
+    redis.call('MSET', prefix .. 'modifier', ARGV[6],
+        prefix .. 'modified', ARGV[7],
+        prefix .. 'type', ARGV[8],
+        prefix .. 'tid', tid)
+    for i = 1, #text, 2 do
+        redis.call('SET', prefix .. text[i], text[i + 1])
+    end
+    if #tags > 0 then
+        redis.call('SADD', prefix .. 'tags', unpack(tags))
+    end
+    if #fields > 0 then
+        redis.call('HMSET', prefix .. 'fields', unpack(fields))
+    end
+end
+redis.call('RPUSH', 'tid:' .. tid .. ':revisions', rvid)
+redis.call('SADD', 'bid:' .. bid .. ':tiddlers', tid)
+update_indexes(tid, field_index_keys(bid, tag_index_keys(bid, tags), indexed))
+redis.call('ZADD', 'bid:' .. bid .. ':recent', modified_score(ARGV[7]), tid)
+trim_revisions('DEL', tid, tonumber(ARGV[11]), ARGV[12], tonumber(ARGV[13]))
+return {rvid, new}
+""",
+
+        # KEYS: bag:#name:bid, tiddler:#bag_name:#tiddler_name:tid,
+        #       bag:#name:moved
+        # ARGV: the channel to publish the tiddler key on, to invalidate
+        #       caches of its tid
+        # Returns 1 when deleted, 0 if there is no such tiddler, -1 if
+        # there is no such bag and -2 if it has moved to another shard.
+        'tiddler_delete': DELETE_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return -2
+end
+local bid = redis.call('GET', KEYS[1])
+if not bid then
+    return -1
+end
+local tid = redis.call('GET', KEYS[2])
+if not tid or record_attribute('tid:' .. tid, 'bid') ~= bid then
+    return 0
+end
+delete_tiddler('DEL', bid, nil, tid, KEYS[2])
+redis.call('PUBLISH', ARGV[1], KEYS[2])
+return 1
+""",
+
+        # Delete up to count tiddlers from a bag.
+        # KEYS: bag:#name:moved, if the bag is not tombstoned
+        # ARGV: bid, bag name, count, DEL or UNLINK
+        # Returns the number of tiddlers left in the bag, or -1 if it
+        # has moved to another shard.
+        'bag_delete_tiddlers': DELETE_FUNCTIONS + """
+if #KEYS > 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    return -1
+end
+redis.replicate_commands()
+local bid, bag_name = ARGV[1], ARGV[2]
+local tiddlers_key = 'bid:' .. bid .. ':tiddlers'
+for _, tid in ipairs(redis.call('SRANDMEMBER', tiddlers_key, ARGV[3])) do
+    delete_tiddler(ARGV[4], bid, bag_name, tid, nil)
+end
+return redis.call('SCARD', tiddlers_key)
+""",
+
+        # Find the revision before one just stored, to rewrite as a
+        # delta against it. See tiddlywebplugins.redisstore.delta.
+        # KEYS: tiddler:#bag_name:#tiddler_name:tid
+        # ARGV: the rvid of the revision, the keyframe interval and, if
+        #       other revisions were stored after it, how many places
+        #       from the end of the list it is, 1 for the latest
+        # Returns the rvid, text, compression and type of the revision
+        # and the number of deltas just before it, or nil if the rvid is
+        # not in that place or the revision before it is a keyframe,
+        # following interval - 1 deltas, already a delta or shares its
+        # text with other revisions. Keyframes are found from the deltas
+        # rather than the positions of revisions, which change when old
+        # ones are trimmed.
+        'revision_previous': INDEX_FUNCTIONS + """
+local tid = redis.call('GET', KEYS[1])
+if not tid then
+    return false
+end
+local revisions_key = 'tid:' .. tid .. ':revisions'
+local place = tonumber(ARGV[3] or 1)
+if redis.call('LLEN', revisions_key) < place + 1
+        or redis.call('LINDEX', revisions_key, -place) ~= ARGV[1] then
+    return false
+end
+local interval = tonumber(ARGV[2])
+local deltas = 0
+for _, older in ipairs(redis.call('LRANGE', revisions_key,
+        -place - interval, -place - 2)) do
+    if record_attribute('rvid:' .. older, 'delta') then
+        deltas = deltas + 1
+    else
+        deltas = 0
+    end
+end
+if deltas >= interval - 1 then
+    return false
+end
+local rvid = redis.call('LINDEX', revisions_key, -place - 1)
+local record = 'rvid:' .. rvid
+local digest = record_attribute(record, 'digest')
+if record_attribute(record, 'delta') or (digest and tonumber(
+        redis.call('HGET', 'text:' .. digest, 'refs') or 0) > 1) then
+    return false
+end
+local text, compression = revision_text(record)
+if not text then
+    return false
+end
+return {rvid, text, compression, record_attribute(record, 'type') or '',
+    deltas}
+""",
+
+        # Rewrite the text of a revision as a delta, in whichever layout
+        # the revision is kept, dropping its reference to shared text.
+        # The revisions of the tiddler are checked again, as others may
+        # have been stored, and delta'd, since revision_previous: the
+        # revision it is a delta against must follow it, and the run of
+        # deltas it joins must stay shorter than the keyframe interval,
+        # so that revision_chain can rebuild every revision in the run.
+        # ARGV: rvid, delta, its compression or '', the rvid of the
+        #       revision it is a delta against, the keyframe interval
+        # Returns 1, or 0 if the revision is gone, already a delta or
+        # would no longer be within the interval of a keyframe.
+        'revision_delta': DELETE_FUNCTIONS + """
+local record = 'rvid:' .. ARGV[1]
+local tid = record_attribute(record, 'tid')
+if not tid or record_attribute(record, 'delta') then
+    return 0
+end
+local revisions_key = 'tid:' .. tid .. ':revisions'
+local place = list_place(revisions_key, ARGV[1])
+if not place or place < 2
+        or redis.call('LINDEX', revisions_key, -place + 1) ~= ARGV[4] then
+    return 0
+end
+local interval = tonumber(ARGV[5])
+local run = 1
+for _, older in ipairs(redis.call('LRANGE', revisions_key,
+        -place - interval + 1, -place - 1)) do
+    if record_attribute('rvid:' .. older, 'delta') then
+        run = run + 1
+    else
+        run = 1
+    end
+end
+local last = math.min(-place + interval - 1, -1)
+for _, newer in ipairs(redis.call('LRANGE', revisions_key, -place + 1,
+        last)) do
+    if not record_attribute('rvid:' .. newer, 'delta') then
+        break
+    end
+    run = run + 1
+end
+if run > interval - 1 then
+    return 0
+end
+release_text('DEL', record)
+if redis.call('HEXISTS', record, 'tid') == 1 then
+    redis.call('HMSET', record, 'text', ARGV[2], 'delta', ARGV[4])
+    redis.call('HDEL', record, 'digest')
+    if ARGV[3] ~= '' then
+        redis.call('HSET', record, 'compression', ARGV[3])
+    else
+        redis.call('HDEL', record, 'compression')
+    end
+    return 1
+end
+redis.call('MSET', record .. ':text', ARGV[2], record .. ':delta', ARGV[4])
+redis.call('DEL', record .. ':digest')
+if ARGV[3] ~= '' then
+    redis.call('SET', record .. ':compression', ARGV[3])
+else
+    redis.call('DEL', record .. ':compression')
+end
+return 1
+""",
+
+        # Read the texts needed to rebuild a revision kept as a delta:
+        # those of the revisions from the one it is a delta against up
+        # to the next with its full text.
+        # ARGV: the rvid of the first revision, the most to read
+        # Returns the text and compression of each, or nil if a
+        # revision is missing or there are more than the most.
+        'revision_chain': INDEX_FUNCTIONS + """
+local chain = {}
+local rvid = ARGV[1]
+for _ = 1, tonumber(ARGV[2]) do
+    local record = 'rvid:' .. rvid
+    local text, compression = revision_text(record)
+    if not text then
+        return false
+    end
+    table.insert(chain, text)
+    table.insert(chain, compression)
+    rvid = record_attribute(record, 'delta')
+    if not rvid then
+        return chain
+    end
+end
+return false
+""",
+
+        # Read the shared text of a revision.
+        # ARGV: rvid
+        # Returns the text and compression, or '', or nil if the revision
+        # does not share its text.
+        'revision_shared_text': INDEX_FUNCTIONS + """
+local record = 'rvid:' .. ARGV[1]
+if not record_attribute(record, 'digest') then
+    return false
+end
+local text, compression = revision_text(record)
+if not text then
+    return false
+end
+return {text, compression}
+""",
+
+        # Add references to shared texts, storing those new to this
+        # server.
+        # ARGV: digest, reference count, text, compression or '' of each
+        # Returns the number of texts stored.
+        'texts_acquire': """
+local stored = 0
+for i = 1, #ARGV, 4 do
+    local text_key = 'text:' .. ARGV[i]
+    if redis.call('HINCRBY', text_key, 'refs', ARGV[i + 1])
+            == tonumber(ARGV[i + 1]) then
+        redis.call('HMSET', text_key, 'text', ARGV[i + 2],
+            'compression', ARGV[i + 3])
+        stored = stored + 1
+    end
+end
+return stored
+""",
+
+        # Drop references to shared texts, deleting those nothing refers
+        # to.
+        # ARGV: DEL or UNLINK, then digest and reference count of each
+        # Returns the number of texts deleted.
+        'texts_release': """
+local deleted = 0
+for i = 2, #ARGV, 2 do
+    local text_key = 'text:' .. ARGV[i]
+    if redis.call('HINCRBY', text_key, 'refs', -ARGV[i + 1]) <= 0 then
+        redis.call(ARGV[1], text_key)
+        deleted = deleted + 1
+    end
+end
+return deleted
+""",
+
+        # Remove the revisions of a tiddler which are not to be kept.
+        # KEYS: bag:#name:moved
+        # ARGV: tid, DEL or UNLINK, how many revisions to keep, the
+        #       modified time before which not to keep them, the most to
+        #       remove (see trim_revisions)
+        # Returns the number removed, or -1 if the bag has moved to
+        # another shard.
+        'tiddler_trim': DELETE_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return -1
+end
+return trim_revisions(ARGV[2], ARGV[1], tonumber(ARGV[3]), ARGV[4],
+    tonumber(ARGV[5]))
+""",
+
+        # Rebuild the index entries of a tiddler from its current revision.
+        # ARGV: schema version, tid, indexed field names...
+        # Returns 1, or 0 if the tiddler has no revisions.
+        'tiddler_reindex': INDEX_FUNCTIONS + """
+local schema, tid = ARGV[1], ARGV[2]
+local rvid = redis.call('LINDEX', 'tid:' .. tid .. ':revisions', -1)
+if not rvid then
+    return 0
+end
+local attributes = {modifier = true, modified = true, type = true}
+local bid, tags
+local indexed = {}
+if schema == '2' then
+    bid = redis.call('HGET', 'tid:' .. tid, 'bid')
+    tags = cjson.decode(redis.call('HGET', 'rvid:' .. rvid, 'tags') or '[]')
+    for i = 3, #ARGV do
+        local name = ARGV[i]
+        if not attributes[name] then
+            name = 'field:' .. name
+        end
+        local value = redis.call('HGET', 'rvid:' .. rvid, name)
+        if value then
+            table.insert(indexed, ARGV[i])
+            table.insert(indexed, value)
+        end
+    end
+else
+    bid = redis.call('GET', 'tid:' .. tid .. ':bid')
+    tags = redis.call('SMEMBERS', 'rvid:' .. rvid .. ':tags')
+    for i = 3, #ARGV do
+        local value
+        if attributes[ARGV[i]] then
+            value = redis.call('GET', 'rvid:' .. rvid .. ':' .. ARGV[i])
+        else
+            value = redis.call('HGET', 'rvid:' .. rvid .. ':fields', ARGV[i])
+        end
+        if value then
+            table.insert(indexed, ARGV[i])
+            table.insert(indexed, value)
+        end
+    end
+end
+update_indexes(tid, field_index_keys(bid, tag_index_keys(bid, tags), indexed))
+redis.call('ZADD', 'bid:' .. bid .. ':recent',
+    modified_score(record_attribute('rvid:' .. rvid, 'modified')), tid)
+return 1
+""",
+
+        # Rewrite one record from schema 1 keys to a schema 2 hash.
+        # ARGV: kind (bid, rid, uid, tid or rvid), id, attributes...
+        # Returns the number of attributes moved, 0 if already done.
+        'migrate_record': """
+local record = ARGV[1] .. ':' .. ARGV[2]
+local values = {}
+local old_keys = {}
+for i = 3, #ARGV do
+    local key = record .. ':' .. ARGV[i]
+    local value = redis.call('GET', key)
+    if value then
+        table.insert(values, ARGV[i])
+        table.insert(values, value)
+        table.insert(old_keys, key)
+    end
+end
+if #values == 0 then
+    return 0
+end
+if ARGV[1] == 'rvid' then
+    local tags = redis.call('SMEMBERS', record .. ':tags')
+    table.insert(values, 'tags')
+    if #tags > 0 then
+        table.insert(values, cjson.encode(tags))
+    else
+        table.insert(values, '[]')
+    end
+    local fields = redis.call('HGETALL', record .. ':fields')
+    for i = 1, #fields, 2 do
+        table.insert(values, 'field:' .. fields[i])
+        table.insert(values, fields[i + 1])
+    end
+    table.insert(old_keys, record .. ':tags')
+    table.insert(old_keys, record .. ':fields')
+end
+redis.call('HMSET', record, unpack(values))
+redis.call('DEL', unpack(old_keys))
+return #values / 2
+""",
+        }
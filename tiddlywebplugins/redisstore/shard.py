@@ -0,0 +1,222 @@
+"""
+Spreading bags over several redis servers, shards.
+
+The 'shards' store option lists the connection configurations of the
+shards, each as a dict like the store config, e.g. {'host': 'shard1'},
+with the settings of the store config, such as db and password, except
+those locating the server. Each shard has a name, given as 'name' or
+made from where the shard is, such as 'shard1:6379/0', by which bags
+are placed on it: renaming a shard moves its bags.
+
+The server of the store config itself is then the coordinator. It keeps
+the ids:* counters, recipes, users, the schema version and the list of
+built indexes. Everything about a bag is on one shard: its record,
+policy, tiddlers, revisions and indexes and its entry in the shard's
+bags and bags:tombstoned sets. Ids are allocated on the coordinator, so
+they are unique over all the shards and a bag keeps them when it moves.
+
+A bag is on the shard picked by consistent hashing of its name unless
+it has been moved elsewhere, when its shard is kept in the coordinator
+hash shards:placement. Each process reads that hash every
+schema_check_interval seconds.
+
+A bag is moved, while the store is in use, with the twanager command
+redismovebag. The bag is first fenced on its shard by setting the key
+bag:#name:moved to the name of the new shard. Changes to the bag check
+for that key atomically with making them and raise BagMoved if it is
+set, so none are made while the bag is copied. A Store which meets
+BagMoved reads the placements again, waiting for up to
+shard_move_wait seconds for the move to finish, and then makes the
+change on the new shard. Reads carry on from the old shard during the
+move. Once copied, the bag is placed on the new shard and, after
+schema_check_interval seconds for every process to notice, deleted from
+the old one, leaving the fence there.
+
+Redis Cluster hash tags are not needed: this is not Redis Cluster, and
+all the keys of a bag are on its shard however they are named, so
+scripts and transactions over them stay on one server.
+"""
+
+import bisect
+import functools
+import hashlib
+import time
+
+from collections import OrderedDict
+
+from redis.exceptions import WatchError
+
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.store import StoreError
+
+from tiddlywebplugins.redisstore.connection import get_client, server_config
+
+
+# The key fencing a bag on a shard it is moving or has moved from.
+MOVED_KEY = 'bag:%s:moved'
+
+# The coordinator hash of the shards of moved bags, by bag name.
+PLACEMENT_KEY = 'shards:placement'
+
+# How many points each shard has on the hash ring.
+POINTS = 64
+
+# How long to wait between looking for the end of a move.
+MOVE_POLL = 0.1
+
+# The shards of this process, by their configuration.
+SHARD_SETS = {}
+
+
+class BagMoved(StoreError):
+    """
+    The bag is moving to, or has moved to, another shard.
+    """
+    pass
+
+
+def shard_name(config):
+    """
+    The name of the shard with the connection configuration config.
+    """
+    if 'name' in config:
+        return config['name']
+    if 'unix_socket_path' in config:
+        location = config['unix_socket_path']
+    else:
+        location = '%s:%s' % (config.get('host', 'localhost'),
+                config.get('port', 6379))
+    return '%s/%s' % (location, config.get('db', 0))
+
+
+def _hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+class Shards(object):
+    """
+    The coordinator and the clients of the shards, by name, and where
+    bags are placed on them.
+    """
+
+    def __init__(self, coordinator, clients, refresh_interval=10):
+        self.coordinator = coordinator
+        self.clients = clients
+        self.refresh_interval = refresh_interval
+        self.ring = sorted((_hash('%s#%s' % (name, point)), name)
+                for name in clients for point in range(POINTS))
+        self.hashes = [point for point, _ in self.ring]
+        # the shards of moved bags
+        self.placements = {}
+        self.refreshed = 0
+
+    def ring_name(self, bag_name):
+        """
+        The name of the shard the hash ring places the bag on.
+        """
+        index = bisect.bisect(self.hashes, _hash(bag_name)) % len(self.ring)
+        return self.ring[index][1]
+
+    def name_for_bag(self, bag_name):
+        """
+        The name of the shard the bag is on.
+        """
+        if time.time() - self.refreshed > self.refresh_interval:
+            self.refresh()
+        return self.placements.get(bag_name) or self.ring_name(bag_name)
+
+    def client_for_bag(self, bag_name):
+        return self.clients[self.name_for_bag(bag_name)]
+
+    def refresh(self):
+        """
+        Read the placements of moved bags from the coordinator.
+        """
+        self.placements = self.coordinator.hgetall(PLACEMENT_KEY)
+        self.refreshed = time.time()
+
+
+def get_shards(client_class, redis_config, options):
+    """
+    Return the Shards of this process for the shards in options, with
+    the server configured by redis_config as the coordinator, or None
+    if there are no shards.
+    """
+    if not options['shards']:
+        return None
+    configs = OrderedDict()
+    for shard in options['shards']:
+        config = server_config(redis_config, shard)
+        configs[shard_name(config)] = config
+        config.pop('name', None)
+    key = (client_class, repr(sorted(redis_config.items())),
+            repr([(name, sorted(config.items()))
+                for name, config in configs.items()]))
+    if key not in SHARD_SETS:
+        SHARD_SETS[key] = Shards(get_client(client_class, redis_config),
+                OrderedDict((name, get_client(client_class, config))
+                    for name, config in configs.items()),
+                options['schema_check_interval'])
+    return SHARD_SETS[key]
+
+
+def on_bag_shard(method):
+    """
+    Decorate a Store method whose first argument is a bag, or a tiddler
+    in a bag, to send its commands to the bag's shard. If the bag is
+    moving the method is tried again once it has moved, for up to
+    shard_move_wait seconds. Generators use the shard as they are
+    consumed.
+    """
+    @functools.wraps(method)
+    def wrapper(self, entity, *args, **kwargs):
+        shards = self.shards
+        if shards is None or getattr(self.reading, 'shard', None):
+            return method(self, entity, *args, **kwargs)
+        if isinstance(entity, Bag):
+            bag_name = entity.name
+        else:
+            bag_name = entity.bag
+        deadline = time.time() + self.options['shard_move_wait']
+        while True:
+            client = shards.client_for_bag(bag_name)
+            try:
+                result = on_node(self, client, method, self, entity,
+                        *args, **kwargs)
+            except (BagMoved, WatchError):
+                shards.refresh()
+                if shards.client_for_bag(bag_name) is client:
+                    if time.time() > deadline:
+                        raise BagMoved('bag %s is moving' % bag_name)
+                    time.sleep(MOVE_POLL)
+                continue
+            if hasattr(result, 'next') and not isinstance(result, list):
+                return node_iterator(self, client, result)
+            return result
+    return wrapper
+
+
+def on_node(store, client, func, *args, **kwargs):
+    """
+    Call func with args, sending the store's commands to client.
+    """
+    previous = getattr(store.reading, 'shard', None)
+    store.reading.shard = client
+    try:
+        return func(*args, **kwargs)
+    finally:
+        store.reading.shard = previous
+
+
+def node_iterator(store, client, iterator):
+    """
+    Consume iterator, sending the store's commands to client.
+    """
+    while True:
+        try:
+            item = on_node(store, client, next, iterator)
+        except StopIteration:
+            return
+        yield item
@@ -0,0 +1,109 @@
+"""
+A store whose operations run on a pool of worker threads, for callers
+which want many operations in flight at once, such as a page which
+gets many tiddlers.
+
+ThreadedStore has the operations of tiddlyweb's Store: get, put and
+delete of bags, recipes, tiddlers and users, and the list methods.
+Each returns at once with a concurrent.futures Future of its result:
+
+    store = ThreadedStore(store_config, environ)
+    futures = [store.get(Tiddler(title, 'bag')) for title in titles]
+    tiddlers = [future.result() for future in futures]
+
+This is not an asynchronous client: the work is done by the
+synchronous Store, with redis-py, with its key layout, scripts,
+caches, replicas and shards, and each operation holds a worker thread
+while it waits on redis. What it gains is the overlap of those waits,
+which is worth most when round trips are slow. Each worker uses a
+connection of the process's pool, so as many operations are in flight
+at once as there are workers, the 'store_workers' store option: the
+pool's max_connections, if set, should be at least as many. The
+workers of a process are shared by its ThreadedStores.
+
+The list methods give lists rather than generators, so that the
+caller never waits on redis while consuming them.
+
+On Python 2 this needs the futures package, the backport of
+concurrent.futures.
+"""
+
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tiddlyweb.store import Store as StoreWrapper
+
+
+# The worker pools of this process, by pid and size, so that a forked
+# process, which has no threads, makes its own.
+EXECUTORS = {}
+
+
+def get_executor(workers):
+    """
+    Return the pool of worker threads of this process.
+    """
+    key = (os.getpid(), workers)
+    if key not in EXECUTORS:
+        EXECUTORS[key] = ThreadPoolExecutor(max_workers=workers)
+    return EXECUTORS[key]
+
+
+class ThreadedStore(object):
+    """
+    The redis store, configured by store_config, with operations which
+    return futures. Hooks and special bags work as with tiddlyweb's
+    Store, in the worker threads.
+    """
+
+    def __init__(self, store_config=None, environ=None):
+        self.store = StoreWrapper('tiddlywebplugins.redisstore',
+                store_config, environ)
+        self.storage = self.store.storage
+        self.environ = self.store.environ
+        self.executor = get_executor(self.storage.options['store_workers'])
+
+    def delete(self, thing):
+        return self._submit(self.store.delete, thing)
+
+    def get(self, thing):
+        return self._submit(self.store.get, thing)
+
+    def put(self, thing):
+        return self._submit(self.store.put, thing)
+
+    def list_bags(self):
+        return self._submit_list(self.store.list_bags)
+
+    def list_bag_tiddlers(self, bag):
+        return self._submit_list(self.store.list_bag_tiddlers, bag)
+
+    def list_recipes(self):
+        return self._submit_list(self.store.list_recipes)
+
+    def list_tiddler_revisions(self, tiddler):
+        return self._submit_list(self.store.list_tiddler_revisions, tiddler)
+
+    def count_tiddler_revisions(self, tiddler):
+        return self._submit(self.storage.count_tiddler_revisions, tiddler)
+
+    def list_users(self):
+        return self._submit_list(self.store.list_users)
+
+    def index_query(self, **kwargs):
+        return self._submit_list(self.storage.index_query, **kwargs)
+
+    def recent_tiddlers(self, bag_names, count=None, start=0):
+        return self._submit_list(self.storage.recent_tiddlers, bag_names,
+                count, start)
+
+    def recent_recipe_tiddlers(self, recipe, count=None, start=0):
+        return self._submit_list(self.storage.recent_recipe_tiddlers,
+                recipe, count, start)
+
+    def _submit(self, func, *args, **kwargs):
+        return self.executor.submit(func, *args, **kwargs)
+
+    def _submit_list(self, func, *args, **kwargs):
+        return self._submit(lambda: list(func(*args, **kwargs)))